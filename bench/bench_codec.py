@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''
+Microbenchmarks of the fused frame codec against packing and
+unpacking the EthFrame, IPDatagram and TCPSegment layers one by one.
+'''
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rawethernet import EthFrame
+from rawip import IPDatagram
+from rawtcp import TCPSegment
+from rawcodec import encode_frame, TCPFrame, ACK, PSH
+
+MAC_SRC = '\x02\x00\x00\x00\x00\x01'
+MAC_DEST = '\x02\x00\x00\x00\x00\x02'
+IP_SRC = '\x0a\x00\x00\x01'
+IP_DEST = '\x0a\x00\x00\x02'
+PAYLOAD = 'x' * 1460
+
+
+def layers_pack(data=PAYLOAD):
+    tcp_segment = TCPSegment(IP_SRC, IP_DEST, 40000, 80, 1000, 2000,
+                             tcp_fack=1, tcp_fpsh=1, tcp_adwind=65535,
+                             data=data)
+    ip_datagram = IPDatagram(IP_SRC, IP_DEST, data=tcp_segment.pack())
+    eth_frame = EthFrame(MAC_DEST, MAC_SRC, data=ip_datagram.pack())
+    return eth_frame.pack()
+
+
+def layers_unpack(frame):
+    eth_frame = EthFrame()
+    eth_frame.unpack(frame)
+    ip_datagram = IPDatagram(IP_DEST, IP_SRC)
+    ip_datagram.unpack(eth_frame.data)
+    tcp_segment = TCPSegment(IP_DEST, IP_SRC)
+    tcp_segment.unpack(ip_datagram.data)
+    return ip_datagram.verify_checksum() and tcp_segment.verify_checksum()
+
+
+def codec_pack(data=PAYLOAD):
+    return encode_frame(MAC_DEST, MAC_SRC, IP_SRC, IP_DEST, 40000, 80,
+                        1000, 2000, ACK | PSH, 65535, data)
+
+
+def codec_unpack(frame):
+    tcp_segment = TCPFrame(frame)
+    return tcp_segment.verify_ip_checksum() and \
+        tcp_segment.verify_checksum()
+
+
+def check():
+    '''
+    Both ways must produce the very same bytes
+    '''
+    for size in (0, 1, 2, 513, 1460):
+        data = PAYLOAD[:size]
+        frame = layers_pack(data)
+        assert str(codec_pack(data)) == frame, size
+        assert layers_unpack(frame) and codec_unpack(frame), size
+        assert TCPFrame(frame).data == data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    args = parser.parse_args()
+    check()
+    frame = layers_pack()
+    cases = [('pack', layers_pack, codec_pack),
+             ('unpack', lambda: layers_unpack(frame),
+              lambda: codec_unpack(frame))]
+    for name, layers, codec in cases:
+        t_layers = timeit.timeit(layers, number=args.number)
+        t_codec = timeit.timeit(codec, number=args.number)
+        print '%-8s layers: %.2fus  codec: %.2fus  speedup: %.1fx' % (
+            name, t_layers * 1e6 / args.number, t_codec * 1e6 / args.number,
+            t_layers / t_codec)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Benchmark the crawler on a synthetic in-memory site, no network
+needed: every page links to a few random pages, mostly on its own
+host, and some pages carry a target flag.
+'''
+import os
+import sys
+import random
+import argparse
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from utils import Timer
+from rawcrawler import Crawler, BloomFilter
+
+PAGE_FMT = '<html><body>%s%s</body></html>'
+LINK_FMT = '<a href="%s">page</a>\n'
+FLAG_FMT = '<h2 class="secret_flag">FLAG: %064x</h2>'
+TARGET_REG = r'secret_flag[^>]*>FLAG:\s*([0-9a-zA-Z]{64})<'
+
+
+class SyntheticSite:
+    '''
+    A site of npages pages spread over nhosts hosts
+    '''
+    def __init__(self, npages, nhosts=4, nlinks=8, remote=0.1,
+                 flags=0.01, padding=2048, seed=5700):
+        rand = random.Random(seed)
+        self.hosts = ['host%d.local' % i for i in range(nhosts)]
+        self.pages = {}
+        self.nflags = 0
+        for i in range(npages):
+            host = self.hosts[i % nhosts]
+            links = []
+            for j in range(nlinks):
+                k = rand.randrange(npages)
+                if rand.random() < remote:
+                    links.append('http://%s/p/%d' % (
+                        self.hosts[k % nhosts], k))
+                else:
+                    links.append('/p/%d' % (k - k % nhosts + i % nhosts))
+            flag = ''
+            if rand.random() < flags:
+                flag = FLAG_FMT % i
+                self.nflags += 1
+            body = ''.join(LINK_FMT % link for link in links)
+            self.pages[(host, '/p/%d' % i)] = PAGE_FMT % (
+                body + ' ' * padding, flag)
+        self.pages[(self.hosts[0], '/')] = PAGE_FMT % (
+            LINK_FMT % '/p/0', '')
+
+    def fetch(self, clients, host, uri, consume):
+        content = self.pages.get((host, uri))
+        if content is None:
+            raise ValueError('Get a non-200 response')
+        # stream the body in small chunks as a socket would
+        for i in xrange(0, len(content), 1460):
+            consume(content[i:i + 1460])
+
+
+def bench_crawl(npages, workers):
+    site = SyntheticSite(npages)
+    sink = StringIO()
+    crawler = Crawler(['http://%s/' % site.hosts[0]], TARGET_REG, sink,
+                      workers=workers, same_host=False,
+                      capacity=npages * 2, fetch=site.fetch)
+    with Timer() as t:
+        stats = crawler.run()
+    return dict(pages=stats['pages'], matches=stats['matches'],
+                flags=site.nflags, seconds=t.duration,
+                pages_per_sec=stats['pages'] / t.duration)
+
+
+def bench_seen_set(nurls, error_rate=0.001):
+    urls = ['host%d.local/p/%d' % (i % 16, i) for i in xrange(nurls)]
+    bloom = BloomFilter(nurls, error_rate)
+    with Timer() as t:
+        for url in urls:
+            bloom.add(url)
+    exact = set(urls)
+    exact_bytes = sys.getsizeof(exact) + sum(sys.getsizeof(u) for u in urls)
+    probes = ['other.local/q/%d' % i for i in xrange(nurls)]
+    false_pos = sum(1 for url in probes if url in bloom)
+    return dict(urls=nurls, bloom_bytes=len(bloom.bits),
+                set_bytes=exact_bytes, false_pos_rate=false_pos
+                / float(nurls), adds_per_sec=nurls / t.duration)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--pages', type=int, default=5000)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('-u', '--urls', type=int, default=200000)
+    args = parser.parse_args()
+    init_logger(None, 0)
+    print 'crawl:', bench_crawl(args.pages, args.workers)
+    print 'seen-set:', bench_seen_set(args.urls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+'''
+Benchmark the receive-side decode of 1MB of synthetic frames: the
+layer classes against the lazy TCPFrame view, per-frame CPU time, and
+the objects and bytes a segment holds on to while buffered in the
+reorder queue, found by walking its references as gc does. Allocation
+counts per MB come from tracemalloc when the interpreter has it (3.4+,
+or a 2.7 patched with pytracemalloc), the gc-tracked objects left per
+MB are counted on any.
+'''
+import os
+import gc
+import sys
+import time
+import types
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rawethernet import EthFrame
+from rawip import IPDatagram
+from rawtcp import TCPSegment
+from rawcodec import encode_frame, TCPFrame, ACK
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+MAC_SRC = '\x02\x00\x00\x00\x00\x01'
+MAC_DEST = '\x02\x00\x00\x00\x00\x02'
+IP_SRC = '\x0a\x00\x00\x02'
+IP_DEST = '\x0a\x00\x00\x01'
+MSS = 1460
+MB = 1 << 20
+
+
+def synthetic_frames(size=MB, mss=MSS):
+    payload = os.urandom(size)
+    return [str(encode_frame(MAC_DEST, MAC_SRC, IP_SRC, IP_DEST, 80, 40000,
+                             seq, 1, ACK, 65535, payload[seq:seq + mss]))
+            for seq in xrange(0, size, mss)]
+
+
+def decode_layers(frame):
+    eth_frame = EthFrame()
+    eth_frame.unpack(frame)
+    ip_datagram = IPDatagram(IP_DEST, IP_SRC)
+    ip_datagram.unpack(eth_frame.data)
+    tcp_segment = TCPSegment(IP_DEST, IP_SRC)
+    tcp_segment.unpack(ip_datagram.data)
+    ip_datagram.verify_checksum() and tcp_segment.verify_checksum()
+    tcp_segment.tcp_seq
+    return tcp_segment
+
+
+def decode_view(frame):
+    tcp_segment = TCPFrame(frame)
+    tcp_segment.is_tcp() and tcp_segment.verify_ip_checksum() and \
+        tcp_segment.verify_checksum()
+    tcp_segment.tcp_seq
+    return tcp_segment
+
+
+def retained(obj, shared):
+    '''
+    Return the number and the total size of the objects reachable
+    from the buffered segment, except the shared ones: the given,
+    the classes, None, the cached small ints and 1-char strings
+    '''
+    seen = set(shared)
+    stack = [obj]
+    count = size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or o is None or \
+                isinstance(o, (type, types.ClassType)) or \
+                (type(o) is int and -5 <= o <= 256) or \
+                (type(o) is str and len(o) <= 1):
+            continue
+        seen.add(id(o))
+        count += 1
+        size += sys.getsizeof(o)
+        stack.extend(gc.get_referents(o))
+    return count, size
+
+
+def bench(decode, frames):
+    # every segment is held as if waiting in the reorder queue,
+    # which detaches the views from their frames
+    queue = {}
+    gc.collect()
+    tracked = len(gc.get_objects())
+    if tracemalloc:
+        tracemalloc.start()
+    begin = time.clock()
+    for frame in frames:
+        segment = decode(frame)
+        if isinstance(segment, TCPFrame):
+            segment = segment.detach()
+        queue[segment.tcp_seq] = segment
+    cpu = time.clock() - begin
+    gc.collect()
+    tracked = len(gc.get_objects()) - tracked
+    shared = set(map(id, (frames, IP_SRC, IP_DEST, MAC_SRC, MAC_DEST)))
+    shared.update(map(id, frames))
+    held = [retained(s, shared) for s in queue.values()]
+    result = dict(us_per_frame=cpu * 1e6 / len(frames),
+                  objects_per_segment=sum(h[0] for h in held) / len(held),
+                  bytes_per_segment=sum(h[1] for h in held) / len(held),
+                  gc_objects_per_mb=tracked)
+    if tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = snapshot.statistics('filename')
+        result['allocs_per_mb'] = sum(s.count for s in stats)
+        result['alloc_bytes_per_mb'] = sum(s.size for s in stats)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--megabytes', type=int, default=4)
+    args = parser.parse_args()
+    frames = synthetic_frames(args.megabytes * MB)
+    for name, decode in (('layers', decode_layers), ('view', decode_view)):
+        result = bench(decode, frames)
+        result['gc_objects_per_mb'] /= args.megabytes
+        if 'allocs_per_mb' in result:
+            result['allocs_per_mb'] /= args.megabytes
+            result['alloc_bytes_per_mb'] /= args.megabytes
+        print '%-7s %s' % (name, result)
+    if not tracemalloc:
+        print 'tracemalloc is not available, no allocation counts'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+Throughput of RawSocket, HttpClient and urlretrieve, unmodified, on
+top of the in-process simulated link and HTTP peer, no root, NIC or
+server needed. For every scenario of link impairments it reports the
+goodput, the retransmissions of both ends and the CPU time the stack
+(the downloading thread alone) spends per MB.
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from rawdns import get_resolver
+from rawlink import set_link_factory
+from rawsim import SimLink, HttpPeer
+from rawurllib import urlretrieve
+
+HOST = 'sim.test'
+HOST_IP = '10.0.0.2'
+PATH = '/file.bin'
+MB = 1 << 20
+# RUSAGE_THREAD, which Python 2 has no constant for
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+# name -> SimLink impairments
+SCENARIOS = [
+    ('clean', dict()),
+    ('lan', dict(latency=0.0002, bandwidth=100e6)),
+    ('wan', dict(latency=0.02, bandwidth=10e6)),
+    ('jumbo', dict(mtu=9000, latency=0.0002)),
+    ('loss-1%', dict(latency=0.002, loss=0.01)),
+    ('reorder-5%', dict(latency=0.002, reorder=0.05)),
+    ('dup-5%', dict(latency=0.002, duplicate=0.05)),
+]
+
+
+def thread_cpu():
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(name, impairments, body, directory, seed):
+    peer = HttpPeer({PATH: body})
+    links = []
+
+    def factory(iface):
+        link = SimLink(peer, seed=seed, **impairments)
+        links.append(link)
+        return link
+
+    set_link_factory(factory)
+    try:
+        begin, cpu = time.time(), thread_cpu()
+        filepath = urlretrieve('http://%s%s' % (HOST, PATH), 80,
+                               directory, compress=False)
+        cpu = thread_cpu() - cpu
+        elapsed = time.time() - begin
+    finally:
+        set_link_factory(None)
+    with open(filepath, 'rb') as f:
+        if f.read() != body:
+            raise RuntimeError('%s: corrupted download' % name)
+    mb = len(body) / float(MB)
+    return dict(scenario=name,
+                goodput_mbps=mb * 8 / elapsed,
+                seconds=elapsed,
+                cpu_s_per_mb=cpu / mb,
+                peer_retransmit=peer.metrics['retransmit'],
+                stack_retransmit=sum(l.metrics['resent'] for l in links),
+                lost=sum(l.metrics['lost'] for l in links))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--megabytes', type=float, default=4)
+    parser.add_argument('-s', '--scenario', action='append',
+                        help='Run only the named scenarios')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    init_logger(None, 0)
+    get_resolver().add_host(HOST, HOST_IP)
+    body = os.urandom(int(args.megabytes * MB))
+    directory = tempfile.mkdtemp()
+    try:
+        for name, impairments in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+            result = run(name, impairments, body, directory, args.seed)
+            print ('%(scenario)-11s goodput: %(goodput_mbps)7.2f Mbit/s  '
+                   'time: %(seconds)6.2fs  cpu: %(cpu_s_per_mb).3fs/MB  '
+                   'retransmit: %(peer_retransmit)d peer, '
+                   '%(stack_retransmit)d stack  lost: %(lost)d') % result
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
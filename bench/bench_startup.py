@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''
+Startup to first byte of a small download, the file fits in one
+segment so it is on disk as soon as its first byte is. Cold runs the
+rawhttpget command line in a fresh interpreter, as a script calling
+it for every file would, daemon runs rawclient against a warm daemon
+serving from this process. Both go over the simulated link and HTTP
+peer, the cold child sets them up before calling rawhttpget.main().
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+sys.path.insert(0, SRC_DIR)
+
+HOST = 'sim.test'
+HOST_IP = '10.0.0.2'
+PATH = '/small.txt'
+URL = 'http://%s%s' % (HOST, PATH)
+BODY = 'x' * 1000
+LATENCY = 0.001
+REPEAT = 20
+
+
+def sim_link(keepalive=False):
+    '''
+    Plug the simulated link to the peer serving BODY in
+    '''
+    from rawdns import get_resolver
+    from rawlink import set_link_factory
+    from rawsim import SimLink, HttpPeer
+    get_resolver().add_host(HOST, HOST_IP)
+    peer = HttpPeer({PATH: BODY}, keepalive=keepalive)
+    set_link_factory(lambda iface: SimLink(peer, latency=LATENCY))
+
+
+def cold_child(directory):
+    '''
+    rawhttpget in this fresh interpreter, on the simulated link
+    '''
+    import rawhttpget
+
+    # the resolver wants the logger rawhttpget sets up
+    def init_logger(logfile, verbosity):
+        init(logfile, verbosity)
+        sim_link()
+    init, rawhttpget.init_logger = rawhttpget.init_logger, init_logger
+    sys.argv = ['rawhttpget', '-d', directory, URL]
+    rawhttpget.main()
+
+
+def cold(directory):
+    '''
+    Return the seconds a fresh rawhttpget takes to get the file
+    '''
+    begin = time.time()
+    subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                           '--cold-child', directory])
+    return time.time() - begin
+
+
+class Warm:
+    '''
+    A daemon serving from this process on the simulated link, its
+    first job opens the connection the next ones reuse
+    '''
+    def __init__(self, directory):
+        from rawdaemon import Daemon
+        sim_link(keepalive=True)
+        self.directory = directory
+        self.path = os.path.join(directory, 'rawhttpget.sock')
+        self.daemon = Daemon(self.path, 'sim')
+        self.daemon.bind()
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.run()
+
+    def run(self):
+        '''
+        Return the seconds rawclient takes to get the file
+        '''
+        begin = time.time()
+        subprocess.check_call([sys.executable,
+                               os.path.join(SRC_DIR, 'rawclient.py'),
+                               '-s', self.path, '-d', self.directory, URL],
+                              stdout=open(os.devnull, 'w'))
+        return time.time() - begin
+
+    def close(self):
+        self.daemon.shutdown()
+
+
+def report(name, times):
+    times = sorted(times)
+    print '%-7s best: %7.2fms  median: %7.2fms' % (
+        name, times[0] * 1e3, times[len(times) // 2] * 1e3)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--repeat', type=int, default=REPEAT)
+    parser.add_argument('--cold-child', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.cold_child:
+        cold_child(args.cold_child)
+        return
+    from logger import init_logger
+    init_logger(None, 0)
+    directory = tempfile.mkdtemp()
+    try:
+        report('cold', [cold(directory) for i in range(args.repeat)])
+        warm = Warm(directory)
+        try:
+            report('daemon', [warm.run() for i in range(args.repeat)])
+        finally:
+            warm.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
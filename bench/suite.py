@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+'''
+Microbenchmark and regression suite of the hot paths: checksum, the
+pack/unpack of every layer class, the fused codec, RawSocket receiving
+synthetic frames in and out of order, _debuf at large sizes, the
+HTTP response parser on big headers and the startup to first byte of
+rawhttpget, cold and through the daemon. Each case is timed as the
+best of several repeats.
+
+    python bench/suite.py --save bench/baseline.json
+    python bench/suite.py --compare bench/baseline.json --threshold 0.2
+
+The comparison exits with status 1 when a case got slower than its
+baseline by more than the threshold, 'make bench' runs it.
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from utils import checksum
+from rawarp import ARPPacket
+from rawethernet import EthFrame
+from rawip import IPDatagram
+from rawtcp import TCPSegment
+from rawsocket import RawSocket
+from rawsim import SIM_LOCAL_IP, SIM_LOCAL_MAC, SIM_GATEWAY_IP, \
+    SIM_GATEWAY_MAC
+from rawcodec import encode_frame, ACK, PSH, FIN
+from HttpParser import ResponseParser
+from bench_codec import layers_pack, codec_pack, codec_unpack, \
+    MAC_SRC, MAC_DEST, IP_SRC, IP_DEST, PAYLOAD
+from bench_recv import decode_view
+from bench_startup import cold, Warm
+
+MB = 1 << 20
+MSS = 1460
+SERVER_IP = '\x0a\x00\x00\x02'
+SERVER_PORT = 80
+CLIENT_PORT = 40000
+SERVER_ISN = 1000
+# each repeat runs for at least this long
+MIN_TIME = 0.1
+REPEAT = 5
+THRESHOLD = 0.2
+
+CASES = []
+
+
+def case(name):
+    '''
+    Register a case, the decorated function sets it up and returns
+    (callable, units per call) or just the callable
+    '''
+    def register(setup):
+        CASES.append((name, setup))
+        return setup
+    return register
+
+
+@case('checksum_40')
+def _():
+    data = os.urandom(40)
+    return lambda: checksum(data)
+
+
+@case('checksum_1460')
+def _():
+    data = os.urandom(1460)
+    return lambda: checksum(data)
+
+
+@case('checksum_9000')
+def _():
+    data = os.urandom(9000)
+    return lambda: checksum(data)
+
+
+@case('eth_pack')
+def _():
+    frame = EthFrame(MAC_DEST, MAC_SRC, data=PAYLOAD)
+    return frame.pack
+
+
+@case('eth_unpack')
+def _():
+    data = EthFrame(MAC_DEST, MAC_SRC, data=PAYLOAD).pack()
+    return lambda: EthFrame().unpack(data)
+
+
+@case('arp_pack')
+def _():
+    packet = ARPPacket(sha=MAC_SRC, spa=IP_SRC, tha='\xff' * 6, tpa=IP_DEST)
+    return packet.pack
+
+
+@case('arp_unpack')
+def _():
+    data = ARPPacket(sha=MAC_SRC, spa=IP_SRC, tha='\xff' * 6,
+                     tpa=IP_DEST).pack()
+    return lambda: ARPPacket().unpack(data)
+
+
+@case('ip_pack')
+def _():
+    datagram = IPDatagram(IP_SRC, IP_DEST, data=PAYLOAD)
+    return datagram.pack
+
+
+@case('ip_unpack')
+def _():
+    data = IPDatagram(IP_SRC, IP_DEST, data=PAYLOAD).pack()
+    return lambda: IPDatagram(IP_DEST, IP_SRC).unpack(data)
+
+
+@case('tcp_pack')
+def _():
+    segment = TCPSegment(IP_SRC, IP_DEST, 40000, 80, 1000, 2000,
+                         tcp_fack=1, tcp_adwind=65535, data=PAYLOAD)
+    return segment.pack
+
+
+@case('tcp_unpack')
+def _():
+    data = TCPSegment(IP_SRC, IP_DEST, 40000, 80, 1000, 2000,
+                      tcp_fack=1, tcp_adwind=65535, data=PAYLOAD).pack()
+    return lambda: TCPSegment(IP_DEST, IP_SRC).unpack(data)
+
+
+@case('layers_pack_frame')
+def _():
+    return layers_pack
+
+
+@case('codec_encode_frame')
+def _():
+    return codec_pack
+
+
+@case('codec_decode_frame')
+def _():
+    frame = str(codec_pack())
+    return lambda: codec_unpack(frame)
+
+
+@case('tcpframe_decode')
+def _():
+    frame = str(codec_pack())
+    return lambda: decode_view(frame)
+
+
+class FrameLink:
+    '''
+    Link feeding RawSocket the queued frames, it answers the
+    gateway ARP request and drops everything else the stack sends
+    '''
+    csum_valid = False
+
+    def __init__(self):
+        self.frames = deque()
+        # always readable
+        self.rfd, self.wfd = os.pipe()
+        os.write(self.wfd, 'x')
+
+    def fileno(self):
+        return self.rfd
+
+    def get_local_ip(self):
+        return SIM_LOCAL_IP
+
+    def get_local_mac(self):
+        return SIM_LOCAL_MAC
+
+    def get_mtu(self):
+        return 1500
+
+    def get_gateway_ip(self):
+        return SIM_GATEWAY_IP
+
+    def tcp_hints(self):
+        return CLIENT_PORT, 1
+
+    def send(self, data):
+        if data[12:14] == '\x08\x06':
+            reply = ARPPacket(optr=2, sha=SIM_GATEWAY_MAC,
+                              spa=SIM_GATEWAY_IP, tha=SIM_LOCAL_MAC,
+                              tpa=SIM_LOCAL_IP)
+            self.frames.append(EthFrame(SIM_LOCAL_MAC, SIM_GATEWAY_MAC,
+                                        0x0806, reply.pack()).pack())
+        return len(data)
+
+    def recv(self, bufsize):
+        return self.frames.popleft()[:bufsize]
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+def connected_socket():
+    '''
+    A RawSocket on a FrameLink, as if connected to SERVER_IP
+    '''
+    link = FrameLink()
+    sock = RawSocket('bench', link=link)
+    sock.ip_dest = SERVER_IP
+    sock.port_dest = SERVER_PORT
+    sock.tcp_ack_seq = SERVER_ISN
+    sock._build_ack_template()
+    return sock, link
+
+
+def server_frames(size, mss=MSS):
+    payload = os.urandom(size)
+    frames = [str(encode_frame(SIM_LOCAL_MAC, SIM_GATEWAY_MAC, SERVER_IP,
+                               SIM_LOCAL_IP, SERVER_PORT, CLIENT_PORT,
+                               SERVER_ISN + seq, 1, ACK | PSH, 65535,
+                               payload[seq:seq + mss]))
+              for seq in xrange(0, size, mss)]
+    fin = str(encode_frame(SIM_LOCAL_MAC, SIM_GATEWAY_MAC, SERVER_IP,
+                           SIM_LOCAL_IP, SERVER_PORT, CLIENT_PORT,
+                           SERVER_ISN + size, 1, ACK | FIN, 65535))
+    return frames, fin
+
+
+def recv_case(size, reorder=False):
+    sock, link = connected_socket()
+    frames, fin = server_frames(size)
+    if reorder:
+        # swap every other pair, half the frames arrive early
+        rand = random.Random(5700)
+        for i in xrange(0, len(frames) - 1, 2):
+            if rand.random() < 0.5:
+                frames[i], frames[i + 1] = frames[i + 1], frames[i]
+
+    def run():
+        sock.tcp_seq = 1
+        sock.tcp_ack_seq = SERVER_ISN
+        sock.hp_head = None
+        sock.tmp_buf.clear()
+        link.frames.extend(frames)
+        link.frames.append(fin)
+        # recv returns a window at most
+        while link.frames:
+            sock.recv(size)
+    return run, len(frames)
+
+
+@case('recv_frame_inorder')
+def _():
+    return recv_case(MB)
+
+
+@case('recv_frame_reorder')
+def _():
+    return recv_case(MB, reorder=True)
+
+
+def debuf_case(size):
+    sock, link = connected_socket()
+    slices = [os.urandom(MSS)] * (size / MSS)
+
+    def run():
+        sock.recv_buf[:] = slices
+        sock._debuf()
+    return run
+
+
+@case('debuf_64k')
+def _():
+    return debuf_case(64 << 10)
+
+
+@case('debuf_1m')
+def _():
+    return debuf_case(MB)
+
+
+@case('debuf_16m')
+def _():
+    return debuf_case(16 * MB)
+
+
+@case('http_parse_big_headers')
+def _():
+    headers = ''.join('X-Header-%03d: %s\r\n' % (i, 'v' * 100)
+                      for i in range(200))
+    response = ''.join(['HTTP/1.1 200 OK\r\n', 'Content-Length: 1024\r\n',
+                        'Set-Cookie: a=1\r\n' * 20, headers, '\r\n',
+                        'x' * 1024])
+    # as it comes off the socket, a segment at a time
+    chunks = [response[i:i + MSS] for i in xrange(0, len(response), MSS)]
+
+    def run():
+        parser = ResponseParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        assert parser.done
+    return run
+
+
+def startup_directory():
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    return directory
+
+
+@case('startup_cold')
+def _():
+    directory = startup_directory()
+    return lambda: cold(directory)
+
+
+@case('startup_daemon')
+def _():
+    return Warm(startup_directory()).run
+
+
+def measure(setup, min_time=MIN_TIME, repeat=REPEAT):
+    '''
+    Return the best time in microseconds per unit of the case
+    '''
+    result = setup()
+    run, units = result if isinstance(result, tuple) else (result, 1)
+    number = 1
+    while True:
+        elapsed = timeit.timeit(run, number=number)
+        if elapsed >= min_time:
+            break
+        number *= max(2, min(10, int(min_time / max(elapsed, 1e-6))))
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return best * 1e6 / number / units
+
+
+def compare(results, baseline, threshold):
+    '''
+    Print the change of every case against the baseline, return
+    the names of the cases slower by more than the threshold
+    '''
+    regressions = []
+    for name, us in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print '%-26s %10.2fus  (new)' % (name, us)
+            continue
+        change = us / base - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-26s %10.2fus  baseline %10.2fus  %+6.1f%%%s' % (
+            name, us, base, change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--match', type=str, default='',
+                        help='Only run the cases whose name contains it')
+    parser.add_argument('--save', type=str,
+                        help='Save the results as a JSON baseline')
+    parser.add_argument('--compare', type=str,
+                        help='Compare the results with a JSON baseline')
+    parser.add_argument('--baseline', type=str,
+                        help='Compare with this baseline if it exists,'
+                        + ' otherwise save it')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='The relative slowdown that fails --compare')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    args = parser.parse_args()
+    init_logger(None, 0)
+    if args.baseline:
+        if os.path.exists(args.baseline):
+            args.compare = args.baseline
+        else:
+            args.save = args.baseline
+    results = {}
+    for name, setup in CASES:
+        if args.match not in name:
+            continue
+        results[name] = measure(setup, repeat=args.repeat)
+        if not args.compare:
+            print '%-26s %10.2fus' % (name, results[name])
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(python=platform.python_version(),
+                           machine=platform.machine(), time=time.time(),
+                           results=results), f, indent=2, sort_keys=True)
+        print 'Baseline saved to %s' % args.save
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print '%d regression(s) beyond %d%%: %s' % (
+                len(regressions), args.threshold * 100,
+                ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import Counter
+
+from logger import get_logger
+
+INDEX = "index.json"
+PART = ".part"
+IDENTITY = "identity"
+# 1GB by default
+MAX_SIZE = 1 << 30
+
+
+class HttpCache:
+    """
+    An on-disk HTTP cache keyed by URL
+    A complete entry gets revalidated with If-None-Match and
+    If-Modified-Since and served from disk on a 304, a partial one
+    (a transfer that died half way) gets resumed with a Range request.
+    The bodies beyond max_size are evicted least recently used first.
+    Concurrent retrievals of one URL take turns, the later ones get
+    the body the first one has cached revalidated.
+    """
+    def __init__(self, directory, max_size=MAX_SIZE):
+        self.logger = get_logger(os.path.basename(__file__))
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # url -> (lock, number of threads holding or waiting for it)
+        self.url_locks = {}
+        self.metrics = Counter(hit=0, miss=0, resume=0, evict=0,
+                               hit_bytes=0, miss_bytes=0)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = self._load_index()
+
+    def retrieve(self, client, url, uri, filepath, reporthook=None):
+        """
+        Retrieve the url to filepath through the cache with the
+        given HttpClient, return the response code from the server.
+        reporthook gets called as by urlretrieve for the body that
+        comes over the wire, a body served from disk is one block.
+        """
+        lock = self._acquire(url)
+        try:
+            return self._retrieve(client, url, uri, filepath, reporthook)
+        finally:
+            self._release(url, lock)
+
+    def _retrieve(self, client, url, uri, filepath, reporthook):
+        with self.lock:
+            entry = self.index.get(url)
+        if entry and not entry["complete"] and not self._resumable(entry):
+            self._drop(url)
+            entry = None
+        try:
+            rc = self._fetch(client, url, uri, entry, reporthook)
+        except ValueError:
+            # e.g. 416 when the partial body is stale, start over once
+            if not entry or entry["complete"]:
+                raise
+            self._drop(url)
+            rc = self._fetch(client, url, uri, None, reporthook)
+        with self.lock:
+            path = self._path(self.index[url])
+        # the URL lock keeps the body from being evicted or replaced,
+        # other URLs need not wait for the copy
+        shutil.copyfile(path, filepath)
+        with self.lock:
+            entry = self.index[url]
+            entry["atime"] = time.time()
+            if entry["no_store"]:
+                self._drop(url, locked=True)
+            else:
+                self._evict(keep=url)
+                self._save_index()
+        return rc
+
+    def dump_metrics(self):
+        """
+        Dump the metrics counters for debug usage
+        """
+        lookups = self.metrics["hit"] + self.metrics["miss"] + \
+            self.metrics["resume"]
+        dump = "\n".join("\t%s: %d" % (k, v) for (k, v)
+                         in self.metrics.items())
+        dump += "\n\thit_rate: %.2f" % (
+            self.metrics["hit"] / float(lookups) if lookups else 0)
+        return dump, self.metrics
+
+    def _fetch(self, client, url, uri, entry, reporthook=None):
+        """
+        Send the conditional or Range request for the entry and
+        stream the response body into the cached file
+        """
+        headers = {}
+        if entry and entry["complete"]:
+            if entry["etag"]:
+                headers["If-None-Match"] = str(entry["etag"])
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = str(entry["last_modified"])
+        elif entry:
+            # ranges only make sense on the identity representation
+            headers["Range"] = "bytes=%d-" % entry["size"]
+            headers["If-Range"] = str(self._validator(entry))
+            headers["Accept-Encoding"] = IDENTITY
+        writer = _BodyWriter(self, url, entry, reporthook)
+        try:
+            rc, _ = client.retrieve(uri, writer.write, headers,
+                                    writer.on_response)
+        finally:
+            writer.close()
+        if rc == "304":
+            writer.served()
+            self.metrics["hit"] += 1
+            self.metrics["hit_bytes"] += entry["size"]
+            self.logger.info("[Cache: hit, URL: %s]" % url)
+        elif rc == "206":
+            self.metrics["resume"] += 1
+            self.metrics["hit_bytes"] += writer.offset
+            self.metrics["miss_bytes"] += writer.written
+            self.logger.info("[Cache: resumed at %d, URL: %s]"
+                             % (writer.offset, url))
+        else:
+            self.metrics["miss"] += 1
+            self.metrics["miss_bytes"] += writer.written
+            self.logger.info("[Cache: miss, URL: %s]" % url)
+        with self.lock:
+            self.index[url]["complete"] = True
+        return rc
+
+    def _acquire(self, url):
+        with self.lock:
+            lock, users = self.url_locks.get(url, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self.url_locks[url] = (lock, users + 1)
+        lock.acquire()
+        return lock
+
+    def _release(self, url, lock):
+        lock.release()
+        with self.lock:
+            users = self.url_locks[url][1] - 1
+            if users:
+                self.url_locks[url] = (lock, users)
+            else:
+                del self.url_locks[url]
+
+    def _resumable(self, entry):
+        return entry["encoding"] == IDENTITY and entry["size"] > 0 and \
+            bool(self._validator(entry))
+
+    def _validator(self, entry):
+        """
+        Return the strong validator If-Range may carry, if any
+        """
+        etag = entry["etag"]
+        if etag and not etag.startswith("W/"):
+            return etag
+        return entry["last_modified"]
+
+    def _path(self, entry):
+        return os.path.join(self.directory, entry["file"])
+
+    def _drop(self, url, locked=False):
+        if not locked:
+            with self.lock:
+                return self._drop(url, True)
+        entry = self.index.pop(url, None)
+        if entry and os.path.exists(self._path(entry)):
+            os.remove(self._path(entry))
+        self._save_index()
+
+    def _evict(self, keep):
+        """
+        Remove the least recently used bodies until the total size
+        fits in max_size, the lock must be held. The bodies being
+        retrieved are left alone.
+        """
+        total = sum(e["size"] for e in self.index.values())
+        for url, entry in sorted(self.index.items(),
+                                 key=lambda item: item[1]["atime"]):
+            if total <= self.max_size:
+                break
+            if url == keep or url in self.url_locks:
+                continue
+            total -= entry["size"]
+            self._drop(url, locked=True)
+            self.metrics["evict"] += 1
+            self.logger.debug("[Cache: evicted, URL: %s]" % url)
+
+    def _load_index(self):
+        path = os.path.join(self.directory, INDEX)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            self.logger.warn("Corrupted cache index %s, starting over"
+                             % path)
+            return {}
+
+    def _save_index(self):
+        path = os.path.join(self.directory, INDEX)
+        with open(path + PART, "w") as f:
+            json.dump(self.index, f)
+        os.rename(path + PART, path)
+
+
+class _BodyWriter:
+    """
+    Write the body of one cached response, the file is only opened
+    once the response code tells whether to truncate or append
+    """
+    def __init__(self, cache, url, entry, reporthook=None):
+        self.cache = cache
+        self.url = url
+        self.entry = entry
+        self.file = None
+        self.offset = 0
+        self.written = 0
+        self.reporthook = reporthook
+        self.blocks = 0
+        self.total = -1
+
+    def on_response(self, rc, headers):
+        cache = self.cache
+        if rc == "304":
+            self.total = self.entry["size"]
+            self._report(0)
+            return
+        if rc == "206":
+            start = headers.get("Content-Range", "").split(" ")[-1]
+            if not start.startswith("%d-" % self.entry["size"]):
+                raise ValueError("Unexpected Content-Range: %s"
+                                 % headers.get("Content-Range"))
+            self.offset = self.entry["size"]
+            entry = self.entry
+        else:
+            entry = {
+                "file": hashlib.sha1(self.url).hexdigest(),
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "encoding": headers.get("Content-Encoding",
+                                        IDENTITY).lower(),
+                "no_store": "no-store" in headers.get("Cache-Control", ""),
+                "size": 0,
+            }
+        entry.update(complete=False, atime=time.time())
+        with cache.lock:
+            cache.index[self.url] = entry
+            cache._save_index()
+        self.entry = entry
+        self.file = open(cache._path(entry), "ab" if self.offset else "wb")
+        self.total = int(headers.get("Content-Length", -1))
+        self._report(0)
+
+    def write(self, data):
+        self.file.write(data)
+        self.written += len(data)
+        self.blocks += 1
+        self._report(len(data))
+
+    def served(self):
+        """
+        The cached body is served from disk after a 304
+        """
+        self.blocks += 1
+        self._report(self.entry["size"])
+
+    def _report(self, size):
+        if self.reporthook is not None:
+            self.reporthook(self.blocks, size, self.total)
+
+    def close(self):
+        """
+        Record how much of the body made it to disk, so that a
+        broken transfer can be resumed from there
+        """
+        if self.file is None:
+            return
+        self.file.close()
+        with self.cache.lock:
+            self.entry["size"] = self.offset + self.written
+            self.cache._save_index()
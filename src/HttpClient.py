@@ -1,16 +1,30 @@
 import rawsocket as s
 import os
+import mmap
+import time
+import threading
 
 import HttpParser as P
 from logger import get_logger
 
 DELIM = "\r\n"
 BLANK = ""
+IDENTITY = "identity"
+ACCEPT_ENCODING = "gzip, deflate"
 RECVBUFSIZE = 65535
+OCTET_STREAM = "application/octet-stream"
+# idle keep-alive connections kept per host and for how long, below
+# the keep-alive timeout of most servers
+MAX_IDLE = 2
+IDLE_TIMEOUT = 15
 RC = {
     "200": "OK",
+    "201": "Created",
+    "204": "No Content",
+    "206": "Partial Content",
     "301": "Moved",
     "302": "Found",
+    "304": "Not Modified",
     "403": "Forbidden",
     "404": "Not Found",
     "500": "Internal Error",
@@ -21,8 +35,12 @@ class HttpClient:
     """
     A simple HTTP client wrapper based on socket
     ONE client per host
+    With a ConnectionPool, the connection is kept alive after a
+    response framed by its length or chunks and the next request
+    to the host, from this client or another, goes over it
     """
-    def __init__(self, server, port=80, iface='eth0'):
+    def __init__(self, server, port=80, iface='eth0', compress=True,
+                 pool=None):
         self.logger = get_logger(os.path.basename(__file__))
         self.logger.debug("Initializing the HTTP client for host %s"
                           % server)
@@ -30,54 +48,248 @@ class HttpClient:
         self.port = port
         self.iface = iface
         self.GET_BASE = self._GET_base()
+        self.UPLOAD_BASE = self._upload_base()
         self.http_params = {
             "uri": BLANK,
+            "host": server,
+            "encoding": ACCEPT_ENCODING if compress else IDENTITY,
+            "extra": BLANK,
         }
-        self.parser = P.HttpParser()
+        # body bytes received on the wire against bytes decoded,
+        # and request body bytes sent
+        self.stats = {"wire": 0, "decoded": 0, "sent": 0, "reused": 0}
         self.socket = None
+        self.pool = pool
+        # whether the last response has begun, and whether it leaves
+        # the connection reusable
+        self.responded = False
+        self.keep_alive = False
 
     def GET(self, uri):
-        self.http_params["uri"] = uri
-        response = self._send_request(self.GET_BASE, **self.http_params)
-        response_code = self.parser.get_response_code(response)
-        headers, content = self._process_response(
-            response_code, response, self.GET_BASE, **self.http_params)
-        return response_code, headers, content
-
-    def _send_request(self, req_base, **params):
+        chunks = []
+        response_code, headers = self.retrieve(uri, chunks.append)
+        return response_code, headers, BLANK.join(chunks)
+
+    def retrieve(self, uri, write, headers=None, on_response=None):
+        """
+        GET the uri and hand each body chunk to write as it streams
+        off the socket, the body is never held in memory as a whole.
+        The given headers are added to the request (Accept-Encoding
+        replaces the default one), and on_response gets called with
+        the response code and headers before the first body chunk.
+        """
+        params = dict(self.http_params, uri=uri)
+        if headers:
+            headers = dict(headers)
+            params["encoding"] = headers.pop("Accept-Encoding",
+                                             params["encoding"])
+            params["extra"] = BLANK.join("%s: %s%s" % (k, v, DELIM)
+                                         for k, v in headers.items())
+        return self._send_request(self.GET_BASE, write, on_response,
+                                  **params)
+
+    def PUT(self, uri, body, headers=None):
+        chunks = []
+        response_code, headers = self.upload("PUT", uri, body,
+                                             chunks.append, headers)
+        return response_code, headers, BLANK.join(chunks)
+
+    def POST(self, uri, body, headers=None):
+        chunks = []
+        response_code, headers = self.upload("POST", uri, body,
+                                             chunks.append, headers)
+        return response_code, headers, BLANK.join(chunks)
+
+    def upload(self, method, uri, body, write, headers=None,
+               on_response=None):
+        """
+        Send body to the uri with the given method and hand the
+        response body to write. The body is a string, a file, which
+        gets mapped and streamed from the page cache, or an iterable
+        of chunks sent with the chunked transfer encoding, so that the
+        memory taken does not grow with the size of the upload.
+        """
+        headers = dict(headers or {})
+        headers.setdefault("Content-Type", OCTET_STREAM)
+        mapped = None
+        if hasattr(body, "fileno"):
+            fileno = body.fileno()
+            size = os.fstat(fileno).st_size
+            # an empty file cannot be mapped
+            body = BLANK
+            if size:
+                body = mapped = mmap.mmap(fileno, size,
+                                          access=mmap.ACCESS_READ)
+        if isinstance(body, (str, mmap.mmap)):
+            headers["Content-Length"] = len(body)
+        else:
+            headers["Transfer-Encoding"] = "chunked"
+        params = dict(self.http_params, uri=uri, method=method, body=body)
+        params["encoding"] = headers.pop("Accept-Encoding",
+                                         params["encoding"])
+        params["extra"] = BLANK.join("%s: %s%s" % (k, v, DELIM)
+                                     for k, v in headers.items())
+        try:
+            return self._send_request(self.UPLOAD_BASE, write, on_response,
+                                      **params)
+        finally:
+            if mapped is not None:
+                mapped.close()
+
+    def _send_request(self, req_base, write, on_response=None, **params):
         self.logger.debug("[Request: %s]" % params["uri"])
+        body = params.pop("body", None)
         request = req_base % params
-        self.socket = self._new_connection()
-        self.socket.send(request)
-        response = ''
-        buffer = self.socket.recv(RECVBUFSIZE)
-        while buffer:
-            response += buffer
+        self.socket = self.pool and self.pool.get(self.server, self.port)
+        if self.socket:
+            self.stats["reused"] += 1
+            try:
+                return self._exchange(request, body, write, on_response,
+                                      reused=True, **params)
+            except RuntimeError as e:
+                # closed by the server in between, try a new one
+                # unless the response has begun or the body chunks
+                # cannot be sent again
+                if self.responded or not isinstance(
+                        body, (type(None), str, mmap.mmap)):
+                    raise
+                self.logger.info("Idle connection to %s lost: %s"
+                                 % (self.server, e))
+        # the request goes in the SYN with TCP Fast Open
+        self.socket = self._new_connection(request)
+        return self._exchange(None, body, write, on_response, **params)
+
+    def _exchange(self, request, body, write, on_response, reused=False,
+                  **params):
+        """
+        Send the request, unless it went out with the connection, and
+        the body, receive the response, then give the connection
+        back to the pool or close it. A reused connection that fails,
+        or a response given up half way, e.g. on an error status,
+        gets the connection reset instead of waiting for the rest.
+        """
+        self.keep_alive = False
+        self.responded = False
+        done = False
+        try:
+            if request:
+                self.socket.send(request)
+            if body is not None:
+                self._send_body(body, **params)
+            response = self._recv_response(write, on_response, **params)
+            done = True
+            return response
+        finally:
+            if self.keep_alive and not self.socket.fin_received:
+                self.pool.put(self.server, self.port, self.socket)
+            elif not done and (reused or self.responded):
+                self.socket.abort()
+            else:
+                self._close_connection()
+            self.logger.debug(self.socket.dump_metrics()[0])
+
+    def _send_body(self, body, **params):
+        """
+        Stream the request body, a segment at a time out of a string
+        or a mapped file, or as chunks, then wait for it to be
+        acknowledged
+        """
+        sent = 0
+        if isinstance(body, (str, mmap.mmap)):
+            sent = self.socket.send(body)
+        else:
+            for chunk in body:
+                if chunk:
+                    self.socket.send("%x%s%s%s" % (len(chunk), DELIM,
+                                                   chunk, DELIM))
+                    sent += len(chunk)
+            self.socket.send("0" + DELIM + DELIM)
+        self.socket.flush()
+        self.stats["sent"] += sent
+        self.logger.info("[Request: %s, URL: %s], %d bytes sent"
+                         % (params["method"], params["uri"], sent))
+
+    def _recv_response(self, write, on_response=None, **params):
+        parser = P.ResponseParser()
+        response_code = headers = decoder = None
+        wire = 0
+        while not parser.done:
             buffer = self.socket.recv(RECVBUFSIZE)
-        self._close_connection()
-        self.logger.debug(self.socket.dump_metrics()[0])
-        return response
+            events = parser.feed(buffer) if buffer else parser.finish()
+            for event, value in events:
+                if event == "body":
+                    wire += len(value)
+                    write(value)
+                elif event == "headers" and not parser.code.startswith("1"):
+                    self.responded = True
+                    response_code, headers = parser.code, value
+                    self._process_response(response_code, headers,
+                                           **params)
+                    if on_response:
+                        on_response(response_code, headers)
+                    decoder = self._content_decoder(headers, write)
+                    if decoder:
+                        write = decoder.feed
+                elif event == "done" and decoder:
+                    decoder.flush()
+        decoded = decoder.decoded_bytes if decoder else wire
+        self.keep_alive = self.pool is not None and parser.keep_alive
+        self.stats["wire"] += wire
+        self.stats["decoded"] += decoded
+        self.logger.info("[Response: %s, URL: %s], %d bytes on the wire,"
+                         " %d bytes decoded" % (response_code, params["uri"],
+                                                wire, decoded))
+        return response_code, headers
 
-    def _process_response(self, rc, response, req_base, **params):
-        headers, content = self.parser.split_response(response)
-        if rc in ("200",):  # just return the content if OK
+    def _content_decoder(self, headers, write):
+        """
+        Return a streaming decoder writing to write if the body
+        is compressed, otherwise None
+        """
+        encoding = headers.get("Content-Encoding", IDENTITY).lower()
+        if encoding == IDENTITY:
+            return None
+        elif encoding in P.CODINGS:
+            return P.ContentDecoder(encoding, write)
+        else:
+            raise ValueError("Unsupported content encoding: %s" % encoding)
+
+    def _process_response(self, rc, headers, **params):
+        # go on streaming the content if OK, a partial content
+        # answers a Range request and a not modified one has no body
+        if rc in ("200", "201", "204", "206", "304"):
             self.logger.debug("[Response: %s %s, URL: %s], OK"
                               % (rc, RC[rc], params["uri"]))
-            return headers, content
-        else:   # abort if recv non-200 response
+        else:   # abort if recv any other response
             self.logger.error("[Response: %s, URL: %s], quit"
                               % (rc, params["uri"]))
             raise ValueError('Get a non-200 response')
 
-    def _new_connection(self):
+    def _new_connection(self, request=""):
         socket = s.RawSocket(self.iface)
-        socket.connect((self.server, self.port))
+        socket.keepalive = self.pool is not None
+        socket.connect((self.server, self.port), request)
         return socket
 
     def _close_connection(self):
         if self.socket:
             self.socket.close()
 
+    def _upload_base(self):
+        """
+        Return a PUT or POST request string with placeholder, the
+        body headers come in extra
+        """
+        UPLOAD_BASE = "%(method)s %(uri)s HTTP/1.1" + DELIM + \
+            "From: yuan.yin@husky.neu.edu" + DELIM + \
+            "User-Agent: enzen/1.0" + DELIM + \
+            "Host: %(host)s" + DELIM + \
+            "Accept-Encoding: %(encoding)s" + DELIM + \
+            "Connection: Keep-Alive" + DELIM + \
+            "%(extra)s" + \
+            DELIM
+        return UPLOAD_BASE
+
     def _GET_base(self):
         """
         Return a GET request string with placeholder
@@ -85,7 +297,85 @@ class HttpClient:
         GET_BASE = "GET %(uri)s HTTP/1.1" + DELIM + \
             "From: yuan.yin@husky.neu.edu" + DELIM + \
             "User-Agent: enzen/1.0" + DELIM + \
-            "Host: david.choffnes.com" + DELIM + \
+            "Host: %(host)s" + DELIM + \
+            "Accept-Encoding: %(encoding)s" + DELIM + \
             "Connection: Keep-Alive" + DELIM + \
+            "%(extra)s" + \
             DELIM
         return GET_BASE
+
+
+class ConnectionPool:
+    """
+    Idle keep-alive connections by host and port, at most max_idle
+    per host for at most idle_timeout seconds. A connection the
+    server has closed in the meantime is dropped on the way out.
+    """
+    def __init__(self, max_idle=MAX_IDLE, idle_timeout=IDLE_TIMEOUT):
+        self.logger = get_logger(os.path.basename(__file__))
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # (host, port) -> [(idle since, RawSocket)], oldest first
+        self.idle = {}
+
+    def get(self, server, port):
+        """
+        Return an idle connection to the host that is still open,
+        the most recent one, or None
+        """
+        while True:
+            with self.lock:
+                idle = self.idle.get((server, port))
+                if not idle:
+                    return None
+                since, socket = idle.pop()
+            if time.time() - since < self.idle_timeout and socket.alive():
+                return socket
+            self._discard(socket)
+
+    def put(self, server, port, socket):
+        with self.lock:
+            idle = self.idle.setdefault((server, port), [])
+            idle.append((time.time(), socket))
+            surplus = idle[:-self.max_idle]
+            del idle[:-self.max_idle]
+        for since, socket in surplus:
+            self._close(socket)
+
+    def prune(self):
+        """
+        Close the connections idle for too long
+        """
+        now = time.time()
+        expired = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                expired += [socket for since, socket in idle
+                            if now - since >= self.idle_timeout]
+                idle[:] = [(since, socket) for since, socket in idle
+                           if now - since < self.idle_timeout]
+        for socket in expired:
+            self._close(socket)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for since, socket in connections:
+                self._close(socket)
+
+    def _close(self, socket):
+        if not socket.alive():
+            self._discard(socket)
+            return
+        try:
+            socket.close()
+        except RuntimeError as e:
+            self.logger.info("Cannot close an idle connection: %s" % e)
+
+    def _discard(self, socket):
+        try:
+            socket.abort()
+        except (RuntimeError, IOError) as e:
+            self.logger.debug("Cannot reset an idle connection: %s" % e)
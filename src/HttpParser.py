@@ -1,5 +1,6 @@
 import re
 import os
+import zlib
 
 from logger import get_logger
 
@@ -8,10 +9,24 @@ LINE_DELIM = "\r\n"
 HEADER_DELIM = ":"
 FIELD_DELIM = ";"
 PARAM_DELIM = "="
+BLANK_REASON = ""
 # regex matching href in HTML
 HREF_REG = r'<a[^>]+href\s*=\s*["\']([^\s@]+)["\'][^>]*>[^<>]+</a>'
 # regex matching a full or partial url
 URL_REG = r'(https?://([^\s/]+))?([^\s]*)'
+# the most bytes the status line and headers may take
+MAX_HEAD_SIZE = 65536
+# the most decoded bytes a compressed body chunk may inflate to at once
+DECODE_CHUNK = 65536
+# zlib window bits for each supported content coding
+CODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "x-gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+# states of the streaming response parser
+STATUS, HEADERS, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, \
+    UNTIL_CLOSE, DONE = range(9)
 
 
 class HttpParser:
@@ -87,8 +102,7 @@ class HttpParser:
 
     def get_header_values(self, headers, header_key):
         header_values = []
-        while headers.find(LINE_DELIM) > 0:
-            header, headers = headers.split(LINE_DELIM, 1)
+        for header in headers.split(LINE_DELIM):
             if header.strip().startswith(header_key):
                 header_values.append(header.split(HEADER_DELIM, 1)[1].strip())
         if header_values:
@@ -110,3 +124,245 @@ class HttpParser:
                               % param_key)
             self.logger.debug("Header Values:\n%s" % header_values)
             raise RuntimeError()
+
+
+class Headers(dict):
+    """
+    HTTP headers keyed by lower-cased field name, the values of
+    a repeated field are joined with commas as RFC 7230 allows
+    """
+    def __init__(self, lines=()):
+        dict.__init__(self)
+        for line in lines:
+            name, sep, value = line.partition(HEADER_DELIM)
+            if not sep:
+                raise RuntimeError("Malformed HTTP header: %s" % line)
+            name = name.strip().lower()
+            value = value.strip()
+            if name in self:
+                value = dict.__getitem__(self, name) + ", " + value
+            dict.__setitem__(self, name, value)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+
+class ResponseParser:
+    """
+    Incremental HTTP/1.1 response parser
+    Bytes are fed in chunks of any size as they come off the socket,
+    and each feed returns the events completed by the chunk:
+        ("status", (version, code, reason))
+        ("headers", Headers)
+        ("body", chunk)
+        ("trailers", Headers)
+        ("done", None)
+    Body chunks are slices of the fed data, nothing but the current
+    header or chunk-size line is ever buffered.
+    """
+    def __init__(self, no_body=False):
+        self.no_body = no_body
+        self.state = STATUS
+        self.buf = ""
+        self.lines = []
+        self.version = None
+        self.code = None
+        self.headers = None
+        self.remaining = 0
+        self.until_close = False
+
+    @property
+    def done(self):
+        return self.state == DONE
+
+    @property
+    def keep_alive(self):
+        """
+        True once the response is done if the connection may carry
+        another request, the body must not have ended with it
+        """
+        if not self.done or self.until_close:
+            return False
+        connection = self.headers.get("Connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def feed(self, data):
+        events = []
+        pos = 0
+        while pos < len(data) and self.state != DONE:
+            if self.state in (BODY, CHUNK_DATA, UNTIL_CLOSE):
+                pos = self._feed_body(data, pos, events)
+            else:
+                pos = self._feed_line(data, pos, events)
+        return events
+
+    def finish(self):
+        """
+        Signal the end of the connection, return the last events
+        """
+        events = []
+        if self.state == UNTIL_CLOSE:
+            self._finish(events)
+        elif self.state != DONE:
+            raise RuntimeError("Connection closed before the end of"
+                               + " the HTTP response")
+        return events
+
+    def _feed_body(self, data, pos, events):
+        if self.state == UNTIL_CLOSE:
+            end = len(data)
+        else:
+            end = min(len(data), pos + self.remaining)
+            self.remaining -= end - pos
+        if end > pos:
+            events.append(("body", data[pos:end]))
+        if self.state == CHUNK_DATA and not self.remaining:
+            self.state = CHUNK_END
+        elif self.state == BODY and not self.remaining:
+            self._finish(events)
+        return end
+
+    def _feed_line(self, data, pos, events):
+        end = data.find("\n", pos)
+        if end < 0:
+            self.buf += data[pos:]
+            if len(self.buf) > MAX_HEAD_SIZE:
+                raise RuntimeError("HTTP response head is too large")
+            return len(data)
+        line = (self.buf + data[pos:end]).rstrip("\r")
+        self.buf = ""
+        self._on_line(line, events)
+        return end + 1
+
+    def _on_line(self, line, events):
+        if self.state == STATUS:
+            fields = line.split(None, 2)
+            if len(fields) < 2 or not fields[0].startswith("HTTP/"):
+                raise RuntimeError("Cannot find the status line in"
+                                   + " HTTP response")
+            self.version, self.code = fields[0], fields[1]
+            events.append(("status", (fields[0], fields[1],
+                                      fields[2] if len(fields) > 2
+                                      else BLANK_REASON)))
+            self.state = HEADERS
+        elif self.state in (HEADERS, TRAILERS):
+            if line:
+                self.lines.append(line)
+                if sum(len(l) for l in self.lines) > MAX_HEAD_SIZE:
+                    raise RuntimeError("HTTP response head is too large")
+            elif self.state == HEADERS:
+                self._on_headers(events)
+            else:
+                events.append(("trailers", Headers(self.lines)))
+                self._finish(events)
+        elif self.state == CHUNK_SIZE:
+            size = line.split(FIELD_DELIM, 1)[0].strip()
+            try:
+                self.remaining = int(size, 16)
+            except ValueError:
+                raise RuntimeError("Bad chunk size in HTTP response: %s"
+                                   % size)
+            if self.remaining:
+                self.state = CHUNK_DATA
+            else:
+                self.lines = []
+                self.state = TRAILERS
+        elif self.state == CHUNK_END:
+            if line:
+                raise RuntimeError("Missing CRLF after HTTP chunk")
+            self.state = CHUNK_SIZE
+
+    def _on_headers(self, events):
+        self.headers = Headers(self.lines)
+        self.lines = []
+        events.append(("headers", self.headers))
+        # a 1xx interim response is followed by the real one
+        if self.code.startswith("1"):
+            self.state = STATUS
+            return
+        encoding = self.headers.get("Transfer-Encoding", "").lower()
+        if self.no_body or self.code in ("204", "304"):
+            self._finish(events)
+        elif encoding and encoding != "identity":
+            if not encoding.endswith("chunked"):
+                raise RuntimeError("Unsupported transfer encoding: %s"
+                                   % encoding)
+            self.state = CHUNK_SIZE
+        elif "Content-Length" in self.headers:
+            try:
+                self.remaining = int(self.headers["Content-Length"])
+            except ValueError:
+                raise RuntimeError("Bad Content-Length in HTTP response")
+            self.state = BODY
+            if not self.remaining:
+                self._finish(events)
+        else:
+            self.state = UNTIL_CLOSE
+            self.until_close = True
+
+    def _finish(self, events):
+        self.state = DONE
+        events.append(("done", None))
+
+
+class ContentDecoder:
+    """
+    Streaming decoder of a gzip or deflate Content-Encoding
+    The compressed body chunks are inflated as they arrive and handed
+    to write in pieces of at most DECODE_CHUNK bytes, so the memory
+    taken stays bounded whatever the compression ratio.
+    """
+    def __init__(self, encoding, write, max_chunk=DECODE_CHUNK):
+        self.encoding = encoding
+        self.wbits = CODINGS[encoding]
+        self.decompressor = zlib.decompressobj(self.wbits)
+        self.write = write
+        self.max_chunk = max_chunk
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        # the deflate bytes fed before the first decoded output, to
+        # be replayed if the zlib wrapper turns out to be missing
+        self.head = [] if self.wbits == zlib.MAX_WBITS else None
+
+    def feed(self, data):
+        if self.head is not None:
+            self.head.append(data)
+        try:
+            self._inflate(data)
+        except zlib.error as e:
+            # some servers send a raw deflate stream without the zlib
+            # wrapper, fall back to it if the very first bytes fail
+            if self.decoded_bytes or self.head is None:
+                raise RuntimeError("Cannot decode %s content: %s"
+                                   % (self.encoding, e))
+            head, self.head = "".join(self.head), None
+            self.wbits = -zlib.MAX_WBITS
+            self.decompressor = zlib.decompressobj(self.wbits)
+            self.wire_bytes = 0
+            self.feed(head)
+            return
+        if self.decoded_bytes:
+            self.head = None
+
+    def _inflate(self, data):
+        self.wire_bytes += len(data)
+        while data:
+            chunk = self.decompressor.decompress(data, self.max_chunk)
+            if chunk:
+                self.decoded_bytes += len(chunk)
+                self.write(chunk)
+            data = self.decompressor.unconsumed_tail
+
+    def flush(self):
+        chunk = self.decompressor.flush()
+        if chunk:
+            self.decoded_bytes += len(chunk)
+            self.write(chunk)
@@ -3,6 +3,8 @@ import sys
 from collections import defaultdict
 
 init = False
+# loggers by name, saves the trip through the logging hierarchy
+_loggers = {}
 
 LEVELS = defaultdict(lambda: L.DEBUG, {
     0: L.ERROR,
@@ -36,6 +38,9 @@ def init_logger(logfile, verbosity):
 
 
 def get_logger(name):
-    if not init:
-        raise ValueError("The logger has not been initialized")
-    return L.getLogger(name)
+    logger = _loggers.get(name)
+    if logger is None:
+        if not init:
+            raise ValueError("The logger has not been initialized")
+        logger = _loggers[name] = L.getLogger(name)
+    return logger
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''
+Thin client of the rawhttpget daemon (rawhttpget --daemon), it hands
+the downloads over to the warm daemon on its Unix socket and prints
+the path of every file. None of the stack gets imported, and getopt
+stands in for argparse, so that it starts in a fraction of the time.
+
+    rawclient [-s SOCKET] [-d DIR] [-p PORT] [--no-compression]
+              [--json] URL...
+
+The exit status is 1 if any download failed, 2 if the daemon cannot
+be reached.
+'''
+import os
+import sys
+import json
+import socket
+import getopt
+
+DEFAULT_SOCKET = '/var/run/rawhttpget.sock'
+USAGE = ('usage: rawclient [-s SOCKET] [-d DIR] [-p PORT]'
+         ' [--no-compression] [--json] URL...')
+
+
+def submit(urls, path=DEFAULT_SOCKET, directory='.', port=80,
+           compress=True):
+    '''
+    Send the download jobs to the daemon at once and yield its
+    replies as they come, in the order of the urls
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    try:
+        directory = os.path.abspath(directory)
+        conn.sendall(''.join(json.dumps(dict(url=url, directory=directory,
+                                             port=port, compress=compress))
+                             + '\n' for url in urls))
+        conn.shutdown(socket.SHUT_WR)
+        replies = conn.makefile('rb')
+        for url in urls:
+            line = replies.readline()
+            if not line:
+                raise socket.error('The daemon hung up')
+            yield json.loads(line)
+    finally:
+        conn.close()
+
+
+def main(argv):
+    try:
+        opts, urls = getopt.getopt(argv, 's:d:p:h', [
+            'socket=', 'directory=', 'port=', 'no-compression', 'json',
+            'help'])
+    except getopt.GetoptError as e:
+        sys.stderr.write('%s\n%s\n' % (e, USAGE))
+        return 2
+    options = dict(opts)
+    if '-h' in options or '--help' in options or not urls:
+        sys.stderr.write(USAGE + '\n')
+        return 0 if urls else 2
+    path = options.get('-s', options.get('--socket', DEFAULT_SOCKET))
+    directory = options.get('-d', options.get('--directory', '.'))
+    port = int(options.get('-p', options.get('--port', 80)))
+    failed = 0
+    try:
+        for reply in submit(urls, path, directory, port,
+                            '--no-compression' not in options):
+            if '--json' in options:
+                sys.stdout.write(json.dumps(reply) + '\n')
+            elif 'error' in reply:
+                sys.stderr.write('%s: %s\n' % (reply['url'], reply['error']))
+            else:
+                sys.stdout.write(reply['path'] + '\n')
+            failed += 'error' in reply
+    except socket.error as e:
+        sys.stderr.write('Cannot reach the daemon at %s: %s\n' % (path, e))
+        return 2
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
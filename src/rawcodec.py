@@ -0,0 +1,282 @@
+import socket
+from struct import Struct
+
+from utils import checksum_add, checksum_fold
+
+# Ethernet header, IP header without options and TCP header without
+# options in a row, the whole frame header in one (un)pack
+FRAME_HDR = Struct('!6s6sH' + 'BBHHHBBH4s4s' + 'HHLLBBHHH')
+TCP_HDR = Struct('!HHLLBBHHH')
+CKSUM = Struct('!H')
+# the 16-bit words of an IP header without options and of a pair
+# of IP addresses, small sums are cheaper through struct than array
+IP_HDR_WORDS = Struct('!10H')
+ADDR_WORDS = Struct('!4H')
+ETH_HDR_LEN = 14
+IP_HDR_LEN = 20
+TCP_HDR_LEN = 20
+HDR_LEN = FRAME_HDR.size
+IP_CKSUM_OFFSET = ETH_HDR_LEN + 10
+TCP_OFFSET = ETH_HDR_LEN + IP_HDR_LEN
+TCP_CKSUM_OFFSET = TCP_OFFSET + 16
+ETH_P_IP = 0x0800
+IP_VER_IHL = 0x45
+
+# TCP flags
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+PSH = 0x08
+ACK = 0x10
+URG = 0x20
+
+# TCP options
+TCPOPT_EOL = 0
+TCPOPT_NOP = 1
+TCPOPT_MSS = 2
+TCPOPT_FASTOPEN = 34
+MSS_OPT = Struct('!BBH')
+
+
+def encode_frame(dest_mac, src_mac, ip_src_addr, ip_dest_addr,
+                 tcp_src_port, tcp_dest_port, tcp_seq, tcp_ack_seq,
+                 tcp_flags, tcp_adwind, data='', tcp_opts='',
+                 ip_id=54321, ip_frag_off=0, ip_ttl=255):
+    '''
+    Encode a whole Ethernet/IPv4/TCP frame into a single buffer,
+    with the same defaults as EthFrame, IPDatagram and TCPSegment.
+    The headers are packed in one pass, the payload is copied once
+    and both checksums are computed over the buffer in place.
+    '''
+    opts_len = len(tcp_opts)
+    tcp_len = TCP_HDR_LEN + opts_len + len(data)
+    frame = bytearray(TCP_OFFSET + tcp_len)
+    FRAME_HDR.pack_into(frame, 0,
+                        dest_mac, src_mac, ETH_P_IP,
+                        IP_VER_IHL, 0, IP_HDR_LEN + tcp_len, ip_id,
+                        ip_frag_off, ip_ttl, socket.IPPROTO_TCP, 0,
+                        ip_src_addr, ip_dest_addr,
+                        tcp_src_port, tcp_dest_port, tcp_seq, tcp_ack_seq,
+                        (5 + opts_len / 4) << 4, tcp_flags, tcp_adwind,
+                        0, 0)
+    if opts_len:
+        frame[HDR_LEN:HDR_LEN + opts_len] = tcp_opts
+    if data:
+        frame[HDR_LEN + opts_len:] = data
+    CKSUM.pack_into(frame, IP_CKSUM_OFFSET, checksum_fold(
+        sum(IP_HDR_WORDS.unpack_from(frame, ETH_HDR_LEN))))
+    CKSUM.pack_into(frame, TCP_CKSUM_OFFSET, checksum_fold(
+        checksum_add(buffer(frame, TCP_OFFSET),
+                     pseudo_header_sum(ip_src_addr, ip_dest_addr,
+                                       tcp_len))))
+    return frame
+
+
+def verify_ip_checksum(frame, headers):
+    '''
+    Return True if the IP header checksum of the frame is valid,
+    with the header fields of the given TCPFrame
+    '''
+    if headers.ip_ihl == 5:
+        return checksum_fold(
+            sum(IP_HDR_WORDS.unpack_from(frame, ETH_HDR_LEN))) == 0
+    return checksum_fold(checksum_add(
+        buffer(frame, ETH_HDR_LEN, headers.ip_ihl * 4))) == 0
+
+
+def verify_tcp_checksum(frame, headers):
+    '''
+    Return True if the TCP checksum of the frame is valid,
+    with the header fields of the given TCPFrame
+    '''
+    tcp_offset = ETH_HDR_LEN + headers.ip_ihl * 4
+    tcp_len = headers.data_end - tcp_offset
+    return checksum_fold(checksum_add(
+        buffer(frame, tcp_offset, tcp_len),
+        pseudo_header_sum(headers.ip_src_addr, headers.ip_dest_addr,
+                          tcp_len))) == 0
+
+
+def pseudo_header_sum(ip_src_addr, ip_dest_addr, tcp_len):
+    '''
+    Return the unfolded sum of the TCP pseudo-header
+    '''
+    return sum(ADDR_WORDS.unpack(ip_src_addr + ip_dest_addr)) + \
+        socket.IPPROTO_TCP + tcp_len
+
+
+def mss_option(mss):
+    '''
+    Return the encoded MSS option for a SYN
+    '''
+    return MSS_OPT.pack(TCPOPT_MSS, MSS_OPT.size, mss)
+
+
+def fastopen_option(cookie=''):
+    '''
+    Return the encoded TCP Fast Open option for a SYN or a SYN-ACK,
+    RFC 7413, a cookie request without a cookie, padded with NOPs
+    '''
+    opt = chr(TCPOPT_FASTOPEN) + chr(2 + len(cookie)) + cookie
+    return chr(TCPOPT_NOP) * (-len(opt) % 4) + opt
+
+
+def tcp_option(opts, kind):
+    '''
+    Return the value of the first option of the given kind in the
+    TCP options, or None if there is no such (well-formed) option
+    '''
+    index = 0
+    size = len(opts)
+    while index < size:
+        opt = ord(opts[index])
+        if opt == TCPOPT_EOL:
+            break
+        elif opt == TCPOPT_NOP:
+            index += 1
+            continue
+        if index + 1 >= size:
+            break
+        length = ord(opts[index + 1])
+        if length < 2 or index + length > size:
+            break
+        if opt == kind:
+            return opts[index + 2:index + length]
+        index += length
+    return None
+
+
+def _field(index):
+    return property(lambda self: (self._fields or self._decode())[index])
+
+
+class TCPFrame(object):
+    '''
+    Lightweight read-only view of a received Ethernet/IPv4/TCP frame
+    Only the raw frame is kept, the headers get decoded with a single
+    unpack on the first field access and the payload is sliced out on
+    demand, so that a frame dropped by the filters costs next to
+    nothing, and a segment waiting in the reorder queue gets detached
+    from its frame. The field names follow IPDatagram and TCPSegment.
+    '''
+    __slots__ = ('frame', '_fields')
+
+    def __init__(self, frame):
+        self.frame = frame
+        self._fields = None
+
+    def __repr__(self):
+        repr = ('TCPFrame: ' +
+                '[src_port: %d, dest_port: %d, seq: %d, ack_seq: %d,' +
+                ' flags: 0x%02x, adwind: %d, len(HTTP): %d]') \
+            % (self.tcp_src_port, self.tcp_dest_port, self.tcp_seq,
+               self.tcp_ack_seq, self.tcp_flags, self.tcp_adwind,
+               len(self.data))
+        return repr
+
+    def _decode(self):
+        '''
+        Unpack the raw FRAME_HDR fields, with the TCP ones taken
+        after the IP options if there are
+        '''
+        frame = self.frame
+        if len(frame) < HDR_LEN:
+            raise ValueError('Truncated TCP frame')
+        fields = FRAME_HDR.unpack_from(frame)
+        ihl = fields[3] & 0x0f
+        if ihl != 5:
+            tcp_offset = ETH_HDR_LEN + ihl * 4
+            if ihl < 5 or len(frame) < tcp_offset + TCP_HDR_LEN:
+                raise ValueError('Truncated TCP frame')
+            fields = fields[:13] + TCP_HDR.unpack_from(frame, tcp_offset)
+        self._fields = fields
+        return fields
+
+    def detach(self):
+        '''
+        Return the segment cut off its frame, for the reorder queue
+        '''
+        return QueuedSegment(self.tcp_seq, self.tcp_ack_seq,
+                             self.tcp_flags, self.tcp_adwind, self.data)
+
+    def is_tcp(self):
+        '''
+        Return True if the frame is long enough to hold IPv4 and
+        TCP headers and carries an IPv4 datagram
+        '''
+        try:
+            fields = self._fields or self._decode()
+        except ValueError:
+            return False
+        return fields[2] == ETH_P_IP and fields[3] >> 4 == 4
+
+    def verify_ip_checksum(self):
+        return verify_ip_checksum(self.frame, self)
+
+    def verify_checksum(self):
+        return verify_tcp_checksum(self.frame, self)
+
+    eth_tcode = _field(2)
+    _ver_ihl = _field(3)
+    ip_tlen = _field(5)
+    ip_id = _field(6)
+    ip_frag_off = _field(7)
+    ip_proto = _field(9)
+    ip_src_addr = _field(11)
+    ip_dest_addr = _field(12)
+    tcp_src_port = _field(13)
+    tcp_dest_port = _field(14)
+    tcp_seq = _field(15)
+    tcp_ack_seq = _field(16)
+    _doff_resvd = _field(17)
+    tcp_flags = _field(18)
+    tcp_adwind = _field(19)
+    ip_ver = property(lambda self: self._ver_ihl >> 4)
+    ip_ihl = property(lambda self: self._ver_ihl & 0x0f)
+    tcp_doff = property(lambda self: self._doff_resvd >> 4)
+    tcp_ffin = property(lambda self: self.tcp_flags & FIN)
+    tcp_fsyn = property(lambda self: (self.tcp_flags & SYN) >> 1)
+    tcp_frst = property(lambda self: (self.tcp_flags & RST) >> 2)
+    tcp_fpsh = property(lambda self: (self.tcp_flags & PSH) >> 3)
+    tcp_fack = property(lambda self: (self.tcp_flags & ACK) >> 4)
+    tcp_furg = property(lambda self: (self.tcp_flags & URG) >> 5)
+
+    @property
+    def data_offset(self):
+        return ETH_HDR_LEN + self.ip_ihl * 4 + self.tcp_doff * 4
+
+    @property
+    def data_end(self):
+        return ETH_HDR_LEN + self.ip_tlen
+
+    @property
+    def tcp_opts(self):
+        tcp_offset = ETH_HDR_LEN + self.ip_ihl * 4
+        return self.frame[tcp_offset + TCP_HDR_LEN:self.data_offset]
+
+    @property
+    def data(self):
+        '''
+        The TCP payload without the Ethernet padding
+        '''
+        return self.frame[self.data_offset:self.data_end]
+
+
+class QueuedSegment(object):
+    '''
+    A segment waiting in the reorder queue: its payload and the TCP
+    fields the receive path reads once the gap before it is filled
+    '''
+    __slots__ = ('tcp_seq', 'tcp_ack_seq', 'tcp_flags', 'tcp_adwind',
+                 'data')
+
+    def __init__(self, tcp_seq, tcp_ack_seq, tcp_flags, tcp_adwind, data):
+        self.tcp_seq = tcp_seq
+        self.tcp_ack_seq = tcp_ack_seq
+        self.tcp_flags = tcp_flags
+        self.tcp_adwind = tcp_adwind
+        self.data = data
+
+    tcp_ffin = property(lambda self: self.tcp_flags & FIN)
+    tcp_fsyn = property(lambda self: (self.tcp_flags & SYN) >> 1)
+    tcp_fack = property(lambda self: (self.tcp_flags & ACK) >> 4)
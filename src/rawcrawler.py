@@ -0,0 +1,308 @@
+import os
+import re
+import math
+import struct
+import hashlib
+import threading
+from collections import deque
+from urlparse import urljoin, urldefrag
+
+import HttpClient as C
+import HttpParser as P
+from logger import get_logger
+from rawdns import get_resolver
+
+# the tail of a body kept between two chunks, so that an href
+# tag split across a chunk boundary can still be matched
+MATCH_WINDOW = 4096
+
+
+class BloomFilter:
+    '''
+    A memory-compact seen-set of URLs.
+    The bit array is sized from the expected capacity and the
+    tolerated false positive rate, e.g. 10M URLs at 0.1% only
+    take ~17MB regardless of the URL lengths.
+    '''
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.nbits = int(math.ceil(-capacity * math.log(error_rate)
+                                   / (math.log(2) ** 2)))
+        self.nhashes = max(1, int(round(self.nbits * math.log(2)
+                                        / capacity)))
+        self.bits = bytearray((self.nbits + 7) / 8)
+        self.count = 0
+
+    def __repr__(self):
+        repr = ('BloomFilter: ' +
+                '[capacity: %d, error_rate: %s, bits: %d, hashes: %d,' +
+                ' count: %d]') \
+            % (self.capacity, self.error_rate, self.nbits, self.nhashes,
+               self.count)
+        return repr
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        '''
+        Add the given key, return True if it was not seen before
+        '''
+        added = False
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def _positions(self, key):
+        '''
+        Kirsch-Mitzenmacher double hashing over one md5 digest
+        '''
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.nbits for i in xrange(self.nhashes)]
+
+
+class Frontier:
+    '''
+    The URLs waiting to be crawled, queued per host.
+    A worker keeps popping from the host it fetched last so that
+    the per-host client state gets reused, and only moves on to
+    the next host (round-robin) when that queue runs dry.
+    '''
+    def __init__(self):
+        self.queues = {}
+        self.hosts = deque()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def push(self, host, uri):
+        with self.lock:
+            queue = self.queues.get(host)
+            if queue is None:
+                queue = self.queues[host] = deque()
+                self.hosts.append(host)
+            queue.append(uri)
+            self.size += 1
+
+    def pop(self, prefer_host=None):
+        '''
+        Return the next (host, uri) pair, or None if empty
+        '''
+        with self.lock:
+            if not self.size:
+                return None
+            host = prefer_host
+            if host not in self.queues:
+                host = self.hosts[0]
+                self.hosts.rotate(-1)
+            queue = self.queues[host]
+            uri = queue.popleft()
+            if not queue:
+                del self.queues[host]
+                self.hosts.remove(host)
+            self.size -= 1
+            return host, uri
+
+
+class StreamMatcher:
+    '''
+    Run a regex over a body fed in chunks, only the tail after
+    the last match (at most MATCH_WINDOW bytes) is carried over
+    '''
+    def __init__(self, pattern, window=MATCH_WINDOW):
+        self.pattern = pattern
+        self.window = window
+        self.tail = ''
+
+    def feed(self, chunk):
+        buf = ''.join([self.tail, chunk])
+        matches = []
+        end = 0
+        for matcher in self.pattern.finditer(buf):
+            matches.append(matcher.group(1) if self.pattern.groups
+                           else matcher.group(0))
+            end = matcher.end()
+        self.tail = buf[end:][-self.window:]
+        return matches
+
+
+class Crawler:
+    '''
+    Crawl from the given seed URLs with a pool of worker threads,
+    links get extracted while each body streams in and the target
+    matches are written to the given sink, one per line, unless
+    there is no target regex to look for
+    '''
+    def __init__(self, seeds, target_reg, sink, port=80, iface='eth0',
+                 workers=4, max_pages=None, same_host=True,
+                 capacity=1000000, error_rate=0.001, fetch=None):
+        self.logger = get_logger(os.path.basename(__file__))
+        self.parser = P.HttpParser(target_reg)
+        self.sink = sink
+        self.port = port
+        self.iface = iface
+        self.workers = workers
+        self.max_pages = max_pages
+        self.fetch = fetch or self._fetch
+        # the connections the servers keep alive, shared by the
+        # workers, as many idle per host as there are workers
+        self.pool = C.ConnectionPool(max_idle=workers)
+        self.seen = BloomFilter(capacity, error_rate)
+        self.frontier = Frontier()
+        # the matches written already, bounded like the URLs seen
+        self.matches = BloomFilter(capacity, error_rate)
+        self.allowed_hosts = None
+        self.stats = dict(pages=0, failures=0, links=0, matches=0, bytes=0)
+        # workers busy fetching, the crawl is over once the
+        # frontier is empty and no worker could refill it
+        self.busy = 0
+        self.cond = threading.Condition()
+        self.sink_lock = threading.Lock()
+        for seed in seeds:
+            self._enqueue(seed, seed)
+        if same_host:
+            self.allowed_hosts = set(self.frontier.queues)
+
+    def run(self):
+        '''
+        Crawl until the frontier is exhausted or max_pages has
+        been fetched, return the stats
+        '''
+        # resolve the seed hosts in one round before the workers
+        # start, the later connections hit the shared DNS cache
+        if self.fetch == self._fetch:
+            get_resolver().resolve_many(self.frontier.queues.keys())
+        threads = [threading.Thread(target=self._work,
+                                    name='crawler-%d' % i)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            self.pool.close()
+        self.logger.info('Crawl finished: %s' % self.stats)
+        return self.stats
+
+    def _work(self):
+        host = None
+        clients = {}
+        while True:
+            with self.cond:
+                while True:
+                    if self._exhausted():
+                        self.cond.notify_all()
+                        return
+                    item = self.frontier.pop(host)
+                    if item is not None:
+                        break
+                    if not self.busy:
+                        self.cond.notify_all()
+                        return
+                    self.cond.wait()
+                self.busy += 1
+                self.stats['pages'] += 1
+            host, uri = item
+            try:
+                self._crawl(clients, host, uri)
+            except (ValueError, RuntimeError) as e:
+                self.logger.warn('Failed to crawl http://%s%s: %s'
+                                 % (host, uri, e))
+                with self.cond:
+                    self.stats['failures'] += 1
+            finally:
+                with self.cond:
+                    self.busy -= 1
+                    self.cond.notify_all()
+
+    def _exhausted(self):
+        return self.max_pages is not None and \
+            self.stats['pages'] >= self.max_pages
+
+    def _crawl(self, clients, host, uri):
+        base = 'http://%s%s' % (host, uri)
+        links = StreamMatcher(self.parser.href_ptn)
+        # an empty regex would match at every byte
+        targets = StreamMatcher(self.parser.target_ptn) \
+            if self.parser.target_ptn.pattern else None
+
+        def consume(chunk):
+            for href in links.feed(chunk):
+                self._enqueue(href, base)
+            if targets is not None:
+                self._emit(targets.feed(chunk))
+            with self.cond:
+                self.stats['bytes'] += len(chunk)
+
+        self.logger.debug('Crawling %s' % base)
+        self.fetch(clients, host, uri, consume)
+
+    def _fetch(self, clients, host, uri, consume):
+        '''
+        Fetch the uri with the worker's client for the host and
+        feed the body to consume, over an idle connection to the
+        host if there is one
+        '''
+        client = clients.get(host)
+        if client is None:
+            client = clients[host] = C.HttpClient(host, self.port,
+                                                  self.iface,
+                                                  pool=self.pool)
+        client.retrieve(uri, consume)
+
+    def _enqueue(self, href, base):
+        url = urldefrag(urljoin(base, href.strip()))[0]
+        if not url.startswith('http://'):
+            return
+        host, uri = self.parser.parse_url(url)
+        if not host or (self.allowed_hosts is not None and
+                        host not in self.allowed_hosts):
+            return
+        uri = uri or '/'
+        with self.cond:
+            if not self.seen.add(''.join([host, uri])):
+                return
+            self.stats['links'] += 1
+            self.frontier.push(host, uri)
+            self.cond.notify()
+
+    def _emit(self, matches):
+        matches = [match for match in matches if match]
+        if not matches:
+            return
+        with self.sink_lock:
+            for match in matches:
+                if not self.matches.add(match):
+                    continue
+                self.stats['matches'] += 1
+                self.sink.write('%s\n' % match)
+            self.sink.flush()
+
+
+def crawl(url, target_reg, sink, port=80, iface='eth0', workers=4,
+          max_pages=None):
+    '''
+    Crawl from the given url within its host, writing every
+    target match to sink
+    '''
+    if not re.match(r'^http://[^\s/]+', url):
+        raise ValueError('Invalid url format')
+    crawler = Crawler([url], target_reg, sink, port, iface, workers,
+                      max_pages)
+    return crawler.run()
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import socket
+import threading
+from collections import Counter
+
+from logger import get_logger
+from rawurllib import urlretrieve
+from rawclient import DEFAULT_SOCKET
+from HttpClient import ConnectionPool
+
+# how often the connections idle for too long get closed
+PRUNE_INTERVAL = 5
+BACKLOG = 16
+
+
+class Daemon:
+    '''
+    Download server on a Unix socket for rawclient, so that scripted
+    bulk downloads don't pay the start of rawhttpget for every file.
+    The stack stays warm between the jobs: the gateway MAC and the
+    DNS answers stay cached in the process, and the connections the
+    servers keep alive are reused. A job is a JSON line
+        {"url": URL, "directory": DIR, "port": 80, "compress": true}
+    answered with a JSON line holding the path and the size of the
+    file and the times the job started, its first body byte arrived
+    and it ended, or the error. Each client gets its own thread, its
+    jobs run in order.
+    '''
+    def __init__(self, path=DEFAULT_SOCKET, iface='eth0', port=80,
+                 compress=True, cache=None):
+        self.logger = get_logger(os.path.basename(__file__))
+        self.path = path
+        self.iface = iface
+        self.port = port
+        self.compress = compress
+        self.cache = cache
+        self.pool = ConnectionPool()
+        self.server = None
+        self.stop = threading.Event()
+        self.metrics = Counter(clients=0, jobs=0, failures=0)
+
+    def bind(self):
+        '''
+        Listen on the Unix socket, only the owner may connect, the
+        socket of a dead daemon gets replaced
+        '''
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise RuntimeError('A daemon is already listening on %s'
+                                   % self.path)
+            finally:
+                probe.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(BACKLOG)
+        self.server = server
+        self.logger.info('Listening on %s' % self.path)
+
+    def serve_forever(self):
+        '''
+        Serve the clients until shutdown() gets called
+        '''
+        if self.server is None:
+            self.bind()
+        pruner = threading.Thread(target=self._prune)
+        pruner.daemon = True
+        pruner.start()
+        while not self.stop.is_set():
+            try:
+                conn, addr = self.server.accept()
+            except socket.error:
+                # closed by shutdown()
+                if self.stop.is_set():
+                    break
+                raise
+            self.metrics['clients'] += 1
+            worker = threading.Thread(target=self._serve, args=(conn,))
+            worker.daemon = True
+            worker.start()
+
+    def shutdown(self):
+        self.stop.set()
+        if self.server is not None:
+            self.server.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        self.pool.close()
+
+    def run_job(self, job):
+        '''
+        Download the file of the job, return the reply
+        '''
+        self.metrics['jobs'] += 1
+        reply = dict(url=job.get('url'), start=time.time())
+
+        def reporthook(count, size, total):
+            if count == 1:
+                reply['first_byte'] = time.time()
+        try:
+            if not isinstance(job.get('url'), basestring):
+                raise ValueError('No url in the job')
+            # JSON strings are unicode, the stack sends byte strings, a
+            # non ASCII url fails here as a UnicodeEncodeError
+            path = urlretrieve(str(job['url']), job.get('port', self.port),
+                               str(job.get('directory', '.')), self.iface,
+                               reporthook, job.get('compress', self.compress),
+                               self.cache, self.pool)
+            reply.update(path=path, size=os.path.getsize(path))
+        except (ValueError, RuntimeError, IOError) as e:
+            self.metrics['failures'] += 1
+            self.logger.error('%s: %s' % (job.get('url'), e))
+            reply['error'] = str(e)
+        reply['end'] = time.time()
+        return reply
+
+    def _serve(self, conn):
+        '''
+        Answer the jobs of one client, a line each
+        '''
+        jobs = conn.makefile('rb')
+        try:
+            # readline, iterating the file would wait for more lines
+            for line in iter(jobs.readline, ''):
+                try:
+                    job = json.loads(line)
+                except ValueError:
+                    job = None
+                if isinstance(job, dict):
+                    reply = self.run_job(job)
+                else:
+                    reply = dict(error='Malformed job: %r' % line[:80])
+                conn.sendall(json.dumps(reply) + '\n')
+        except socket.error as e:
+            self.logger.info('Client gone: %s' % e)
+        finally:
+            jobs.close()
+            conn.close()
+
+    def _prune(self):
+        while not self.stop.wait(PRUNE_INTERVAL):
+            self.pool.prune()
@@ -0,0 +1,348 @@
+import os
+import time
+import random
+import socket
+import struct
+import threading
+from select import select
+
+from logger import get_logger
+
+DNS_HDR_FMT = '!HHHHHH'
+DNS_QUESTION_FMT = '!HH'
+DNS_RR_FMT = '!HHLH'
+DNS_PORT = 53
+DNS_TYPE_A = 1
+DNS_TYPE_SOA = 6
+DNS_CLASS_IN = 1
+DNS_RCODE_NOERROR = 0
+DNS_RCODE_NXDOMAIN = 3
+# recursion desired
+DNS_FLAG_RD = 0x0100
+RESOLV_CONF = '/etc/resolv.conf'
+HOSTS = '/etc/hosts'
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    '''
+    Return the resolver shared by every connection in the process
+    '''
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = Resolver()
+        return _resolver
+
+
+class Resolver:
+    '''
+    Caching DNS resolver for IPv4 hosts
+    Answers are cached for their TTL (clamped to [min_ttl, max_ttl]),
+    a host that does not exist or has no A record for the negative
+    TTL of the SOA or negative_ttl, so that a batch of requests to the
+    same host only pays for one lookup. A nameserver failing
+    (SERVFAIL, REFUSED) is not an answer, the next one gets asked, a
+    host none answers for is not cached, an answer to a question
+    other than the one asked is dropped. The queries go out over UDP
+    to the nameservers in /etc/resolv.conf, several hosts can be
+    resolved in one round with resolve_many.
+    '''
+    def __init__(self, nameservers=None, timeout=2, retries=2,
+                 min_ttl=5, max_ttl=3600, negative_ttl=30, hosts=HOSTS,
+                 port=DNS_PORT):
+        self.logger = get_logger(os.path.basename(__file__))
+        if nameservers is None:
+            nameservers = self._read_nameservers()
+        self.nameservers = nameservers
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        # hostname -> (IP address or None, expiry time)
+        self.cache = {}
+        self.static = self._read_hosts(hosts) if hosts else {}
+        self.lock = threading.Lock()
+        self.metrics = dict(hit=0, miss=0, negative=0, failure=0, query=0)
+
+    def add_host(self, hostname, ip):
+        '''
+        Pin the hostname to the given IP address, like /etc/hosts
+        '''
+        self.static[hostname.lower()] = ip
+
+    def resolve(self, hostname):
+        '''
+        Return the IPv4 address of the hostname in dotted form
+        '''
+        ip = self.resolve_many([hostname])[hostname]
+        if ip is None:
+            raise RuntimeError('Cannot resolve host name %s' % hostname)
+        return ip
+
+    def resolve_many(self, hostnames):
+        '''
+        Resolve all the given hostnames with their queries in flight
+        at the same time, return a dict of hostname -> IP address, or
+        None for the hosts that cannot be resolved
+        '''
+        result = {}
+        pending = []
+        now = time.time()
+        with self.lock:
+            for hostname in set(hostnames):
+                ip, hit = self._lookup(hostname, now)
+                if hit:
+                    result[hostname] = ip
+                else:
+                    pending.append(hostname)
+            self.metrics['hit'] += len(result)
+            self.metrics['miss'] += len(pending)
+        if not pending:
+            return result
+        answers = self._query(pending)
+        now = time.time()
+        with self.lock:
+            for hostname in pending:
+                if hostname not in answers:
+                    # timed out or failed, worth asking again
+                    self.metrics['failure'] += 1
+                    result[hostname] = None
+                    continue
+                ip, ttl = answers[hostname]
+                if ip is None:
+                    self.metrics['negative'] += 1
+                    if ttl is None:
+                        ttl = self.negative_ttl
+                ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+                self.cache[hostname.lower()] = (ip, now + ttl)
+                result[hostname] = ip
+        return result
+
+    def _lookup(self, hostname, now):
+        '''
+        Return (ip, True) if the hostname is an IP address, pinned
+        or cached and not expired, otherwise (None, False)
+        '''
+        try:
+            socket.inet_aton(hostname)
+            if hostname.count('.') == 3:
+                return hostname, True
+        except socket.error:
+            pass
+        key = hostname.lower()
+        if key in self.static:
+            return self.static[key], True
+        entry = self.cache.get(key)
+        if entry and entry[1] > now:
+            return entry[0], True
+        self.cache.pop(key, None)
+        return None, False
+
+    def _query(self, hostnames):
+        '''
+        Send one A query per hostname over a single UDP socket and
+        collect the answers, return a dict of hostname -> (ip, ttl)
+        for the hosts answered by the nameservers, (None, negative
+        ttl) for those that do not exist or have no A record
+        '''
+        if not self.nameservers:
+            return self._query_system(hostnames)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            return self._exchange(sock, hostnames)
+        finally:
+            sock.close()
+
+    def _exchange(self, sock, hostnames):
+        answers = {}
+        queries = {}
+        for hostname in hostnames:
+            qid = random.randint(0, 0xffff)
+            while qid in queries:
+                qid = random.randint(0, 0xffff)
+            queries[qid] = hostname
+        for attempt in range(self.retries + 1):
+            nameserver = self.nameservers[attempt % len(self.nameservers)]
+            # the queries this nameserver has yet to answer or fail
+            waiting = set(queries)
+            for qid, hostname in queries.items():
+                self.metrics['query'] += 1
+                sock.sendto(build_query(qid, hostname),
+                            (nameserver, self.port))
+            deadline = time.time() + self.timeout
+            while waiting:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                rsock, _, _ = select([sock], [], [], wait)
+                if not rsock:
+                    break
+                data, addr = sock.recvfrom(4096)
+                try:
+                    qid, qname, rcode, answer = parse_response(data)
+                except (struct.error, ValueError, IndexError):
+                    self.logger.debug('Malformed DNS response from %s'
+                                      % addr[0])
+                    continue
+                if qid not in queries or addr[0] not in self.nameservers:
+                    continue
+                if qname is not None and \
+                        qname != queries[qid].rstrip('.').lower():
+                    self.logger.debug('DNS response from %s for %s, the'
+                                      ' query was for %s'
+                                      % (addr[0], qname, queries[qid]))
+                    continue
+                waiting.discard(qid)
+                if rcode not in (DNS_RCODE_NOERROR, DNS_RCODE_NXDOMAIN):
+                    self.logger.debug('DNS server %s failed to resolve %s,'
+                                      ' rcode %d'
+                                      % (addr[0], queries[qid], rcode))
+                    continue
+                hostname = queries.pop(qid)
+                answers[hostname] = answer
+                self.logger.debug('Resolved %s: %s, ttl %s'
+                                  % ((hostname,) + answer))
+            if not queries:
+                break
+        for hostname in queries.values():
+            self.logger.warn('DNS query for %s timed out or failed'
+                             % hostname)
+        return answers
+
+    def _query_system(self, hostnames):
+        '''
+        Fall back to the blocking system resolver, which does not
+        tell the TTL, when there is no nameserver to query
+        '''
+        answers = {}
+        for hostname in hostnames:
+            self.metrics['query'] += 1
+            try:
+                answers[hostname] = (socket.gethostbyname(hostname),
+                                     self.min_ttl)
+            except socket.error:
+                answers[hostname] = (None, self.negative_ttl)
+        return answers
+
+    def _read_nameservers(self):
+        nameservers = []
+        try:
+            with open(RESOLV_CONF) as resolv_conf:
+                for line in resolv_conf:
+                    fields = line.split()
+                    if len(fields) > 1 and fields[0] == 'nameserver' and \
+                            ':' not in fields[1]:
+                        nameservers.append(fields[1])
+        except IOError:
+            self.logger.warn('Cannot read %s, using the system resolver'
+                             % RESOLV_CONF)
+        return nameservers
+
+    def _read_hosts(self, path):
+        hosts = {}
+        try:
+            with open(path) as hosts_file:
+                for line in hosts_file:
+                    fields = line.split('#', 1)[0].split()
+                    if len(fields) < 2 or ':' in fields[0]:
+                        continue
+                    for hostname in fields[1:]:
+                        hosts.setdefault(hostname.lower(), fields[0])
+        except IOError:
+            pass
+        return hosts
+
+
+def build_query(qid, hostname):
+    '''
+    Pack a recursive query for the A record of the hostname
+    '''
+    header = struct.pack(DNS_HDR_FMT, qid, DNS_FLAG_RD, 1, 0, 0, 0)
+    qname = ''.join('%c%s' % (len(label), label)
+                    for label in hostname.rstrip('.').split('.'))
+    return ''.join([header, qname, '\x00',
+                    struct.pack(DNS_QUESTION_FMT, DNS_TYPE_A,
+                                DNS_CLASS_IN)])
+
+
+def parse_response(data):
+    '''
+    Unpack a DNS response to an A query, return its id, the name in
+    its question, its rcode and (ip, ttl) of the first A record, or
+    (None, negative ttl) if there is no such record, (None, None) if
+    the nameserver failed. The negative ttl is the TTL of the SOA or
+    its MINIMUM field, whichever is lower (RFC 2308).
+    '''
+    offset = struct.calcsize(DNS_HDR_FMT)
+    qid, flags, qdcount, ancount, nscount, arcount = \
+        struct.unpack(DNS_HDR_FMT, data[:offset])
+    if not flags & 0x8000:
+        raise ValueError('Not a DNS response')
+    rcode = flags & 0x000f
+    qname = None
+    if qdcount == 1:
+        qname, offset = _read_name(data, offset)
+        qtype, qclass = struct.unpack(
+            DNS_QUESTION_FMT,
+            data[offset:offset + struct.calcsize(DNS_QUESTION_FMT)])
+        if qtype != DNS_TYPE_A or qclass != DNS_CLASS_IN:
+            raise ValueError('Not a response to an A query')
+        offset += struct.calcsize(DNS_QUESTION_FMT)
+    elif qdcount or rcode in (DNS_RCODE_NOERROR, DNS_RCODE_NXDOMAIN):
+        # only a failure may leave the question out
+        raise ValueError('DNS response without its question')
+    if rcode not in (DNS_RCODE_NOERROR, DNS_RCODE_NXDOMAIN):
+        return qid, qname, rcode, (None, None)
+    negative_ttl = None
+    for i in range(ancount + nscount):
+        offset = _skip_name(data, offset)
+        rtype, rclass, ttl, rdlen = struct.unpack(
+            DNS_RR_FMT, data[offset:offset + struct.calcsize(DNS_RR_FMT)])
+        offset += struct.calcsize(DNS_RR_FMT)
+        if rtype == DNS_TYPE_A and rclass == DNS_CLASS_IN and rdlen == 4:
+            return qid, qname, rcode, (
+                socket.inet_ntoa(data[offset:offset + 4]), ttl)
+        elif rtype == DNS_TYPE_SOA:
+            # MNAME and RNAME, then serial, refresh, retry, expire and
+            # minimum, the last 4 bytes
+            if rdlen < 22:
+                raise ValueError('Malformed SOA record')
+            minimum = struct.unpack(
+                '!L', data[offset + rdlen - 4:offset + rdlen])[0]
+            negative_ttl = min(ttl, minimum)
+        offset += rdlen
+    return qid, qname, rcode, (None, negative_ttl)
+
+
+def _read_name(data, offset):
+    '''
+    Return the uncompressed name at offset in lower case and the
+    offset right after it
+    '''
+    labels = []
+    while True:
+        length = ord(data[offset])
+        if length == 0:
+            return '.'.join(labels).lower(), offset + 1
+        elif length & 0xc0:
+            raise ValueError('Compressed name in the question')
+        labels.append(data[offset + 1:offset + 1 + length])
+        offset += length + 1
+
+
+def _skip_name(data, offset):
+    '''
+    Return the offset right after the (compressed) name at offset
+    '''
+    while True:
+        length = ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        elif length == 0:
+            return offset + 1
+        offset += length + 1
@@ -1,10 +1,21 @@
 #!/usr/bin/env python
 import argparse
 import os
+import sys
+import signal
+from urlparse import urlparse
 
 from logger import init_logger, get_logger
 from utils import Timer
 from rawurllib import urlretrieve
+from rawdns import get_resolver
+from rawlink import set_link_factory, recording_factory, Replay, ReplayLink
+from rawmetrics import get_registry, JSONL, PROMETHEUS
+from rawclient import DEFAULT_SOCKET
+import rawtrace
+import rawtfo
+# the crawler, the cache, the daemon and the profilers get imported
+# when asked for, a plain download doesn't pay for them at startup
 
 
 def parse_arguments():
@@ -12,7 +23,7 @@ def parse_arguments():
     Set up the arg parser and parse the command line
     '''
     parser = argparse.ArgumentParser()
-    parser.add_argument('url', type=str,
+    parser.add_argument('url', type=str, nargs='?',
                         help='The url the raw sockets will fetch')
     parser.add_argument('-p', '--port', type=int,
                         default=80,
@@ -31,7 +42,215 @@ def parse_arguments():
                         help='The name of the log file. If specified,'
                         + ' program output will be logged into the file'
                         + ' instead of outputed to stdout')
-    return parser.parse_args()
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Do not ask the server for a gzip or deflate'
+                        + ' encoded response')
+    parser.add_argument('--cache', type=str, action='store',
+                        help='The directory of the HTTP cache, the file'
+                        + ' is revalidated or resumed from it if cached')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='The size in MB the cache is trimmed to,'
+                        + ' least recently used files first')
+    parser.add_argument('-c', '--crawl', action='store_true',
+                        help='Crawl the pages reachable from the url'
+                        + ' within its host instead of downloading it')
+    parser.add_argument('-t', '--target', type=str, action='store',
+                        default='',
+                        help='The regex of the targets to collect while'
+                        + ' crawling, its first group if it has any,'
+                        + ' none are collected without it')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='The number of concurrent crawler workers')
+    parser.add_argument('-n', '--max-pages', type=int,
+                        help='Stop crawling after fetching this many pages')
+    parser.add_argument('-o', '--output', type=str, action='store',
+                        help='The file the crawled targets are written'
+                        + ' to, stdout by default')
+    parser.add_argument('--metrics', type=str, action='store',
+                        help='Export the connection metrics to this file,'
+                        + ' periodically while crawling')
+    parser.add_argument('--metrics-format', choices=(JSONL, PROMETHEUS),
+                        default=JSONL,
+                        help='JSON lines appended per connection and host,'
+                        + ' or a Prometheus text file of the host rollups')
+    parser.add_argument('--metrics-interval', type=int, default=10,
+                        help='The seconds between two exports while'
+                        + ' crawling')
+    parser.add_argument('--trace', type=str, action='store',
+                        help='Keep a ring of the last packets of every'
+                        + ' connection and dump it to this file on failure,'
+                        + ' as pcap-ng if it ends with .pcapng, else text')
+    parser.add_argument('--trace-size', type=int, default=rawtrace.TRACE_SIZE,
+                        help='The number of packets kept per connection')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time spent per stage of the stack:'
+                        + ' decode, checksum, filter, ACK, file write...')
+    parser.add_argument('--profile-out', type=str, action='store',
+                        help='Also write the profile to this file, folded'
+                        + ' stacks for flamegraph.pl if it ends with'
+                        + ' .folded, else cProfile stats')
+    parser.add_argument('--fastopen', type=str, action='store',
+                        help='Use TCP Fast Open, the request goes in the'
+                        + ' SYN once the server has given a cookie, the'
+                        + ' cookies are kept in this file')
+    parser.add_argument('--daemon', type=str, nargs='?',
+                        const=DEFAULT_SOCKET,
+                        help='Stay up and take download jobs from rawclient'
+                        + ' over this Unix socket, %s by default'
+                        % DEFAULT_SOCKET)
+    link = parser.add_mutually_exclusive_group()
+    link.add_argument('--record', type=str, action='store',
+                      help='Record every frame sent and received to this'
+                      + ' pcap-ng file')
+    link.add_argument('--replay', type=str, action='store',
+                      help='Replay a recorded pcap file offline in place'
+                      + ' of the network interface')
+    args = parser.parse_args()
+    if not args.url and not args.daemon:
+        parser.error('the url is required')
+    return args
+
+
+def setup_link(args, logger):
+    '''
+    Plug the recording or the replaying link in if asked to
+    '''
+    if args.record:
+        logger.info('Recording frames to: %s' % args.record)
+        set_link_factory(recording_factory(args.record))
+    elif args.replay:
+        logger.info('Replaying frames from: %s' % args.replay)
+        replay = Replay(args.replay)
+        # the recording knows where the host was, no DNS offline
+        server_ip = replay.server_ip()
+        if server_ip and args.url:
+            get_resolver().add_host(urlparse(args.url).hostname, server_ip)
+        set_link_factory(lambda iface: ReplayLink(replay))
+
+
+def export_metrics(args, logger):
+    '''
+    Write the collected metrics out if asked to
+    '''
+    if not args.metrics:
+        return
+    registry = get_registry()
+    registry.stop_exporter()
+    try:
+        registry.export(args.metrics, args.metrics_format)
+    except IOError as e:
+        logger.error('Cannot export metrics: %s' % e)
+        return
+    logger.info('Metrics exported to: %s' % args.metrics)
+
+
+def dump_trace(args, logger):
+    '''
+    Dump the packet traces of the last connections if asked to
+    '''
+    if not args.trace:
+        return
+    try:
+        if args.trace.endswith('.pcapng'):
+            rawtrace.dump_pcap(args.trace)
+        else:
+            with open(args.trace, 'w') as f:
+                rawtrace.dump_text(f)
+    except IOError as e:
+        logger.error('Cannot dump the packet trace: %s' % e)
+        return
+    logger.info('Packet trace dumped to: %s' % args.trace)
+
+
+def start_profile(args):
+    '''
+    Instrument the stack if asked to, return the cProfile profiler
+    if its stats are to be written
+    '''
+    if not args.profile and not args.profile_out:
+        return None
+    import rawprofile
+    rawprofile.enable()
+    if args.profile_out and not args.profile_out.endswith('.folded'):
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    return None
+
+
+def report_profile(args, logger, profile, nbytes):
+    '''
+    Print the breakdown per stage and write the profile out
+    '''
+    if not args.profile and not args.profile_out:
+        return
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile_out)
+    import rawprofile
+    profiler = rawprofile.enable()
+    if args.profile_out and not profile:
+        profiler.write_folded(args.profile_out)
+    if args.profile_out:
+        logger.info('Profile written to: %s' % args.profile_out)
+    sys.stderr.write(profiler.report(nbytes) + '\n')
+
+
+def run_crawler(args, logger):
+    '''
+    Crawl from the url and collect the target matches
+    '''
+    from rawcrawler import crawl
+    logger.info('Crawling from: %s' % args.url)
+    sink = open(args.output, 'w') if args.output else sys.stdout
+    if args.metrics:
+        get_registry().start_exporter(args.metrics, args.metrics_format,
+                                      args.metrics_interval)
+    profile = start_profile(args)
+    with Timer() as t:
+        try:
+            stats = crawl(args.url, args.target, sink, args.port,
+                          args.interface, args.workers, args.max_pages)
+        except (ValueError, RuntimeError) as e:
+            logger.error('%s, quit' % e.message)
+            dump_trace(args, logger)
+            exit(1)
+        finally:
+            if args.output:
+                sink.close()
+            export_metrics(args, logger)
+    if stats['failures']:
+        dump_trace(args, logger)
+    report_profile(args, logger, profile, stats['bytes'])
+    logger.info('Crawled %d pages, found %d targets'
+                % (stats['pages'], stats['matches']))
+    logger.info('Time taken: %ss' % t.duration)
+
+
+def run_daemon(args, logger, cache):
+    '''
+    Serve the download jobs of rawclient until interrupted
+    '''
+    from rawdaemon import Daemon
+    daemon = Daemon(args.daemon, args.interface, args.port,
+                    not args.no_compression, cache)
+    if args.metrics:
+        get_registry().start_exporter(args.metrics, args.metrics_format,
+                                      args.metrics_interval)
+    # the accept gets interrupted and the loop ends
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop.set())
+    try:
+        daemon.serve_forever()
+    except (RuntimeError, IOError, OSError) as e:
+        logger.error('%s, quit' % e)
+        exit(1)
+    except KeyboardInterrupt:
+        logger.info('Interrupted, %d jobs served, %d failed'
+                    % (daemon.metrics['jobs'], daemon.metrics['failures']))
+    finally:
+        daemon.shutdown()
+        export_metrics(args, logger)
 
 
 def main():
@@ -43,16 +262,50 @@ def main():
     logger = get_logger(os.path.basename(__file__))
     logger.info('Running the rawhttpget script in verbosity level: %d'
                 % args.verbosity)
+    try:
+        setup_link(args, logger)
+    except (ValueError, IOError) as e:
+        logger.error('%s, quit' % e)
+        exit(1)
+    if args.metrics:
+        get_registry().enable()
+    if args.trace:
+        rawtrace.enable(args.trace_size)
+    tfo = rawtfo.enable(args.fastopen) if args.fastopen else None
+
+    cache = None
+    if args.cache:
+        from HttpCache import HttpCache
+        cache = HttpCache(args.cache, args.cache_size << 20)
+
+    if args.daemon:
+        run_daemon(args, logger, cache)
+        return
+    if args.crawl:
+        run_crawler(args, logger)
+        return
 
     # download the file with the given url
     logger.info('Downloading file at: %s' % args.url)
+    profile = start_profile(args)
     with Timer() as t:
         try:
-            filepath = urlretrieve(args.url, args.port, args.directory)
+            filepath = urlretrieve(args.url, args.port, args.directory,
+                                   args.interface,
+                                   compress=not args.no_compression,
+                                   cache=cache)
         except (ValueError, RuntimeError) as e:
             logger.error('%s, quit' % e.message)
+            dump_trace(args, logger)
             exit(1)
+        finally:
+            export_metrics(args, logger)
     logger.info('File is downloaded to: %s' % filepath)
+    report_profile(args, logger, profile, os.path.getsize(filepath))
+    if cache:
+        logger.info('Cache metrics:\n%s' % cache.dump_metrics()[0])
+    if tfo:
+        logger.info('Fast Open metrics:\n%s' % tfo.dump_metrics()[0])
     logger.info('Time taken: %ss' % t.duration)
 
 
@@ -1,16 +1,29 @@
+import time
 import socket
-from ctypes import create_string_buffer
-from struct import pack_into, unpack, calcsize
+from struct import pack_into, unpack, unpack_from, calcsize
+from collections import OrderedDict, Counter
 
 from utils import checksum
 
 IP_HDR_FMT = '!BBHHHBBH4s4s'
+# flags and fragment offset
+IP_DF = 0x4000
+IP_MF = 0x2000
+IP_OFFMASK = 0x1fff
+IP_MAX_LEN = 0xffff
+# RFC 791 recommends 15 seconds, Linux waits 30
+FRAG_TIMEOUT = 30
+FRAG_MAX_BYTES = 4 << 20
 
 
-class IPDatagram:
+class IPDatagram(object):
     '''
     Simple Python model for an IP datagram
     '''
+    __slots__ = ('ip_ver', 'ip_ihl', 'ip_tos', 'ip_tlen', 'ip_id',
+                 'ip_frag_off', 'ip_ttl', 'ip_proto', 'ip_hdr_cksum',
+                 'ip_src_addr', 'ip_dest_addr', 'ip_opts', 'data')
+
     def __init__(self, ip_src_addr, ip_dest_addr, ip_ver=4,
                  ip_ihl=5, ip_tos=0, ip_id=54321, ip_frag_off=0,
                  ip_ttl=255, ip_proto=socket.IPPROTO_TCP,
@@ -55,7 +68,7 @@ class IPDatagram:
         header checksum could use the same checksum algorithm,
         and then simply check if the result is 0.
         '''
-        ip_hdr_buf = create_string_buffer(calcsize(IP_HDR_FMT))
+        ip_hdr_buf = bytearray(calcsize(IP_HDR_FMT))
         ip_ver_ihl = (self.ip_ver << 4) + self.ip_ihl
         pack_into(IP_HDR_FMT, ip_hdr_buf, 0,
                   ip_ver_ihl, self.ip_tos, self.ip_tlen,
@@ -63,10 +76,10 @@ class IPDatagram:
                   self.ip_ttl, self.ip_proto,
                   self.ip_hdr_cksum,
                   self.ip_src_addr, self.ip_dest_addr)
-        self.ip_hdr_cksum = checksum(ip_hdr_buf.raw)
+        self.ip_hdr_cksum = checksum(str(ip_hdr_buf))
         pack_into('!H', ip_hdr_buf, calcsize(IP_HDR_FMT[:8]),
                   self.ip_hdr_cksum)
-        ip_datagram = ''.join([ip_hdr_buf.raw, self.data])
+        ip_datagram = ''.join([str(ip_hdr_buf), self.data])
         return ip_datagram
 
     def unpack(self, ip_datagram):
@@ -109,3 +122,137 @@ class IPDatagram:
         the return value is unpredictable.
         '''
         return self.ip_hdr_cksum == 0x0000
+
+
+class Reassembler:
+    '''
+    IPv4 fragment reassembly with bounded memory
+    Fragments are kept in buckets per (src, dst, id, proto), each with
+    the list of holes still missing (RFC 815). A bucket is dropped when
+    it is not complete within the timeout, and the oldest buckets get
+    evicted whenever the fragments held exceed max_bytes in total.
+    '''
+    def __init__(self, timeout=FRAG_TIMEOUT, max_bytes=FRAG_MAX_BYTES):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        # key -> _FragmentBucket, the oldest first
+        self.buckets = OrderedDict()
+        self.size = 0
+        self.metrics = Counter(fragment=0, reassembled=0, timeout=0,
+                               evict=0, malformed=0)
+
+    def reassemble(self, ip_datagram, now=None):
+        '''
+        Take the given IP datagram string, return it untouched if it
+        is not a fragment, the whole datagram if it was the missing
+        fragment, or None while fragments are still missing
+        '''
+        ver_ihl, _, tlen, ip_id, frag_off, _, proto, _, src, dest = \
+            unpack_from(IP_HDR_FMT, ip_datagram)
+        if not frag_off & (IP_MF | IP_OFFMASK):
+            return ip_datagram
+        self.metrics['fragment'] += 1
+        now = time.time() if now is None else now
+        self._expire(now)
+        ihl = (ver_ihl & 0x0f) * 4
+        offset = (frag_off & IP_OFFMASK) * 8
+        data = ip_datagram[ihl:tlen]
+        more = frag_off & IP_MF
+        key = (src, dest, ip_id, proto)
+        # but the last one, fragments carry multiples of 8 bytes
+        if (more and len(data) % 8) or not data or \
+                ihl + offset + len(data) > IP_MAX_LEN:
+            self.metrics['malformed'] += 1
+            self._drop(key)
+            return None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = _FragmentBucket(now + self.timeout)
+        if offset == 0:
+            bucket.header = ip_datagram[:ihl]
+        self.size += bucket.add(offset, data, more)
+        if bucket.complete():
+            self._drop(key)
+            self.metrics['reassembled'] += 1
+            return bucket.datagram()
+        while self.size > self.max_bytes and self.buckets:
+            self.metrics['evict'] += 1
+            self._drop(next(iter(self.buckets)))
+        return None
+
+    def _expire(self, now):
+        for key, bucket in self.buckets.items():
+            if bucket.expiry > now:
+                break
+            self.metrics['timeout'] += 1
+            self._drop(key)
+
+    def _drop(self, key):
+        bucket = self.buckets.pop(key, None)
+        if bucket is not None:
+            self.size -= bucket.size
+
+
+class _FragmentBucket:
+    '''
+    The fragments of one datagram and the holes between them
+    '''
+    def __init__(self, expiry):
+        self.expiry = expiry
+        self.header = None
+        self.fragments = []
+        self.size = 0
+        self.total = None
+        # (first, last) byte offsets still missing, inclusive
+        self.holes = [(0, IP_MAX_LEN)]
+
+    def add(self, offset, data, more):
+        '''
+        Fill the holes with the fragment, return the bytes it added
+        Only the parts falling in holes are kept, the bytes already
+        there win over duplicates and overlaps.
+        '''
+        first, last = offset, offset + len(data) - 1
+        if not more:
+            self.total = last + 1
+        holes = []
+        added = 0
+        for hole_first, hole_last in self.holes:
+            if first > hole_last or last < hole_first:
+                holes.append((hole_first, hole_last))
+                continue
+            start, end = max(first, hole_first), min(last, hole_last)
+            self.fragments.append((start,
+                                   data[start - offset:end - offset + 1]))
+            added += end - start + 1
+            if first > hole_first:
+                holes.append((hole_first, first - 1))
+            if last < hole_last and more:
+                holes.append((last + 1, hole_last))
+        if self.total is not None:
+            holes = [h for h in holes if h[0] < self.total]
+        self.holes = holes
+        self.size += added
+        return added
+
+    def complete(self):
+        return not self.holes and self.total is not None and \
+            self.header is not None
+
+    def datagram(self):
+        '''
+        Rebuild the whole datagram behind the header of the first
+        fragment, with the length, the offset and the checksum fixed
+        '''
+        data = bytearray(self.total)
+        for offset, fragment in self.fragments:
+            if offset < self.total:
+                data[offset:offset + len(fragment)] = \
+                    fragment[:self.total - offset]
+        header = bytearray(self.header)
+        frag_off = unpack_from('!H', header, 6)[0]
+        pack_into('!HHH', header, 2, len(header) + self.total,
+                  unpack_from('!H', header, 4)[0], frag_off & IP_DF)
+        pack_into('!H', header, 10, 0)
+        pack_into('!H', header, 10, checksum(str(header)))
+        return str(header + data)
@@ -0,0 +1,465 @@
+import os
+import time
+import fcntl
+import threading
+import socket as s
+import struct
+
+from logger import get_logger
+from rawpcap import PcapWriter, read_pcap, INBOUND, OUTBOUND
+from rawcodec import tcp_option, TCPOPT_MSS
+
+SOL_PACKET = 263
+PACKET_AUXDATA = 8
+# tp_status bits of struct tpacket_auxdata
+TP_STATUS_CSUMNOTREADY = 1 << 3
+TP_STATUS_CSUM_VALID = 1 << 7
+# room for one cmsghdr carrying a struct tpacket_auxdata
+CONTROL_LEN = 64
+SIZE_T = struct.calcsize('P')
+CMSG_HDR = struct.Struct('@' + ('Q' if SIZE_T == 8 else 'I') + 'ii')
+TP_STATUS = struct.Struct('@I')
+SIOCGIFADDR = 0x8915
+SIOCGIFHWADDR = 0x8927
+SIOCGIFMTU = 0x8921
+DEFAULT_MTU = 1500
+# comment on a recorded frame whose checksum the kernel reported valid
+CSUM_VALID = 'csum_valid'
+ETH_P_ARP = '\x08\x06'
+ETH_P_IP = '\x08\x00'
+TCP_SYN_ACK = 0x12
+TCP_SYN = 0x02
+
+
+# how long the gateway of an interface is trusted without reading
+# /proc/net/route again
+ROUTE_TTL = 60
+
+# ctypes, the structures of recvmsg and recvmsg itself, loaded by
+# the first PacketLink so that the other links don't pay for them
+ctypes = None
+_IOVec = None
+_MsgHdr = None
+_recvmsg = None
+_ctypes_lock = threading.Lock()
+_link_factory = None
+_link_factory_lock = threading.Lock()
+# iface -> (gateway IP, expiry time)
+_gateways = {}
+
+
+def _load_recvmsg():
+    '''
+    Import ctypes and look recvmsg up in libc, once
+    '''
+    global ctypes, _IOVec, _MsgHdr, _recvmsg
+    with _ctypes_lock:
+        if ctypes is not None:
+            return _recvmsg
+        import ctypes as c
+        from ctypes.util import find_library
+
+        class IOVec(c.Structure):
+            _fields_ = [('iov_base', c.c_void_p),
+                        ('iov_len', c.c_size_t)]
+
+        class MsgHdr(c.Structure):
+            _fields_ = [('msg_name', c.c_void_p),
+                        ('msg_namelen', c.c_uint32),
+                        ('msg_iov', c.POINTER(IOVec)),
+                        ('msg_iovlen', c.c_size_t),
+                        ('msg_control', c.c_void_p),
+                        ('msg_controllen', c.c_size_t),
+                        ('msg_flags', c.c_int)]
+        try:
+            libc = c.CDLL(find_library('c'), use_errno=True)
+            recvmsg = libc.recvmsg
+            recvmsg.argtypes = [c.c_int, c.POINTER(MsgHdr), c.c_int]
+            recvmsg.restype = c.c_ssize_t
+        except (OSError, AttributeError):
+            recvmsg = None
+        _IOVec, _MsgHdr, _recvmsg = IOVec, MsgHdr, recvmsg
+        ctypes = c
+        return _recvmsg
+
+
+def open_link(iface):
+    '''
+    Open the link every new RawSocket runs on, the AF_PACKET socket
+    bound to iface unless another factory has been set
+    '''
+    with _link_factory_lock:
+        factory = _link_factory or PacketLink
+    return factory(iface)
+
+
+def set_link_factory(factory):
+    '''
+    Make open_link call factory(iface) from now on, None restores
+    the AF_PACKET link
+    '''
+    global _link_factory
+    with _link_factory_lock:
+        _link_factory = factory
+
+
+class PacketLink:
+    '''
+    AF_PACKET socket bound to a network interface
+    With PACKET_AUXDATA enabled every frame comes with the tp_status
+    the kernel reports for it, csum_valid tells whether the checksum
+    of the last received frame is already known to be good, so that
+    the software verification can be skipped. Without ancillary data
+    (no recvmsg in libc, or an old kernel) csum_valid stays False.
+    '''
+    def __init__(self, iface, bufsize=65536):
+        self.logger = get_logger(os.path.basename(__file__))
+        self.iface = iface
+        self.socket = s.socket(s.AF_PACKET, s.SOCK_RAW)
+        self.socket.bind((iface, s.SOCK_RAW))
+        self.csum_valid = False
+        self.auxdata = False
+        if _load_recvmsg() is not None:
+            try:
+                self.socket.setsockopt(SOL_PACKET, PACKET_AUXDATA, 1)
+                self.auxdata = True
+            except s.error, e:
+                self.logger.info('PACKET_AUXDATA not supported: %s' % e)
+        self._resize(bufsize)
+        self._control = ctypes.create_string_buffer(CONTROL_LEN)
+        self._msg = _MsgHdr()
+        self._msg.msg_iov = ctypes.pointer(self._iov)
+        self._msg.msg_iovlen = 1
+        self._msg.msg_control = ctypes.addressof(self._control)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def get_local_ip(self):
+        '''
+        Get the IP address of the local interface
+        NOTE: IP address already encoded
+        '''
+        try:
+            ip = fcntl.ioctl(self.socket.fileno(), SIOCGIFADDR,
+                             struct.pack('256s', self.iface[:15]))[20:24]
+            return ip
+        except IOError:
+            raise RuntimeError('Cannot get IP address of local interface %s'
+                               % self.iface)
+
+    def get_local_mac(self):
+        '''
+        Get the mac address of the local interface
+        NOTE: MAC address already encoded
+        '''
+        try:
+            mac = fcntl.ioctl(self.socket.fileno(), SIOCGIFHWADDR,
+                              struct.pack('256s', self.iface[:15]))[18:24]
+            return mac
+        except IOError:
+            raise RuntimeError('Cannot get mac address of local interface %s'
+                               % self.iface)
+
+    def get_mtu(self):
+        '''
+        Get the MTU of the local interface, jumbo frames included
+        '''
+        try:
+            ifreq = fcntl.ioctl(self.socket.fileno(), SIOCGIFMTU,
+                                struct.pack('256s', self.iface[:15]))
+            return struct.unpack('@i', ifreq[16:20])[0]
+        except IOError:
+            self.logger.warn('Cannot get MTU of local interface %s, '
+                             'assuming %d' % (self.iface, DEFAULT_MTU))
+            return DEFAULT_MTU
+
+    def get_gateway_ip(self):
+        '''
+        Look up the gateway IP address from /proc/net/route, the
+        answer is kept for ROUTE_TTL seconds
+        '''
+        gateway, expiry = _gateways.get(self.iface, (None, 0))
+        if time.time() < expiry:
+            return gateway
+        with open('/proc/net/route') as route_info:
+            for line in route_info:
+                fields = line.strip().split()
+                if fields[0] == self.iface and fields[1] == '00000000':
+                    gateway = struct.pack('<L', int(fields[2], 16))
+                    _gateways[self.iface] = (gateway,
+                                             time.time() + ROUTE_TTL)
+                    return gateway
+            else:
+                raise RuntimeError('Cannot find the default gateway Ip ' +
+                                   'address in /proc/net/route, please ' +
+                                   'pass the correct network interface name')
+
+    def tcp_hints(self):
+        '''
+        Return the (source port, ISN) the next connection has to use,
+        None to pick them at random
+        '''
+        return None
+
+    def send(self, data):
+        return self.socket.send(data)
+
+    def recv(self, bufsize):
+        '''
+        Receive one frame of at most bufsize bytes and record the
+        checksum status the kernel attached to it
+        '''
+        if not self.auxdata:
+            return self.socket.recv(bufsize)
+        if bufsize > self._bufsize:
+            self._resize(bufsize)
+        msg = self._msg
+        self._iov.iov_len = bufsize
+        msg.msg_controllen = CONTROL_LEN
+        msg.msg_flags = 0
+        size = _recvmsg(self.socket.fileno(), ctypes.byref(msg), 0)
+        if size < 0:
+            err = ctypes.get_errno()
+            raise s.error(err, os.strerror(err))
+        self.csum_valid = self._csum_valid(msg.msg_controllen)
+        return ctypes.string_at(self._buffer, size)
+
+    def close(self):
+        self.socket.close()
+
+    def _resize(self, bufsize):
+        self._bufsize = bufsize
+        self._buffer = ctypes.create_string_buffer(bufsize)
+        if not hasattr(self, '_iov'):
+            self._iov = _IOVec()
+        self._iov.iov_base = ctypes.addressof(self._buffer)
+
+    def _csum_valid(self, controllen):
+        '''
+        Look for the PACKET_AUXDATA control message and check its
+        tp_status, a partial checksum on a frame the local host sent
+        (e.g. over veth or loopback) is as good as a verified one
+        '''
+        control = self._control.raw[:controllen]
+        offset = 0
+        while offset + CMSG_HDR.size <= controllen:
+            cmsg_len, level, type = CMSG_HDR.unpack_from(control, offset)
+            if cmsg_len < CMSG_HDR.size:
+                break
+            if level == SOL_PACKET and type == PACKET_AUXDATA:
+                status = TP_STATUS.unpack_from(control,
+                                               offset + CMSG_HDR.size)[0]
+                return bool(status & (TP_STATUS_CSUM_VALID |
+                                      TP_STATUS_CSUMNOTREADY))
+            # CMSG_NXTHDR, lengths are aligned to size_t
+            offset += (cmsg_len + SIZE_T - 1) & ~(SIZE_T - 1)
+        return False
+
+
+class RecordingLink:
+    '''
+    Link recording every frame sent and received through it to a
+    pcap-ng file, the identity queries go to the wrapped link
+    '''
+    def __init__(self, link, recording):
+        self.link = link
+        self.recording = recording
+        self.writer = recording.open()
+
+    def __getattr__(self, name):
+        return getattr(self.link, name)
+
+    def send(self, data):
+        self.writer.write(data, OUTBOUND)
+        return self.link.send(data)
+
+    def recv(self, bufsize):
+        data = self.link.recv(bufsize)
+        self.writer.write(data, INBOUND,
+                          CSUM_VALID if self.link.csum_valid else None)
+        return data
+
+    def close(self):
+        try:
+            self.link.close()
+        finally:
+            self.recording.release()
+
+
+class _Recording:
+    '''
+    The pcap-ng file shared by the RecordingLinks of one factory,
+    closed along with the last link open, a later link appends
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.links = 0
+        self.started = False
+        self.lock = threading.Lock()
+
+    def open(self):
+        with self.lock:
+            if self.writer is None:
+                self.writer = PcapWriter(self.path, append=self.started)
+                self.started = True
+            self.links += 1
+            return self.writer
+
+    def release(self):
+        with self.lock:
+            self.links -= 1
+            if not self.links:
+                self.writer.close()
+                self.writer = None
+
+
+def recording_factory(path, factory=PacketLink):
+    '''
+    Return a link factory recording all the links it opens into
+    the single pcap-ng file at path
+    '''
+    recording = _Recording(path)
+    return lambda iface: RecordingLink(factory(iface), recording)
+
+
+class Replay:
+    '''
+    The frames of a recorded session, shared by the ReplayLinks
+    that play it back one connection after the other
+    The local identity (MAC, IP, gateway) is taken from what was
+    sent, the MTU from the MSS option of our first SYN. A classic
+    pcap does not tell the direction, frames from the MAC of the
+    first one are then taken as sent.
+    '''
+    def __init__(self, path):
+        self.records = []
+        self.cursor = 0
+        self.lock = threading.Lock()
+        local_mac = None
+        for ts, frame, direction, comment in read_pcap(path):
+            if local_mac is None:
+                local_mac = frame[6:12]
+            if direction is None:
+                direction = OUTBOUND if frame[6:12] == local_mac \
+                    else INBOUND
+            self.records.append((frame, direction, comment == CSUM_VALID))
+        self.local_mac = local_mac
+        self.local_ip = None
+        self.gateway_ip = None
+        self.mtu = DEFAULT_MTU
+        sent = [frame for frame, direction, _ in self.records
+                if direction == OUTBOUND]
+        for frame in sent:
+            if frame[12:14] == ETH_P_ARP and len(frame) >= 42:
+                # ARP request for the gateway
+                self.local_ip = self.local_ip or frame[28:32]
+                self.gateway_ip = self.gateway_ip or frame[38:42]
+            elif frame[12:14] == ETH_P_IP and self.local_ip is None:
+                self.local_ip = frame[26:30]
+        for frame in sent:
+            if self._syn(frame) is not None:
+                tcp = 14 + (ord(frame[14]) & 0x0f) * 4
+                mss = tcp_option(
+                    frame[tcp + 20:tcp + (ord(frame[tcp + 12]) >> 4) * 4],
+                    TCPOPT_MSS)
+                if mss and len(mss) == 2:
+                    self.mtu = struct.unpack('!H', mss)[0] + 40
+                break
+
+    def server_ip(self):
+        '''
+        Return the dotted IP address of the first server connected
+        '''
+        for frame, direction, _ in self.records:
+            if direction == OUTBOUND and self._syn(frame):
+                return s.inet_ntoa(frame[30:34])
+        return None
+
+    def next_syn(self):
+        '''
+        Return (source port, ISN) of the next SYN to be sent
+        '''
+        with self.lock:
+            for frame, direction, _ in self.records[self.cursor:]:
+                if direction == OUTBOUND:
+                    syn = self._syn(frame)
+                    if syn is not None:
+                        return syn
+        return None
+
+    def next_inbound(self):
+        '''
+        Return the next received frame and whether its checksum was
+        reported valid, or None at the end of the recording
+        '''
+        with self.lock:
+            while self.cursor < len(self.records):
+                frame, direction, csum_valid = self.records[self.cursor]
+                self.cursor += 1
+                if direction == INBOUND:
+                    return frame, csum_valid
+        return None
+
+    def _syn(self, frame):
+        # a frame cut short by the snap length or the recording
+        if len(frame) < 54 or frame[12:14] != ETH_P_IP or \
+                ord(frame[23]) != s.IPPROTO_TCP:
+            return None
+        tcp = 14 + (ord(frame[14]) & 0x0f) * 4
+        if tcp < 34 or len(frame) < tcp + 20 or \
+                ord(frame[tcp + 13]) & TCP_SYN_ACK != TCP_SYN:
+            return None
+        return struct.unpack('!H', frame[tcp:tcp + 2])[0], \
+            struct.unpack('!L', frame[tcp + 4:tcp + 8])[0]
+
+
+class ReplayLink:
+    '''
+    Link playing back the received frames of a Replay in place of
+    the AF_PACKET socket, as fast as they are asked for. What gets
+    sent is only counted, the recording dictates the conversation,
+    so the same code on the same recording runs the same way.
+    '''
+    def __init__(self, replay):
+        self.replay = replay
+        self.csum_valid = False
+        self.sent = 0
+        # always readable, recv tells when the recording is over
+        self.rfd, self.wfd = os.pipe()
+        os.write(self.wfd, 'x')
+
+    def fileno(self):
+        return self.rfd
+
+    def get_local_ip(self):
+        return self.replay.local_ip
+
+    def get_local_mac(self):
+        return self.replay.local_mac
+
+    def get_mtu(self):
+        return self.replay.mtu
+
+    def get_gateway_ip(self):
+        return self.replay.gateway_ip
+
+    def tcp_hints(self):
+        return self.replay.next_syn()
+
+    def send(self, data):
+        self.sent += 1
+        return len(data)
+
+    def recv(self, bufsize):
+        record = self.replay.next_inbound()
+        if record is None:
+            raise RuntimeError('End of the replayed recording')
+        frame, self.csum_valid = record
+        return frame[:bufsize]
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
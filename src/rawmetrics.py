@@ -0,0 +1,398 @@
+import os
+import json
+import time
+import bisect
+import threading
+from collections import Counter
+
+from logger import get_logger
+
+# log-spaced bucket bounds in seconds, from 50us to about 13s
+TIME_BOUNDS = [5e-5 * 2 ** i for i in range(19)]
+SERIES_INTERVAL = 1.0
+SERIES_MAXLEN = 3600
+JSONL = 'jsonl'
+PROMETHEUS = 'prometheus'
+PART = '.part'
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    '''
+    Return the metrics registry shared by every connection in the
+    process, disabled until enable() gets called on it
+    '''
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = Registry()
+        return _registry
+
+
+class Histogram:
+    '''
+    Fixed-bucket histogram, the last bucket takes everything above
+    the highest bound
+    '''
+    def __init__(self, bounds=TIME_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        '''
+        Return the upper bound of the bucket holding the q-th
+        percentile, the maximum for the last bucket
+        '''
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return dict(count=self.count, sum=self.sum, min=self.min,
+                    max=self.max, p50=self.percentile(50),
+                    p90=self.percentile(90), p99=self.percentile(99),
+                    buckets=[[le, count] for le, count
+                             in zip(self.bounds + ['+Inf'], self.counts)
+                             if count])
+
+
+class TimeSeries:
+    '''
+    Values bucketed per interval seconds, either summed up (e.g. the
+    bytes received each second) or the last one kept (e.g. a window)
+    '''
+    def __init__(self, total=False, interval=SERIES_INTERVAL,
+                 maxlen=SERIES_MAXLEN):
+        self.total = total
+        self.interval = interval
+        self.maxlen = maxlen
+        self.points = []
+
+    def add(self, now, value):
+        slot = int(now / self.interval) * self.interval
+        if self.points and self.points[-1][0] == slot:
+            if self.total:
+                self.points[-1][1] += value
+            else:
+                self.points[-1][1] = value
+            return
+        self.points.append([slot, value])
+        if len(self.points) > self.maxlen:
+            del self.points[0]
+
+    def to_list(self):
+        return [list(point) for point in self.points]
+
+
+class ConnectionMetrics:
+    '''
+    The metrics of one connection: the RawSocket counters, the RTT
+    of our segments and the inter-arrival time of the received ones,
+    the goodput, the peer's window, our bytes in flight and our
+    congestion window over time
+    '''
+    def __init__(self, registry, counters):
+        self.registry = registry
+        self.counters = counters
+        self.host = None
+        self.port = None
+        self.start = time.time()
+        self.end = None
+        self.bytes_recv = 0
+        self.bytes_sent = 0
+        self.rtt = Histogram()
+        self.interarrival = Histogram()
+        self.goodput = TimeSeries(total=True)
+        self.rwnd = TimeSeries()
+        self.inflight = TimeSeries()
+        self.cwnd = TimeSeries()
+        self.last_arrival = None
+        # (end seq, send time) of our segments waiting for their ACK
+        self.unacked = []
+        self.snd_max = None
+
+    def on_connect(self, host, port):
+        self.host = host
+        self.port = port
+
+    def on_send(self, seq, size, now=None):
+        '''
+        Our segment of the given sequence space size went out
+        '''
+        now = now or time.time()
+        end = seq + size
+        self.bytes_sent += size
+        if self.snd_max is None or end > self.snd_max:
+            self.snd_max = end
+            self.unacked.append((end, now))
+
+    def on_retransmit(self):
+        # Karn's algorithm, no RTT sample from retransmitted segments
+        del self.unacked[:]
+
+    def on_arrival(self, window=None, ack_seq=None, now=None):
+        '''
+        A segment of the peer passed the filters and the checksums
+        '''
+        now = now or time.time()
+        if self.last_arrival is not None:
+            self.interarrival.observe(now - self.last_arrival)
+        self.last_arrival = now
+        if window is not None:
+            self.rwnd.add(now, window)
+        if ack_seq is not None and self.unacked:
+            while self.unacked and self.unacked[0][0] <= ack_seq:
+                end, sent = self.unacked.pop(0)
+                if not self.unacked or self.unacked[0][0] > ack_seq:
+                    self.rtt.observe(now - sent)
+            self.inflight.add(now, max(0, self.snd_max - ack_seq))
+
+    def on_cwnd(self, cwnd, now=None):
+        self.cwnd.add(now or time.time(), cwnd)
+
+    def on_deliver(self, size, now=None):
+        '''
+        In-order payload got appended to the receive buffer
+        '''
+        if size:
+            self.bytes_recv += size
+            self.goodput.add(now or time.time(), size)
+
+    def close(self):
+        if self.end is None:
+            self.end = time.time()
+            self.registry.finish(self)
+
+    def to_dict(self):
+        duration = (self.end or time.time()) - self.start
+        return dict(type='connection', host=self.host, port=self.port,
+                    start=self.start, duration=duration,
+                    bytes_recv=self.bytes_recv, bytes_sent=self.bytes_sent,
+                    goodput_bps=self.bytes_recv / duration
+                    if duration else 0,
+                    counters=dict(self.counters), rtt=self.rtt.to_dict(),
+                    interarrival=self.interarrival.to_dict(),
+                    series=dict(goodput=self.goodput.to_list(),
+                                rwnd=self.rwnd.to_list(),
+                                inflight=self.inflight.to_list(),
+                                cwnd=self.cwnd.to_list()))
+
+
+class HostMetrics:
+    '''
+    Rollup of the finished connections to one host
+    '''
+    def __init__(self, host):
+        self.host = host
+        self.connections = 0
+        self.duration = 0.0
+        self.bytes_recv = 0
+        self.bytes_sent = 0
+        self.counters = Counter()
+        self.rtt = Histogram()
+        self.interarrival = Histogram()
+        self.goodput = TimeSeries(total=True)
+
+    def add(self, connection):
+        self.connections += 1
+        self.duration += connection.end - connection.start
+        self.bytes_recv += connection.bytes_recv
+        self.bytes_sent += connection.bytes_sent
+        self.counters.update(connection.counters)
+        self.rtt.merge(connection.rtt)
+        self.interarrival.merge(connection.interarrival)
+        for slot, value in connection.goodput.points:
+            self.goodput.add(slot, value)
+
+    def to_dict(self):
+        return dict(type='host', host=self.host,
+                    connections=self.connections, duration=self.duration,
+                    bytes_recv=self.bytes_recv, bytes_sent=self.bytes_sent,
+                    goodput_bps=self.bytes_recv / self.duration
+                    if self.duration else 0,
+                    counters=dict(self.counters), rtt=self.rtt.to_dict(),
+                    interarrival=self.interarrival.to_dict(),
+                    series=dict(goodput=self.goodput.to_list()))
+
+
+class Registry:
+    '''
+    Collect the metrics of every connection and roll them up per
+    host, export them as JSON lines (appended, one line per finished
+    connection and one rollup per host of the connections finished
+    since the last export) or Prometheus text (cumulative, the file
+    gets rewritten, e.g. for the node_exporter textfile collector)
+    '''
+    def __init__(self):
+        self.logger = get_logger(os.path.basename(__file__))
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.finished = []
+        self.hosts = {}
+        # the end of the interval the last JSON lines cover
+        self.exported = time.time()
+        self.exporter = None
+        self.stop = threading.Event()
+
+    def enable(self):
+        self.enabled = True
+
+    def connection(self, counters):
+        '''
+        Return the ConnectionMetrics of a new connection with the
+        given counters, None while disabled
+        '''
+        if not self.enabled:
+            return None
+        return ConnectionMetrics(self, counters)
+
+    def finish(self, connection):
+        with self.lock:
+            self.finished.append(connection)
+            host = self.hosts.get(connection.host)
+            if host is None:
+                host = self.hosts[connection.host] = \
+                    HostMetrics(connection.host)
+            host.add(connection)
+
+    def export(self, path, format=JSONL):
+        '''
+        Write what has been collected since the last export
+        '''
+        with self.lock:
+            if format == PROMETHEUS:
+                self.finished = []
+                text = prometheus_text(sorted(self.hosts.values(),
+                                              key=lambda h: h.host))
+            else:
+                text = self._jsonl()
+        if format == PROMETHEUS:
+            with open(path + PART, 'w') as f:
+                f.write(text)
+            os.rename(path + PART, path)
+        else:
+            with open(path, 'a') as f:
+                f.write(text)
+
+    def _jsonl(self):
+        '''
+        The finished connections not exported yet and their rollups
+        per host, summing up the host records of every export gives
+        the totals, the lock must be held
+        '''
+        finished, self.finished = self.finished, []
+        since, self.exported = self.exported, time.time()
+        hosts = {}
+        for connection in finished:
+            if connection.host not in hosts:
+                hosts[connection.host] = HostMetrics(connection.host)
+            hosts[connection.host].add(connection)
+        records = [connection.to_dict() for connection in finished]
+        for host in sorted(hosts):
+            record = hosts[host].to_dict()
+            record.update(since=since, until=self.exported)
+            records.append(record)
+        return ''.join(json.dumps(record) + '\n' for record in records)
+
+    def start_exporter(self, path, format=JSONL, interval=10):
+        '''
+        Export every interval seconds from a background thread, for
+        the long running batch modes
+        '''
+        def run():
+            while not self.stop.wait(interval):
+                try:
+                    self.export(path, format)
+                except IOError as e:
+                    self.logger.warn('Cannot export metrics: %s' % e)
+        self.stop.clear()
+        self.exporter = threading.Thread(target=run)
+        self.exporter.daemon = True
+        self.exporter.start()
+
+    def stop_exporter(self):
+        if self.exporter is not None:
+            self.stop.set()
+            self.exporter.join()
+            self.exporter = None
+
+
+def prometheus_text(hosts):
+    '''
+    Render the per-host rollups in the Prometheus text format
+    '''
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append('# HELP rawsocket_%s %s' % (name, help))
+        lines.append('# TYPE rawsocket_%s %s' % (name, kind))
+        for labels, value in samples:
+            lines.append('rawsocket_%s{%s} %s' % (
+                name, ','.join('%s="%s"' % (k, v) for k, v in labels),
+                repr(float(value))))
+
+    def label(host):
+        return [('host', host.host)]
+
+    metric('connections_total', 'counter', 'Finished connections',
+           [(label(h), h.connections) for h in hosts])
+    metric('received_bytes_total', 'counter', 'Payload bytes received',
+           [(label(h), h.bytes_recv) for h in hosts])
+    metric('sent_bytes_total', 'counter', 'Payload bytes sent',
+           [(label(h), h.bytes_sent) for h in hosts])
+    metric('goodput_bytes_per_second', 'gauge',
+           'Payload bytes received per second of connection time',
+           [(label(h), h.bytes_recv / h.duration if h.duration else 0)
+            for h in hosts])
+    for counter in ('send', 'recv', 'retry', 'cksumfail', 'fastpath'):
+        metric('%s_total' % counter, 'counter',
+               'RawSocket %s counter' % counter,
+               [(label(h), h.counters[counter]) for h in hosts])
+    for name, help in (('rtt', 'Round trip time of our segments'),
+                       ('interarrival', 'Time between received segments')):
+        lines.append('# HELP rawsocket_%s_seconds %s' % (name, help))
+        lines.append('# TYPE rawsocket_%s_seconds histogram' % name)
+        for h in hosts:
+            histogram = getattr(h, name)
+            seen = 0
+            for le, count in zip(histogram.bounds + ['+Inf'],
+                                 histogram.counts):
+                seen += count
+                lines.append('rawsocket_%s_seconds_bucket{host="%s",'
+                             'le="%s"} %d' % (name, h.host, le, seen))
+            lines.append('rawsocket_%s_seconds_sum{host="%s"} %r'
+                         % (name, h.host, histogram.sum))
+            lines.append('rawsocket_%s_seconds_count{host="%s"} %d'
+                         % (name, h.host, histogram.count))
+    return '\n'.join(lines) + '\n'
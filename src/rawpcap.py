@@ -0,0 +1,169 @@
+import time
+import threading
+from struct import Struct
+
+# pcap-ng blocks
+SHB_TYPE = 0x0a0d0d0a
+IDB_TYPE = 0x00000001
+EPB_TYPE = 0x00000006
+BYTE_ORDER_MAGIC = 0x1a2b3c4d
+BLOCK_HDR = Struct('<LL')
+SHB_BODY = Struct('<LHHq')
+IDB_BODY = Struct('<HHL')
+EPB_BODY = Struct('<LLLLL')
+OPT_HDR = Struct('<HH')
+OPT_ENDOFOPT = 0
+OPT_COMMENT = 1
+EPB_FLAGS = 2
+# direction bits of epb_flags
+INBOUND = 1
+OUTBOUND = 2
+LINKTYPE_ETHERNET = 1
+SNAPLEN = 0xffff
+# classic pcap, microsecond and nanosecond timestamps
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_NSEC_MAGIC = 0xa1b23c4d
+PCAP_HDR_LEN = 24
+PCAP_REC_LEN = 16
+
+
+class PcapWriter:
+    '''
+    Append Ethernet frames to a pcap-ng file
+    Every frame is written as an Enhanced Packet Block with its
+    direction in epb_flags and an optional comment, so that a replay
+    can tell the frames we sent from the ones we received. The writer
+    may be shared by several links, writes are serialized. Appending
+    to an existing file starts a new section in it.
+    '''
+    def __init__(self, path, append=False):
+        self.file = open(path, 'ab' if append else 'wb')
+        self.lock = threading.Lock()
+        self._block(SHB_TYPE, SHB_BODY.pack(BYTE_ORDER_MAGIC, 1, 0, -1))
+        self._block(IDB_TYPE, IDB_BODY.pack(LINKTYPE_ETHERNET, 0, SNAPLEN))
+
+    def write(self, frame, direction, comment=None, ts=None, origlen=None):
+        '''
+        Write one frame, sent (OUTBOUND) or received (INBOUND), the
+        original length tells how long it was before being truncated
+        '''
+        ts = int((time.time() if ts is None else ts) * 1e6)
+        frame = str(frame)
+        options = [_option(EPB_FLAGS, Struct('<L').pack(direction))]
+        if comment:
+            options.append(_option(OPT_COMMENT, comment))
+        options.append(OPT_HDR.pack(OPT_ENDOFOPT, 0))
+        body = ''.join([EPB_BODY.pack(0, ts >> 32, ts & 0xffffffff,
+                                      len(frame), origlen or len(frame)),
+                        _pad(frame)] + options)
+        with self.lock:
+            self._block(EPB_TYPE, body)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _block(self, block_type, body):
+        length = BLOCK_HDR.size + len(body) + 4
+        self.file.write(''.join([BLOCK_HDR.pack(block_type, length), body,
+                                 Struct('<L').pack(length)]))
+
+
+def read_pcap(path):
+    '''
+    Iterate over the frames of a pcap-ng or classic pcap file, as
+    (timestamp, frame, direction, comment) tuples. The direction is
+    None when the file does not record it (classic pcap).
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < 4:
+        raise ValueError('Not a pcap file: %s' % path)
+    magic = Struct('<L').unpack_from(data)[0]
+    if magic == SHB_TYPE:
+        return _read_pcapng(data)
+    return _read_classic(data, path)
+
+
+def _read_pcapng(data):
+    offset = 0
+    order = '<'
+    # interface id -> timestamp resolution
+    tsres = []
+    while offset + BLOCK_HDR.size <= len(data):
+        if Struct('<L').unpack_from(data, offset)[0] == SHB_TYPE:
+            magic = Struct('<L').unpack_from(data, offset + 8)[0]
+            order = '<' if magic == BYTE_ORDER_MAGIC else '>'
+            tsres = []
+        block_type, length = Struct(order + 'LL').unpack_from(data, offset)
+        if length < 12 or offset + length > len(data):
+            raise ValueError('Truncated pcap-ng block at %d' % offset)
+        body = data[offset + 8:offset + length - 4]
+        offset += length
+        if block_type == IDB_TYPE:
+            tsres.append(_if_tsresol(body, order))
+        elif block_type == EPB_TYPE:
+            ifid, ts_high, ts_low, caplen, origlen = \
+                Struct(order + 'LLLLL').unpack_from(body)
+            frame = body[20:20 + caplen]
+            direction, comment = None, None
+            opts = body[20 + caplen + (-caplen % 4):]
+            for code, value in _options(opts, order):
+                if code == EPB_FLAGS and len(value) == 4:
+                    direction = Struct(order + 'L').unpack(value)[0] & 3
+                elif code == OPT_COMMENT:
+                    comment = value
+            ts = ((ts_high << 32) | ts_low) / float(
+                tsres[ifid] if ifid < len(tsres) else 1e6)
+            yield ts, frame, direction or None, comment
+
+
+def _read_classic(data, path):
+    for order in ('<', '>'):
+        magic = Struct(order + 'L').unpack_from(data)[0]
+        if magic in (PCAP_MAGIC, PCAP_NSEC_MAGIC):
+            break
+    else:
+        raise ValueError('Not a pcap file: %s' % path)
+    scale = 1e9 if magic == PCAP_NSEC_MAGIC else 1e6
+    record = Struct(order + 'LLLL')
+    offset = PCAP_HDR_LEN
+    while offset + PCAP_REC_LEN <= len(data):
+        ts_sec, ts_frac, caplen, origlen = record.unpack_from(data, offset)
+        offset += PCAP_REC_LEN
+        yield ts_sec + ts_frac / scale, data[offset:offset + caplen], \
+            None, None
+        offset += caplen
+
+
+def _if_tsresol(body, order):
+    for code, value in _options(body[IDB_BODY.size:], order):
+        # if_tsresol, a power of 10, or of 2 with the top bit set
+        if code == 9 and value:
+            res = ord(value[0])
+            return 2 ** (res & 0x7f) if res & 0x80 else 10 ** res
+    return 1e6
+
+
+def _options(opts, order):
+    offset = 0
+    opt_hdr = Struct(order + 'HH')
+    while offset + opt_hdr.size <= len(opts):
+        code, length = opt_hdr.unpack_from(opts, offset)
+        if code == OPT_ENDOFOPT:
+            break
+        offset += opt_hdr.size
+        yield code, opts[offset:offset + length]
+        offset += length + (-length % 4)
+
+
+def _option(code, value):
+    return OPT_HDR.pack(code, len(value)) + _pad(value)
+
+
+def _pad(data):
+    return data + '\x00' * (-len(data) % 4)
@@ -0,0 +1,175 @@
+import time
+import threading
+from collections import defaultdict
+
+import rawsocket
+import rawdns
+import rawcodec
+import HttpClient
+import HttpParser
+
+# report order of the stages, from the wire up to the file
+STAGES = ['wait', 'recv', 'fastpath', 'decode', 'checksum', 'filter',
+          'reassembly', 'ack', 'send', 'handshake', 'dns', 'parse',
+          'decompress', 'write', 'request']
+
+_profiler = None
+
+
+def enable():
+    '''
+    Instrument the stack and return the profiler, the hooks only
+    exist while profiling so that they cost nothing otherwise
+    '''
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+        _profiler.install()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    if _profiler is not None:
+        _profiler.uninstall()
+        _profiler = None
+
+
+class Profiler:
+    '''
+    Cumulative time and call counts per stage of the stack. Stages
+    nest (a checksum inside a receive inside a request), each keeps
+    its own time only, so that the stages add up to the total. Every
+    thread tallies on its own, by stack of stages.
+    '''
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # per thread, stack of stages -> [calls, seconds]
+        self.tallies = []
+        self.patched = []
+        self.start = time.time()
+
+    def install(self):
+        self.patch(rawsocket, 'select', 'wait')
+        self.patch(rawsocket.RawSocket, '_recv', 'recv')
+        self.patch(rawsocket.RawSocket, '_deliver_predicted', 'fastpath')
+        self.patch(rawcodec.TCPFrame, '_decode', 'decode')
+        self.patch(rawcodec.TCPFrame, 'verify_ip_checksum', 'checksum')
+        self.patch(rawcodec.TCPFrame, 'verify_checksum', 'checksum')
+        self.patch(rawsocket.RawSocket, '_ip_expected', 'filter')
+        self.patch(rawsocket.RawSocket, '_tcp_expected', 'filter')
+        self.patch(rawsocket.RawSocket, '_reassemble', 'reassembly')
+        self.patch(rawsocket.RawSocket, '_send_ack', 'ack')
+        self.patch(rawsocket.RawSocket, '_send', 'send')
+        self.patch(rawsocket.RawSocket, '_tcp_handshake', 'handshake')
+        self.patch(rawdns.Resolver, 'resolve', 'dns')
+        self.patch(HttpParser.ResponseParser, 'feed', 'parse')
+        self.patch(HttpParser.ContentDecoder, 'feed', 'decompress')
+        retrieve = HttpClient.HttpClient.__dict__['retrieve']
+        timed = self.timed
+
+        def write_timed(client, uri, write, *args, **kwargs):
+            return retrieve(client, uri, timed('write', write),
+                            *args, **kwargs)
+        self.patch(HttpClient.HttpClient, 'retrieve', 'request',
+                   write_timed)
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        del self.patched[:]
+
+    def patch(self, owner, name, stage, func=None):
+        # the plain function, not the unbound method of a class
+        original = owner.__dict__[name]
+        self.patched.append((owner, name, original))
+        setattr(owner, name, self.timed(stage, func or original))
+
+    def timed(self, stage, func):
+        '''
+        Wrap func to count its calls and time under the stage
+        '''
+        def wrapper(*args, **kwargs):
+            stack, tally = self._thread_state()
+            # [stage, time of the nested stages]
+            frame = [stage, 0.0]
+            stack.append(frame)
+            begin = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - begin
+                stack.pop()
+                entry = tally[tuple(f[0] for f in stack) + (stage,)]
+                entry[0] += 1
+                entry[1] += elapsed - frame[1]
+                if stack:
+                    stack[-1][1] += elapsed
+        return wrapper
+
+    def _thread_state(self):
+        try:
+            return self.local.stack, self.local.tally
+        except AttributeError:
+            self.local.stack = []
+            self.local.tally = defaultdict(lambda: [0, 0.0])
+            with self.lock:
+                self.tallies.append(self.local.tally)
+            return self.local.stack, self.local.tally
+
+    def paths(self):
+        '''
+        Return the calls and seconds by stack of stages, all the
+        threads together
+        '''
+        paths = defaultdict(lambda: [0, 0.0])
+        with self.lock:
+            tallies = list(self.tallies)
+        for tally in tallies:
+            for path, (calls, seconds) in tally.items():
+                paths[path][0] += calls
+                paths[path][1] += seconds
+        return paths
+
+    def stages(self):
+        '''
+        Return the calls and seconds by stage
+        '''
+        stages = defaultdict(lambda: [0, 0.0])
+        for path, (calls, seconds) in self.paths().items():
+            stages[path[-1]][0] += calls
+            stages[path[-1]][1] += seconds
+        return stages
+
+    def report(self, nbytes=0):
+        '''
+        Return the breakdown per stage as text, with the time per MB
+        if the number of bytes transferred is given
+        '''
+        stages = self.stages()
+        total = sum(seconds for calls, seconds in stages.values())
+        lines = ['%-11s %10s %10s %7s %10s%s' % (
+            'stage', 'calls', 'seconds', '%', 'us/call',
+            ' %10s' % 'ms/MB' if nbytes else '')]
+        for stage in STAGES + sorted(set(stages) - set(STAGES)):
+            if stage not in stages:
+                continue
+            calls, seconds = stages[stage]
+            lines.append('%-11s %10d %10.4f %6.1f%% %10.2f%s' % (
+                stage, calls, seconds,
+                seconds * 100 / total if total else 0,
+                seconds * 1e6 / calls if calls else 0,
+                ' %10.3f' % (seconds * 1e3 / (nbytes / 1048576.0))
+                if nbytes else ''))
+        lines.append('%-11s %10s %10.4f' % ('total', '', total))
+        return '\n'.join(lines)
+
+    def write_folded(self, path):
+        '''
+        Write the stacks of stages in the folded format of
+        flamegraph.pl, weighted in microseconds
+        '''
+        with open(path, 'w') as f:
+            for stack, (calls, seconds) in sorted(self.paths().items()):
+                f.write('%s %d\n' % (';'.join(stack), seconds * 1e6))
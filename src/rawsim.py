@@ -0,0 +1,492 @@
+import os
+import time
+import hashlib
+import heapq
+import random
+import struct
+import socket as s
+import threading
+from collections import Counter
+
+import HttpParser as P
+from logger import get_logger
+from rawarp import ARPPacket
+from rawethernet import EthFrame
+from rawcodec import encode_frame, TCPFrame, mss_option, tcp_option, \
+    fastopen_option, TCPOPT_MSS, TCPOPT_FASTOPEN, FIN, SYN, RST, PSH, ACK
+
+SIM_LOCAL_IP = s.inet_aton('10.0.0.1')
+SIM_GATEWAY_IP = s.inet_aton('10.0.0.254')
+SIM_LOCAL_MAC = '\x02\x00\x00\x00\x00\x01'
+SIM_GATEWAY_MAC = '\x02\x00\x00\x00\x00\xfe'
+ETH_P_ARP = 0x0806
+ARP_REPLY = 2
+# peer TCP defaults, an RTO a bit above the Linux minimum
+DEFAULT_MSS = 536
+PEER_WINDOW = 65535
+PEER_INIT_CWND = 10
+PEER_RTO = 0.25
+PEER_MAX_RTO = 4
+# room for many frames in flight to the stack
+SOCKBUF = 4 << 20
+CRLF2 = '\r\n\r\n'
+TFO_COOKIE_LEN = 8
+
+
+class SimLink:
+    '''
+    In-process link joining a RawSocket to a simulated peer
+    The frames both ways go through the same impairments: one-way
+    latency in seconds, bandwidth in bytes per second (None for no
+    limit), and the probabilities for a frame to be lost, reordered
+    (held back by up to one more latency) or duplicated. A scheduler
+    thread delivers them on time over a datagram socketpair, so that
+    select works on the link like on the AF_PACKET socket.
+    '''
+    def __init__(self, peer, mtu=1500, latency=0.0, bandwidth=None,
+                 loss=0.0, reorder=0.0, duplicate=0.0, seed=None,
+                 csum_valid=False):
+        self.logger = get_logger(os.path.basename(__file__))
+        self.peer = peer
+        self.mtu = mtu
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.random = random.Random(seed)
+        self.csum_valid = csum_valid
+        self.metrics = Counter(sent=0, delivered=0, lost=0, reordered=0,
+                               duplicated=0, resent=0)
+        self.prev_sent = None
+        # when each direction is done serializing its last frame
+        self.busy_until = {True: 0, False: 0}
+        self.events = []
+        self.counter = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.stack_end, self.sim_end = s.socketpair(s.AF_UNIX, s.SOCK_DGRAM)
+        for sock in (self.stack_end, self.sim_end):
+            sock.setsockopt(s.SOL_SOCKET, s.SO_SNDBUF, SOCKBUF)
+            sock.setsockopt(s.SOL_SOCKET, s.SO_RCVBUF, SOCKBUF)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fileno(self):
+        return self.stack_end.fileno()
+
+    def get_local_ip(self):
+        return SIM_LOCAL_IP
+
+    def get_local_mac(self):
+        return SIM_LOCAL_MAC
+
+    def get_mtu(self):
+        return self.mtu
+
+    def get_gateway_ip(self):
+        return SIM_GATEWAY_IP
+
+    def tcp_hints(self):
+        return None
+
+    def send(self, data):
+        '''
+        Send a frame of the stack to the peer
+        '''
+        data = str(data)
+        self.metrics['sent'] += 1
+        # the stack resends its last frame verbatim on a timeout
+        if data == self.prev_sent:
+            self.metrics['resent'] += 1
+        self.prev_sent = data
+        self._transmit(data, True)
+        return len(data)
+
+    def recv(self, bufsize):
+        return self.stack_end.recv(bufsize)
+
+    def deliver(self, frame):
+        '''
+        Send a frame of the peer to the stack
+        '''
+        self._transmit(str(frame), False)
+
+    def schedule(self, delay, function, *args):
+        '''
+        Call function(*args) from the scheduler thread after delay
+        '''
+        with self.cond:
+            self.counter += 1
+            heapq.heappush(self.events, (time.time() + delay, self.counter,
+                                         function, args))
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.stack_end.close()
+        self.sim_end.close()
+
+    def _transmit(self, frame, uplink):
+        if self.random.random() < self.loss:
+            self.metrics['lost'] += 1
+            return
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.metrics['duplicated'] += 1
+            copies = 2
+        now = time.time()
+        with self.cond:
+            start = max(now, self.busy_until[uplink])
+            if self.bandwidth:
+                start += len(frame) / float(self.bandwidth)
+            self.busy_until[uplink] = start
+        delay = start - now + self.latency
+        for i in range(copies):
+            if self.random.random() < self.reorder:
+                self.metrics['reordered'] += 1
+                delay += self.random.uniform(0, self.latency or 0.001)
+            if uplink:
+                self.schedule(delay, self.peer.receive, self, frame)
+            else:
+                self.schedule(delay, self._to_stack, frame)
+
+    def _to_stack(self, frame):
+        self.metrics['delivered'] += 1
+        try:
+            self.sim_end.send(frame)
+        except s.error:
+            # the stack has gone, like a cable pulled
+            pass
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.closed and (
+                        not self.events or self.events[0][0] > time.time()):
+                    wait = self.events[0][0] - time.time() \
+                        if self.events else None
+                    self.cond.wait(wait)
+                if self.closed:
+                    return
+                due, _, function, args = heapq.heappop(self.events)
+            try:
+                function(*args)
+            except Exception:
+                self.logger.exception('Simulated peer failed')
+
+
+class HttpPeer:
+    '''
+    Minimal HTTP/1.1 server over a simulated TCP sender
+    It answers ARP for the gateway and serves the bodies in files,
+    a dict of path -> content, for any IP address the stack connects
+    to, then closes the connection. A PUT or POST body (Content-Length
+    or chunked) is only hashed, its size and MD5 are kept in uploads
+    and the MD5 is sent back. Its MSS follows the MTU of the link
+    unless given, its window is fixed. The sender does slow start and
+    congestion avoidance, fast retransmit on 3 duplicate ACKs, NewReno
+    partial ACKs and exponential RTO backoff, and counts the segments
+    it retransmits. With fastopen, it gives TCP Fast Open cookies
+    derived from the client IP and a secret, and takes the request
+    in a SYN with a valid cookie. With keepalive, the connection
+    stays open for the next request unless the client asks to close.
+    '''
+    def __init__(self, files, mss=None, rto=PEER_RTO, window=PEER_WINDOW,
+                 fastopen=False, keepalive=False):
+        self.files = files
+        self.mss = mss
+        self.rto = rto
+        self.window = window
+        self.fastopen = fastopen
+        self.keepalive = keepalive
+        self.secret = os.urandom(16)
+        # path -> (size, MD5 hex digest) of the uploaded bodies
+        self.uploads = {}
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.metrics = Counter(connections=0, requests=0, retransmit=0,
+                               timeout=0, fast_retransmit=0,
+                               tfo_request=0, tfo_accepted=0,
+                               tfo_rejected=0, reused=0)
+
+    def cookie(self, ip):
+        '''
+        Return the Fast Open cookie of the client IP, changing the
+        secret invalidates all of them
+        '''
+        return hashlib.md5(self.secret + ip).digest()[:TFO_COOKIE_LEN]
+
+    def receive(self, link, frame):
+        eth_frame = EthFrame()
+        eth_frame.unpack(frame)
+        if eth_frame.eth_tcode == ETH_P_ARP:
+            self._arp_reply(link, eth_frame)
+            return
+        tcp_segment = TCPFrame(frame)
+        if not tcp_segment.is_tcp() or \
+                tcp_segment.ip_proto != s.IPPROTO_TCP:
+            return
+        key = (link, tcp_segment.tcp_src_port)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is None or tcp_segment.tcp_flags & SYN and \
+                    connection.closed:
+                if not tcp_segment.tcp_flags & SYN:
+                    return
+                self.metrics['connections'] += 1
+                connection = self.connections[key] = \
+                    _PeerConnection(self, link, tcp_segment)
+        connection.receive(tcp_segment)
+
+    def _arp_reply(self, link, eth_frame):
+        request = ARPPacket()
+        request.unpack(eth_frame.data)
+        reply = ARPPacket(optr=ARP_REPLY, sha=SIM_GATEWAY_MAC,
+                          spa=request.arp_tpa, tha=request.arp_sha,
+                          tpa=request.arp_spa)
+        link.deliver(EthFrame(dest_mac=request.arp_sha,
+                              src_mac=SIM_GATEWAY_MAC, tcode=ETH_P_ARP,
+                              data=reply.pack()).pack())
+
+
+class _PeerConnection:
+    '''
+    The server side of one simulated TCP connection
+    '''
+    def __init__(self, peer, link, syn):
+        self.peer = peer
+        self.link = link
+        self.ip_src = syn.ip_dest_addr
+        self.ip_dest = syn.ip_src_addr
+        self.port_src = syn.tcp_dest_port
+        self.port_dest = syn.tcp_src_port
+        mss = tcp_option(syn.tcp_opts, TCPOPT_MSS)
+        self.mss = min(peer.mss or link.mtu - 40, struct.unpack('!H', mss)[0]
+                       if mss and len(mss) == 2 else DEFAULT_MSS)
+        self.isn = random.randint(0, 0xffffff)
+        self.rcv_nxt = (syn.tcp_seq + 1) & 0xffffffff
+        self.snd_una = self.isn
+        self.snd_nxt = self.isn
+        self.rwnd = syn.tcp_adwind
+        # the options of our SYN-ACK and the data of the SYN taken
+        # with a valid Fast Open cookie
+        self.synack_opts = mss_option(self.mss)
+        self.syn_data = ''
+        cookie = tcp_option(syn.tcp_opts, TCPOPT_FASTOPEN) \
+            if peer.fastopen else None
+        if cookie is not None:
+            valid = peer.cookie(self.ip_dest)
+            if cookie == valid and syn.data:
+                peer.metrics['tfo_accepted'] += 1
+                self.syn_data = syn.data
+            else:
+                # asked for or invalid, give the right one
+                peer.metrics['tfo_rejected' if cookie else
+                             'tfo_request'] += 1
+                self.synack_opts += fastopen_option(valid)
+        self.cwnd = PEER_INIT_CWND * self.mss
+        self.ssthresh = PEER_WINDOW
+        self.rto = peer.rto
+        self.timer = 0
+        self.dupacks = 0
+        # snd_nxt when the last loss was detected, NewReno
+        self.recover = self.isn
+        self.request = ''
+        # seq -> (data, FIN) of the segments received out of order
+        self.ooo = {}
+        # the parser of the request body once the head is complete
+        self.body = None
+        self.digest = hashlib.md5()
+        self.size = 0
+        # the responses so far, sent from isn + 1, then FIN once
+        # closing, after the last response or the client's FIN
+        self.response = None
+        self.keep = False
+        self.closing = False
+        self.closed = False
+
+    def receive(self, tcp_segment):
+        flags = tcp_segment.tcp_flags
+        if flags & RST:
+            self.closed = True
+            return
+        if flags & SYN:
+            if self.syn_data and self.snd_nxt == self.isn:
+                self.rcv_nxt += len(self.syn_data)
+                self._on_request(self.syn_data)
+            # a new or retransmitted SYN
+            self._output(self.isn, SYN | ACK, opts=self.synack_opts)
+            self.snd_nxt = max(self.snd_nxt, self.isn + 1)
+            # the response to a Fast Open request goes right away
+            self._push()
+            self._arm()
+            return
+        if flags & ACK:
+            self._ack(tcp_segment.tcp_ack_seq, tcp_segment.tcp_adwind,
+                      bool(tcp_segment.data) or flags & FIN)
+        data = tcp_segment.data
+        if data or flags & FIN:
+            seq, fin = tcp_segment.tcp_seq, flags & FIN
+            if seq > self.rcv_nxt and \
+                    seq - self.rcv_nxt < self.peer.window:
+                # out of order, kept until the hole is filled
+                self.ooo[seq] = (data, fin)
+            while seq == self.rcv_nxt:
+                self.rcv_nxt += len(data) + (1 if fin else 0)
+                if fin:
+                    self.closed = self.closing = True
+                if data and not self.closing:
+                    self._on_request(data)
+                if self.rcv_nxt not in self.ooo:
+                    break
+                seq = self.rcv_nxt
+                data, fin = self.ooo.pop(seq)
+            # ACK new data and retransmissions alike
+            self._output(self.snd_nxt, ACK)
+            if flags & FIN and self.response is not None and \
+                    self.snd_una <= self._fin_seq() < self.snd_nxt:
+                # our FIN is not acknowledged, say it again
+                self._output(self._fin_seq(), FIN | ACK)
+        self._push()
+
+    def _on_request(self, data):
+        if self.body is None:
+            self.request += data
+            if CRLF2 not in self.request:
+                return
+            self.request, data = self.request.split(CRLF2, 1)
+            lines = self.request.split('\r\n')
+            headers = P.Headers(lines[1:])
+            self.keep = self.peer.keepalive and \
+                headers.get('Connection', '').lower() != 'close'
+            if 'Content-Length' not in headers and \
+                    'Transfer-Encoding' not in headers:
+                self._respond()
+                return
+            # the request body is framed the way a response body is
+            self.body = P.ResponseParser()
+            self.body.feed('HTTP/1.1 200 OK\r\n%s%s' % (
+                '\r\n'.join(lines[1:]), CRLF2))
+        for event, value in self.body.feed(data):
+            if event == 'body':
+                self.digest.update(value)
+                self.size += len(value)
+        if self.body.done:
+            self._respond()
+
+    def _respond(self):
+        self.peer.metrics['requests'] += 1
+        request_line = self.request.split('\r\n', 1)[0].split()
+        path = request_line[1] if len(request_line) > 1 else '/'
+        body = self.peer.files.get(path)
+        if self.body is not None:
+            body = self.digest.hexdigest()
+            self.peer.uploads[path] = (self.size, body)
+            status = '201 Created' if request_line[0] == 'PUT' \
+                else '200 OK'
+        elif body is None:
+            status, body = '404 Not Found', ''
+        else:
+            status = '200 OK'
+        if self.response is not None:
+            self.peer.metrics['reused'] += 1
+        self.response = ''.join([
+            self.response or '', 'HTTP/1.1 %s\r\n' % status,
+            'Content-Length: %d\r\n' % len(body),
+            'Connection: %s\r\n\r\n' % (
+                'keep-alive' if self.keep else 'close'), body])
+        self.closing = not self.keep
+        # ready for the next request on the connection
+        self.request = ''
+        self.body = None
+        self.digest = hashlib.md5()
+        self.size = 0
+
+    def _fin_seq(self):
+        return self.isn + 1 + len(self.response)
+
+    def _ack(self, ack, window, carries_data):
+        self.rwnd = window
+        if ack > self.snd_una and ack <= self.snd_nxt:
+            acked = ack - self.snd_una
+            self.snd_una = ack
+            self.dupacks = 0
+            self.rto = self.peer.rto
+            if ack < self.recover:
+                # partial ACK, the next hole is lost as well
+                self._retransmit()
+            elif self.cwnd < self.ssthresh:
+                self.cwnd += min(acked, self.mss)
+            else:
+                self.cwnd += max(1, self.mss * self.mss / self.cwnd)
+            self._arm()
+        elif ack == self.snd_una and self.snd_nxt > self.snd_una and \
+                not carries_data:
+            self.dupacks += 1
+            if self.dupacks == 3:
+                self.peer.metrics['fast_retransmit'] += 1
+                self._loss()
+                self._retransmit()
+
+    def _push(self):
+        '''
+        Send new segments as far as the windows allow
+        '''
+        if self.response is None:
+            return
+        fin_seq = self._fin_seq()
+        last = fin_seq if self.closing else fin_seq - 1
+        while self.snd_nxt <= last and \
+                self.snd_nxt - self.snd_una < min(self.cwnd, self.rwnd):
+            self._segment(self.snd_nxt)
+            self.snd_nxt = min(fin_seq, self.snd_nxt + self.mss) \
+                if self.snd_nxt < fin_seq else fin_seq + 1
+        self._arm()
+
+    def _segment(self, seq):
+        fin_seq = self._fin_seq()
+        if seq >= fin_seq:
+            self._output(fin_seq, FIN | ACK)
+            return
+        offset = seq - self.isn - 1
+        data = self.response[offset:offset + self.mss]
+        self._output(seq, ACK | PSH, data)
+
+    def _retransmit(self):
+        self.peer.metrics['retransmit'] += 1
+        if self.snd_una == self.isn:
+            self._output(self.isn, SYN | ACK, opts=self.synack_opts)
+        else:
+            self._segment(self.snd_una)
+
+    def _loss(self):
+        flight = self.snd_nxt - self.snd_una
+        self.recover = self.snd_nxt
+        self.ssthresh = max(flight / 2, 2 * self.mss)
+        self.cwnd = self.ssthresh
+
+    def _arm(self):
+        self.timer += 1
+        if self.snd_nxt > self.snd_una and not self.closed:
+            self.link.schedule(self.rto, self._timeout, self.timer)
+
+    def _timeout(self, timer):
+        if timer != self.timer or self.snd_una >= self.snd_nxt:
+            return
+        self.peer.metrics['timeout'] += 1
+        self._loss()
+        self.cwnd = self.mss
+        self.rto = min(self.rto * 2, PEER_MAX_RTO)
+        self._retransmit()
+        self._arm()
+
+    def _output(self, seq, flags, data='', opts=''):
+        self.link.deliver(encode_frame(
+            SIM_LOCAL_MAC, SIM_GATEWAY_MAC, self.ip_src, self.ip_dest,
+            self.port_src, self.port_dest, seq & 0xffffffff,
+            self.rcv_nxt & 0xffffffff, flags, self.peer.window, data, opts))
@@ -1,74 +1,202 @@
 import socket as s
 import os
 import random
-import fcntl
 import struct
+import time
+import threading
 from select import select
-from collections import Counter
+from collections import Counter, deque
 
 from logger import get_logger
+from rawdns import get_resolver
 from rawarp import ARPPacket
 from rawethernet import EthFrame
-from rawip import IPDatagram
-from rawtcp import TCPSegment
+from rawip import Reassembler, IP_DF
+from rawlink import open_link
+from rawmetrics import get_registry
+from rawtrace import get_trace
+from rawtfo import get_cookie_cache
+from rawpcap import INBOUND, OUTBOUND
+from rawcodec import encode_frame, pseudo_header_sum, TCPFrame, \
+    TCP_OFFSET, TCP_CKSUM_OFFSET, HDR_LEN, ETH_HDR_LEN, IP_HDR_LEN, \
+    TCP_HDR_LEN, IP_HDR_WORDS, ACK, TCPOPT_MSS, TCPOPT_FASTOPEN, \
+    mss_option, fastopen_option, tcp_option
+from utils import checksum_add, checksum_fold
+
+# offsets of the fields a pure ACK patches in its template
+TCP_SEQ_OFFSET = TCP_OFFSET + 4
+TCP_WIN_OFFSET = TCP_OFFSET + 14
+# header prediction compares the frame from the IP source address
+# to the TCP data offset, then the flags and the window
+HP_BEGIN = ETH_HDR_LEN + 12
+HP_END = TCP_OFFSET + 13
+HP_FLAGS = ('\x10', '\x18')   # ACK, ACK | PSH
+# Ethernet type IP, IP version 4 without options
+HP_ETH_IP = '\x08\x00\x45'
+# no fragment offset nor more fragments, maybe don't fragment
+NO_FRAG = ('\x00\x00', '\x40\x00')
+HP_SEQS = struct.Struct('!LL')
+HP_WINDOW = struct.Struct('!H')
+IP_TLEN = struct.Struct('!H')
+# seq, ack_seq and flags of a frame to retransmit
+TRACE_FIELDS = struct.Struct('!LLxB')
+# returned by _recv for a predicted segment already delivered
+PREDICTED = object()
+# the MSS assumed when the peer sends none, RFC 1122
+DEFAULT_MSS = 536
+# Ethernet header plus a VLAN tag
+LINK_HDR_LEN = ETH_HDR_LEN + 4
+ICMP_DEST_UNREACH = 3
+ICMP_FRAG_NEEDED = 4
+# the smallest MTU every IPv4 link must carry, RFC 791
+MIN_MTU = 68
+# initial congestion window in segments, RFC 6928
+INIT_CWND = 10
+INIT_SSTHRESH = 1 << 30
+# lower bound of the retransmission timeout, as Linux has it
+MIN_RTO = 0.2
+# how long a gateway MAC is reused without asking ARP again
+ARP_TTL = 60
+
+# (iface, local IP, gateway IP) -> (gateway MAC, expiry time)
+_arp_cache = {}
+_arp_cache_lock = threading.Lock()
 
 
 class RawSocket:
-    def __init__(self, iface, timeout=180, tick=2):
+    def __init__(self, iface, timeout=180, tick=2, resolver=None,
+                 link=None):
         self.logger = get_logger(os.path.basename(__file__))
-        # socket setup: 0x0800 EthType only IP
-        self.socket = s.socket(s.AF_PACKET, s.SOCK_RAW)
-        self.socket.bind((iface, s.SOCK_RAW))
+        # shared DNS cache unless a resolver is given
+        self.resolver = resolver or get_resolver()
+        # the AF_PACKET socket, or whatever link is plugged in
+        self.socket = link or open_link(iface)
         # IPs
-        self.ip_gateway = self._get_gateway_ip(iface)
-        self.ip_src = self._get_local_ip(iface)
+        self.ip_gateway = self.socket.get_gateway_ip()
+        self.ip_src = self.socket.get_local_ip()
         self.ip_dest = ''
-        # ports
-        self.port_src = random.randint(0x7530, 0xffff)
+        # ports and ISN, a replayed link dictates the recorded ones
+        hints = self.socket.tcp_hints()
+        self.port_src = hints[0] if hints else random.randint(0x7530, 0xffff)
         self.port_dest = 80
         # MACs
-        self.mac_src = self._get_local_mac(iface)
-        self.mac_gateway = self._get_gateway_mac(iface)
+        self.mac_src = self.socket.get_local_mac()
+        self.mac_gateway = self._gateway_mac(iface)
+        # MTU of the interface, the largest frame we may receive, the
+        # MSS we advertise and the MSS we send with, which gets lowered
+        # by the peer's MSS option and by path MTU discovery
+        self.mtu = self.socket.get_mtu()
+        self.bufsize = self.mtu + LINK_HDR_LEN
+        self.mss = self.mtu - IP_HDR_LEN - TCP_HDR_LEN
+        self.snd_mss = self.mss
         # TCP setup
-        self.tcp_seq = random.randint(0x0001, 0xffff)
+        self.tcp_seq = hints[1] if hints else random.randint(0x0001, 0xffff)
+        # sender: the oldest unacknowledged seq, the (end seq, frame)
+        # of the segments in flight, the peer's window, the congestion
+        # window and the state of fast retransmit
+        self.snd_una = self.tcp_seq
+        self.snd_queue = deque()
+        self.snd_wnd = 65535
+        self.cwnd = INIT_CWND * self.snd_mss
+        self.ssthresh = INIT_SSTHRESH
+        self.recover = 0
+        self.dupacks = 0
+        # retransmission timeout from the smoothed RTT, RFC 6298, and
+        # the (end seq, send time) of the segment being timed
+        self.srtt = None
+        self.rttvar = None
+        self.rtt_timing = None
         self.tcp_ack_seq = 0
-        self.tcp_cwind = 64
         # size of the receive buffer
         self.tcp_adwind = 65535
         self.recv_buf = []
         self.tmp_buf = {}
+        self.reassembler = Reassembler()
         self.prev_data = ''
+        # pre-encoded pure ACK frame and the partial checksum of its
+        # fixed fields, built once the connection is set up
+        self.ack_frame = None
+        self.ack_cksum_base = 0
+        # header prediction: the expected header bytes of the next
+        # in-sequence bulk data segment, None while disabled
+        self.hp_head = None
+        self.hp_window = None
+        self.hp_len = 0
+        self.ack_pending = False
+        # a kept-alive connection gets no FIN at the end of a
+        # response, recv returns what has arrived instead of waiting
+        self.keepalive = False
+        self.fin_received = False
         self.tick = tick
+        self.rto = tick
         self.maxretry = timeout / tick
         self.metrics = Counter(send=0, recv=0, erecv=0,
-                               retry=0, cksumfail=0)
+                               retry=0, cksumfail=0, fastpath=0,
+                               cksumskip=0, fastretx=0)
+        # histograms and time series, None unless metrics are enabled
+        self.stats = get_registry().connection(self.metrics)
+        # ring of the last packets in place of per-packet debug logs,
+        # None unless tracing is enabled
+        self.trace = get_trace()
+        # TCP Fast Open cookies, None unless Fast Open is enabled
+        self.tfo = get_cookie_cache()
 
-    def connect(self, (hostname, port)):
+    def connect(self, (hostname, port), data=''):
         '''
-        Connect to the given hostname and port
+        Connect to the given hostname and port, then send the given
+        data, in the SYN as far as the server takes it if TCP Fast
+        Open is enabled and the server has given us a cookie
         '''
-        self.ip_dest = s.inet_aton(s.gethostbyname(hostname))
+        self.ip_dest = s.inet_aton(self.resolver.resolve(hostname))
         self.port_dest = port
+        if self.stats:
+            self.stats.on_connect(hostname, port)
+        if self.trace:
+            self.trace.endpoints = (self.mac_src, self.mac_gateway,
+                                    self.ip_src, self.ip_dest,
+                                    self.port_src, self.port_dest)
         # 3-way handshake
-        self._tcp_handshake()
+        sent = self._tcp_handshake(data)
+        if sent < len(data):
+            self.send(buffer(data, sent))
 
     def send(self, data=''):
         '''
-        Send all the given data, the TCP congestion control
-        goes here, so that data might be sliced
+        Send all the given data, a string or anything buffer() takes
+        such as an mmap, sliced into segments of the MSS of the path
+        without copying it. The segments go out as far as the
+        congestion window and the peer's window allow, then the ACKs
+        are waited for. Return once the last segment is sent, flush()
+        waits for it to be acknowledged.
         '''
+        if not self.snd_queue:
+            self.snd_una = self.tcp_seq
         slen = 0
         tlen = len(data)
         while slen < tlen:
-            self._send(data[slen:(slen + self.tcp_cwind)], ack=1)
+            inflight = self.tcp_seq - self.snd_una
+            room = min(self.cwnd, self.snd_wnd) - inflight
+            size = min(self.snd_mss, tlen - slen)
+            if room < size and (inflight or room <= 0):
+                self._wait_ack()
+                continue
+            size = min(size, room)
+            self._send(buffer(data, slen, size), ack=1)
+            self.snd_queue.append((self.tcp_seq + size, self.prev_data))
+            if self.rtt_timing is None:
+                self.rtt_timing = (self.tcp_seq + size, time.time())
             # update TCP seq
-            if (slen + self.tcp_cwind) > tlen:
-                self.tcp_seq += (tlen - slen)
-            else:
-                self.tcp_seq += self.tcp_cwind
-            slen += self.tcp_cwind
+            self.tcp_seq += size
+            slen += size
         return tlen
 
+    def flush(self):
+        '''
+        Wait until the peer has acknowledged all the data sent
+        '''
+        while self.snd_queue:
+            self._wait_ack()
+
     def recv(self, bufsize=8192):
         '''
         Receive the data with the given buffer size,
@@ -78,32 +206,41 @@ class RawSocket:
         tcp_data = ''
         times = 1 + bufsize / self.tcp_adwind
         fin = False
+        # data that arrived while flush() waited for its ACKs
+        pending = self.tmp_buf.pop(self.tcp_ack_seq, None)
         while times:
             while rlen < self.tcp_adwind:
-                tcp_segment = self._recv(self.maxretry)
+                if pending is not None:
+                    tcp_segment, pending = pending, None
+                elif rlen and self.keepalive and \
+                        not select([self.socket], [], [], 0)[0]:
+                    if self.ack_pending:
+                        self._send(ack=1)
+                    return ''.join([tcp_data, self._debuf()])
+                else:
+                    tcp_segment = self._recv(self.maxretry)
                 if tcp_segment is None:
                     raise RuntimeError('Connection timeout')
+                elif tcp_segment is PREDICTED:
+                    rlen += self.hp_len
                 elif tcp_segment.tcp_fack:
                     if (tcp_segment.tcp_seq == self.tcp_ack_seq):
-                        self.logger.debug('Recv in-order TCP segment')
                         rlen += self._enbuf(tcp_segment)
-                        self._send(ack=1)
                         if tcp_segment.tcp_ffin:
                             fin = True
-                            break
-                        while self.tcp_ack_seq in self.tmp_buf:
-                            tcp_segment = self.tmp_buf[self.tcp_ack_seq]
+                        while not fin and self.tcp_ack_seq in self.tmp_buf:
+                            tcp_segment = self.tmp_buf.pop(self.tcp_ack_seq)
                             rlen += self._enbuf(tcp_segment)
                             if tcp_segment.tcp_ffin:
                                 fin = True
-                                break
                         self._send(ack=1)
                         if fin:
+                            self.fin_received = True
                             break
-                    elif (tcp_segment.tcp_seq > self.tcp_ack_seq) and \
-                            (tcp_segment.tcp_seq not in self.tmp_buf):
-                        self.logger.debug('Recv out-of-order TCP segment')
-                        self.tmp_buf[tcp_segment.tcp_seq] = tcp_segment
+                        self._predict(tcp_segment)
+                    elif tcp_segment.tcp_seq > self.tcp_ack_seq:
+                        self._queue(tcp_segment)
+                        self.hp_head = None
                 else:
                     continue
             tcp_data = ''.join([tcp_data, self._debuf()])
@@ -116,48 +253,58 @@ class RawSocket:
         '''
         Tear down the raw socket connection
         '''
-        self._tcp_teardown()
-        self.socket.close()
+        try:
+            self._tcp_teardown()
+        finally:
+            self.socket.close()
+            if self.stats:
+                self.stats.close()
 
-    def _get_local_ip(self, iface):
+    def alive(self):
         '''
-        Get the IP address of the local interface
-        NOTE: IP address already encoded
+        Return False if the peer has closed or reset the connection
+        while it sat idle, the frames queued meanwhile get dropped
         '''
+        if self.fin_received:
+            return False
         try:
-            ip = fcntl.ioctl(self.socket.fileno(), 0x8915,
-                             struct.pack('256s', iface[:15]))[20:24]
-            return ip
-        except IOError:
-            raise RuntimeError('Cannot get IP address of local interface %s'
-                               % iface)
+            while select([self.socket], [], [], 0)[0]:
+                tcp_segment = TCPFrame(self.socket.recv(self.bufsize))
+                if tcp_segment.is_tcp() and \
+                        self._ip_expected(tcp_segment) and \
+                        self._tcp_expected(tcp_segment) and \
+                        tcp_segment.tcp_ffin:
+                    return False
+        except RuntimeError:
+            return False
+        return True
 
-    def _get_local_mac(self, iface):
+    def abort(self):
         '''
-        Get tge mac address of the local interface
-        NOTE: MAC address already encoded
+        Reset the connection and close the raw socket, for a
+        connection that cannot be torn down cleanly
         '''
         try:
-            mac = fcntl.ioctl(self.socket.fileno(), 0x8927,
-                              struct.pack('256s', iface[:15]))[18:24]
-            return mac
-        except IOError:
-            raise RuntimeError('Cannot get mac address of local interface %s'
-                               % iface)
+            self._send(rst=1, ack=1)
+        finally:
+            self.socket.close()
+            if self.stats:
+                self.stats.close()
 
-    def _get_gateway_ip(self, iface):
+    def _gateway_mac(self, iface):
         '''
-        Look up the gateway IP address from /proc/net/route
+        Return the gateway MAC, the ARP answer is shared by every
+        connection in the process for ARP_TTL seconds
         '''
-        with open('/proc/net/route') as route_info:
-            for line in route_info:
-                fields = line.strip().split()
-                if fields[0] == iface and fields[1] == '00000000':
-                    return struct.pack('<L', int(fields[2], 16))
-            else:
-                raise RuntimeError('Cannot find the default gateway Ip ' +
-                                   'address in /proc/net/route, please ' +
-                                   'pass the correct network interface name')
+        key = (iface, self.ip_src, self.ip_gateway)
+        with _arp_cache_lock:
+            mac, expiry = _arp_cache.get(key, (None, 0))
+        if time.time() < expiry:
+            return mac
+        mac = self._get_gateway_mac(iface)
+        with _arp_cache_lock:
+            _arp_cache[key] = (mac, time.time() + ARP_TTL)
+        return mac
 
     def _get_gateway_mac(self, iface):
         '''
@@ -192,12 +339,43 @@ class RawSocket:
         self.logger.info('Get gateway MAC address, %s' % arp_packet)
         return arp_packet.arp_sha
 
-    def _tcp_handshake(self):
-        '''
-        Wrap the TCP 3-way handshake procedure
-        '''
-        self._send(syn=1)
-        tcp_segment = self._recv(self.maxretry)
+    def _tcp_handshake(self, data=''):
+        '''
+        Wrap the TCP 3-way handshake procedure, return how many bytes
+        of the given data the server took in the SYN
+        '''
+        isn = self.tcp_seq
+        ip = s.inet_ntoa(self.ip_dest)
+        cookie, syn_data = None, ''
+        opts = mss_option(self.mss)
+        if self.tfo:
+            cookie, cached_mss = self.tfo.lookup(ip)
+        if cookie is not None:
+            # ask for a cookie, or send what fits with ours
+            opts += fastopen_option(cookie)
+            if cookie and data:
+                syn_data = data[:min(cached_mss or DEFAULT_MSS, self.mss)
+                                - len(opts)]
+            else:
+                self.tfo.metrics['request'] += 1
+        self._send(syn_data, syn=1, opts=opts)
+        if syn_data:
+            # a middlebox may drop a SYN with data, RFC 7413 4.1.3.2
+            tcp_segment = self._recv(1)
+            if tcp_segment is None:
+                self.logger.info('TCP Fast Open SYN timeout, retry'
+                                 + ' without it')
+                self.tfo.fail(ip)
+                cookie, syn_data = None, ''
+                self._send(syn=1, opts=mss_option(self.mss))
+                tcp_segment = self._recv(self.maxretry)
+        else:
+            tcp_segment = self._recv(self.maxretry)
+        # the response to the data in the SYN may overtake the SYN-ACK
+        while tcp_segment is not None and tcp_segment.data and \
+                not tcp_segment.tcp_fsyn:
+            self._queue(tcp_segment)
+            tcp_segment = self._recv(self.maxretry)
         # check timeout
         if tcp_segment is None:
             raise RuntimeError('TCP handshake failed, connection timeout')
@@ -207,13 +385,89 @@ class RawSocket:
         # save next ACK seq
         self.tcp_seq = tcp_segment.tcp_ack_seq
         self.tcp_ack_seq = tcp_segment.tcp_seq + 1
+        mss = tcp_option(tcp_segment.tcp_opts, TCPOPT_MSS)
+        peer_mss = struct.unpack('!H', mss)[0] if mss and len(mss) == 2 \
+            else DEFAULT_MSS
+        self.snd_mss = min(self.snd_mss, peer_mss)
+        self.snd_una = self.tcp_seq
+        self.snd_wnd = tcp_segment.tcp_adwind
+        self.cwnd = INIT_CWND * self.snd_mss
+        self.logger.info('TCP MSS: %d, peer MSS: %d, interface MTU: %d'
+                         % (self.mss, peer_mss, self.mtu))
+        # the SYN-ACK acknowledges the data it takes
+        sent = (self.tcp_seq - isn - 1) & 0xffffffff
+        if sent > len(syn_data):
+            sent = 0
+        if cookie is not None:
+            self._fastopen_result(ip, tcp_segment, peer_mss, syn_data, sent)
+        self._build_ack_template()
         self._send(ack=1)
+        return sent
+
+    def _fastopen_result(self, ip, tcp_segment, peer_mss, syn_data, sent):
+        '''
+        Keep the cookie the SYN-ACK carries, if any, and count
+        whether the server took the data of the SYN
+        '''
+        cookie = tcp_option(tcp_segment.tcp_opts, TCPOPT_FASTOPEN)
+        if syn_data:
+            self.tfo.metrics['accepted' if sent else 'rejected'] += 1
+            self.logger.info('TCP Fast Open: %d of %d bytes taken in'
+                             ' the SYN' % (sent, len(syn_data)))
+        if cookie:
+            self.tfo.store(ip, cookie, peer_mss)
+        elif syn_data and not sent:
+            self.tfo.forget(ip)
+
+    def _build_ack_template(self):
+        '''
+        Encode a pure ACK frame for this connection once, so that
+        later ACKs only patch seq, ack_seq and adwind into it
+        '''
+        frame = encode_frame(self.mac_gateway, self.mac_src,
+                             self.ip_src, self.ip_dest,
+                             self.port_src, self.port_dest,
+                             0, 0, ACK, 0, ip_frag_off=IP_DF)
+        frame[TCP_CKSUM_OFFSET:TCP_CKSUM_OFFSET + 2] = '\x00\x00'
+        # the pseudo-header and the TCP header with the variable
+        # fields zeroed never change for the connection
+        self.ack_cksum_base = checksum_add(
+            buffer(frame, TCP_OFFSET),
+            pseudo_header_sum(self.ip_src, self.ip_dest,
+                              len(frame) - TCP_OFFSET))
+        self.ack_frame = frame
+
+    def _send_ack(self):
+        '''
+        Send a pure ACK by patching the pre-encoded frame in place,
+        with the TCP checksum completed from the fixed fields' sum
+        '''
+        frame = self.ack_frame
+        seq = self.tcp_seq & 0xffffffff
+        ack_seq = self.tcp_ack_seq & 0xffffffff
+        adwind = self.tcp_adwind
+        struct.pack_into('!LL', frame, TCP_SEQ_OFFSET, seq, ack_seq)
+        struct.pack_into('!H', frame, TCP_WIN_OFFSET, adwind)
+        cksum = checksum_fold(self.ack_cksum_base + (seq >> 16) +
+                              (seq & 0xffff) + (ack_seq >> 16) +
+                              (ack_seq & 0xffff) + adwind)
+        struct.pack_into('!H', frame, TCP_CKSUM_OFFSET, cksum)
+        if self.trace:
+            self.trace.record(OUTBOUND, seq, ack_seq, ACK, 0)
+        self.metrics['send'] += 1
+        # the template only changes on the next ACK, which would
+        # become the frame to retransmit anyway
+        self.prev_data = frame
+        return self.socket.send(frame)
 
     def _tcp_teardown(self):
         '''
         Tear down the stateful TCP connection before explicitly
         closing the raw socket
         '''
+        # the data still coming in takes the general path, _recv
+        # returns segments, never PREDICTED, from here on
+        self.hp_head = None
         self._send(fin=1, ack=1)
         tcp_segment = self._recv(self.maxretry)
         # check timeout
@@ -222,103 +476,380 @@ class RawSocket:
         # check server ACK
         if not tcp_segment.tcp_fack:
             raise RuntimeError('TCP teardown failed, server not ACK to FIN')
-        tcp_segment = self._recv(self.maxretry)
-        # check server FIN
-        if not tcp_segment.tcp_ffin:
-            raise RuntimeError('TCP teardown failed, server not FIN')
+        # check server FIN, past the ACKs of retransmitted data, the
+        # data still in flight gets acknowledged along with our FIN
+        # again so that the server gets to the end and sends its FIN
+        while not tcp_segment.tcp_ffin:
+            if tcp_segment.data:
+                if tcp_segment.tcp_seq == self.tcp_ack_seq:
+                    self.tcp_ack_seq += len(tcp_segment.data)
+                self._send(fin=1, ack=1)
+            tcp_segment = self._recv(self.maxretry)
+            if tcp_segment is None:
+                raise RuntimeError('TCP teardown failed, server not FIN')
         self.tcp_seq = tcp_segment.tcp_ack_seq
-        self.tcp_ack_seq = tcp_segment.tcp_seq + 1
+        self.tcp_ack_seq = tcp_segment.tcp_seq + len(tcp_segment.data) + 1
         self._send(ack=1)
 
     def _send(self, data='', retry=False, urg=0, ack=0, psh=0,
-              rst=0, syn=0, fin=0):
+              rst=0, syn=0, fin=0, opts=''):
         '''
-        Send the given data within a packet the set TCP flags,
-        return the number of bytes sent.
+        Send the given data within a packet the set TCP flags and
+        options, return the number of bytes sent.
+        Don't fragment is always set for path MTU discovery.
         '''
+        if ack:
+            self.ack_pending = False
         if retry:
+            if self.stats:
+                self.stats.on_retransmit()
+            if self.trace:
+                frame = self.prev_data
+                self.trace.record(OUTBOUND, *TRACE_FIELDS.unpack_from(
+                    frame, TCP_SEQ_OFFSET), length=len(frame) - HDR_LEN)
             return self.socket.send(self.prev_data)
+        elif ack and self.ack_frame is not None and not (
+                data or urg or psh or rst or syn or fin):
+            return self._send_ack()
         else:
-            # build TCP segment
-            tcp_segment = TCPSegment(ip_src_addr=self.ip_src,
-                                     ip_dest_addr=self.ip_dest,
-                                     tcp_src_port=self.port_src,
-                                     tcp_dest_port=self.port_dest,
-                                     tcp_seq=self.tcp_seq,
-                                     tcp_ack_seq=self.tcp_ack_seq,
-                                     tcp_furg=urg, tcp_fack=ack, tcp_fpsh=psh,
-                                     tcp_frst=rst, tcp_fsyn=syn, tcp_ffin=fin,
-                                     tcp_adwind=self.tcp_adwind, data=data)
-            ip_data = tcp_segment.pack()
-            # build IP datagram
-            ip_datagram = IPDatagram(ip_src_addr=self.ip_src,
-                                     ip_dest_addr=self.ip_dest,
-                                     data=ip_data)
-            eth_data = ip_datagram.pack()
-            # build Ethernet Frame
-            eth_frame = EthFrame(dest_mac=self.mac_gateway,
-                                 src_mac=self.mac_src,
-                                 data=eth_data)
-            phy_data = eth_frame.pack()
-            # send raw data
-            self.logger.debug('Send: %s' % tcp_segment)
+            tcp_flags = fin | (syn << 1) | (rst << 2) | (psh << 3) \
+                | (ack << 4) | (urg << 5)
+            seq = self.tcp_seq & 0xffffffff
+            ack_seq = self.tcp_ack_seq & 0xffffffff
+            # encode the whole Ethernet/IP/TCP frame in one pass
+            phy_data = encode_frame(self.mac_gateway, self.mac_src,
+                                    self.ip_src, self.ip_dest,
+                                    self.port_src, self.port_dest,
+                                    seq, ack_seq, tcp_flags,
+                                    self.tcp_adwind, data, opts,
+                                    ip_frag_off=IP_DF)
+            if self.trace:
+                self.trace.record(OUTBOUND, seq, ack_seq, tcp_flags,
+                                  len(data))
             self.metrics['send'] += 1
+            if self.stats and (data or syn or fin):
+                self.stats.on_send(seq, len(data) + syn + fin)
             self.prev_data = phy_data
             return self.socket.send(phy_data)
 
-    def _recv(self, maxretry, bufsize=1500):
+    def _recv(self, maxretry, bufsize=None, timeout=None):
         '''
         Receive a packet with the given buffer size, will not retry
-        for per-packet failure until using up maxretry
+        for per-packet failure until using up maxretry, waiting for
+        the given timeout or a tick each time
         '''
+        bufsize = bufsize or self.bufsize
         while maxretry:
             self.metrics['recv'] += 1
+            # flush the delayed ACK before waiting for more data
+            if self.ack_pending and \
+                    not select([self.socket], [], [], 0)[0]:
+                self._send(ack=1)
             # wait with timeout for the readable socket
-            rsock, wsock, exsock = select([self.socket], [], [], self.tick)
+            rsock, wsock, exsock = select([self.socket], [], [],
+                                          timeout or self.tick)
             # socket is ready to read, no timeout
             if self.socket in rsock:
-                # process Ethernet frame
                 phy_data = self.socket.recv(bufsize)
-                eth_frame = EthFrame()
-                eth_frame.unpack(phy_data)
-                # process IP datagram
-                eth_data = eth_frame.data
-                ip_datagram = IPDatagram(self.ip_src, self.ip_dest)
-                ip_datagram.unpack(eth_data)
+                # fast path for the next in-sequence bulk data segment
+                if phy_data[HP_BEGIN:HP_END] == self.hp_head and \
+                        phy_data[HP_END] in HP_FLAGS and \
+                        phy_data[HP_END + 1:HP_END + 3] == self.hp_window \
+                        and phy_data[12:15] == HP_ETH_IP and \
+                        phy_data[20:22] in NO_FRAG and \
+                        self._deliver_predicted(phy_data):
+                    return PREDICTED
+                csum_valid = self.socket.csum_valid
+                # IP fragments wait for the rest of the datagram
+                if phy_data[20:22] not in NO_FRAG and \
+                        phy_data[12:14] == HP_ETH_IP[:2]:
+                    phy_data = self._reassemble(phy_data)
+                    if phy_data is None:
+                        continue
+                    csum_valid = False
+                # the headers get decoded on first access
+                tcp_segment = TCPFrame(phy_data)
+                if not tcp_segment.is_tcp():
+                    continue
+                if tcp_segment.ip_proto == s.IPPROTO_ICMP:
+                    self._icmp_frag_needed(phy_data)
+                    continue
+                if tcp_segment.data_end > len(phy_data):
+                    # truncated, e.g. coalesced by GRO beyond the MTU,
+                    # take the frame in full when it gets retransmitted
+                    bufsize = self._grow_bufsize(tcp_segment.data_end)
+                    continue
                 # IP filtering
-                if not self._ip_expected(ip_datagram):
+                if not self._ip_expected(tcp_segment):
                     continue
                 # IP checksum
-                if not ip_datagram.verify_checksum():
-                    return self._retry(bufsize, maxretry)
-                # process TCP segment
-                ip_data = ip_datagram.data
-                tcp_segment = TCPSegment(self.ip_src, self.ip_dest)
-                tcp_segment.unpack(ip_data)
+                if not tcp_segment.verify_ip_checksum():
+                    return self._retry(bufsize, maxretry, timeout)
                 # TCP filtering
                 if not self._tcp_expected(tcp_segment):
                     continue
-                # TCP checksum
-                if not tcp_segment.verify_checksum():
+                # TCP checksum, unless the NIC has verified it
+                if csum_valid:
+                    self.metrics['cksumskip'] += 1
+                elif not tcp_segment.verify_checksum():
                     self.metrics['cksumfail'] += 1
-                    return self._retry(bufsize, maxretry)
-                self.logger.debug('Recv: %s' % tcp_segment)
+                    return self._retry(bufsize, maxretry, timeout)
+                if self.trace:
+                    self.trace.record(INBOUND, tcp_segment.tcp_seq,
+                                      tcp_segment.tcp_ack_seq,
+                                      tcp_segment.tcp_flags,
+                                      len(tcp_segment.data))
                 self.metrics['erecv'] += 1
+                if self.stats:
+                    self.stats.on_arrival(
+                        tcp_segment.tcp_adwind, tcp_segment.tcp_ack_seq
+                        if tcp_segment.tcp_fack else None)
                 return tcp_segment
             # timeout, re-_send and re-_recv
             else:
-                return self._retry(bufsize, maxretry)
+                return self._retry(bufsize, maxretry, timeout)
         return None
 
-    def _retry(self, bufsize, maxretry):
+    def _reassemble(self, phy_data):
+        '''
+        Hand a verified IP fragment from the peer to the reassembler,
+        return the frame of the whole datagram once it is complete
+        '''
+        if len(phy_data) < TCP_OFFSET or \
+                phy_data[HP_BEGIN:HP_BEGIN + 4] != self.ip_dest:
+            return None
+        ihl = (ord(phy_data[ETH_HDR_LEN]) & 0x0f) * 4
+        tlen = IP_TLEN.unpack_from(phy_data, ETH_HDR_LEN + 2)[0]
+        if ihl < IP_HDR_LEN or len(phy_data) < ETH_HDR_LEN + tlen or \
+                checksum_fold(checksum_add(
+                    buffer(phy_data, ETH_HDR_LEN, ihl))):
+            return None
+        ip_datagram = self.reassembler.reassemble(
+            phy_data[ETH_HDR_LEN:ETH_HDR_LEN + tlen])
+        if ip_datagram is None:
+            return None
+        self.logger.debug('Reassembled IP datagram of %d bytes'
+                          % len(ip_datagram))
+        return phy_data[:ETH_HDR_LEN] + ip_datagram
+
+    def _grow_bufsize(self, size):
+        self.bufsize = max(self.bufsize, size + LINK_HDR_LEN)
+        self.logger.warn('Truncated frame of %d bytes, receive buffer '
+                         'grown to %d' % (size, self.bufsize))
+        return self.bufsize
+
+    def _icmp_frag_needed(self, phy_data):
+        '''
+        Lower the send MSS on an ICMP fragmentation needed message
+        about one of our segments, RFC 1191
+        '''
+        icmp = phy_data[TCP_OFFSET:]
+        if len(icmp) < 8 + IP_HDR_LEN + 4 or \
+                ord(icmp[0]) != ICMP_DEST_UNREACH or \
+                ord(icmp[1]) != ICMP_FRAG_NEEDED:
+            return
+        # the IP header and the first 8 bytes of the original datagram
+        orig = icmp[8:]
+        orig_ihl = (ord(orig[0]) & 0x0f) * 4
+        if orig[16:20] != self.ip_dest or \
+                orig[orig_ihl:orig_ihl + 4] != struct.pack(
+                    '!HH', self.port_src, self.port_dest):
+            return
+        mtu = struct.unpack('!H', icmp[6:8])[0]
+        if not mtu:
+            # pre RFC 1191 routers leave the next-hop MTU out, guess
+            # the next plateau below the size that did not fit
+            mtu = struct.unpack('!H', orig[2:4])[0] / 2
+        mss = max(mtu, MIN_MTU) - IP_HDR_LEN - TCP_HDR_LEN
+        if mss < self.snd_mss:
+            self.logger.info('Path MTU lowered to %d, MSS: %d'
+                             % (mtu, mss))
+            self.snd_mss = mss
+            # the segments in flight too large for the path got
+            # dropped, resend them sliced rather than on timeout
+            self.rtt_timing = None
+            for frame in self._resegment():
+                self.prev_data = frame
+                self._send(retry=True, ack=1)
+
+    def _resegment(self):
+        '''
+        Slice the segments in flight larger than the send MSS into
+        segments that fit, return the new frames
+        '''
+        frames = []
+        queue = deque()
+        for end, frame in self.snd_queue:
+            size = len(frame) - HDR_LEN
+            if size <= self.snd_mss:
+                queue.append((end, frame))
+                continue
+            seq = end - size
+            for offset in range(0, size, self.snd_mss):
+                data = buffer(frame, HDR_LEN + offset, self.snd_mss)
+                frames.append(encode_frame(
+                    self.mac_gateway, self.mac_src, self.ip_src,
+                    self.ip_dest, self.port_src, self.port_dest,
+                    (seq + offset) & 0xffffffff,
+                    self.tcp_ack_seq & 0xffffffff, ACK, self.tcp_adwind,
+                    data, ip_frag_off=IP_DF))
+                queue.append((seq + offset + len(data), frames[-1]))
+        self.snd_queue = queue
+        return frames
+
+    def _predict(self, tcp_segment):
+        '''
+        Expect the next segment to carry in-sequence data with only
+        ACK (and maybe PSH) set and the window of the given segment,
+        unless out-of-order segments are waiting to be merged
+        '''
+        if self.tmp_buf:
+            self.hp_head = None
+            return
+        # the segment may come out of the reorder queue, frameless
+        self.hp_window = HP_WINDOW.pack(tcp_segment.tcp_adwind)
+        self._predict_next()
+
+    def _predict_next(self):
+        self.hp_head = ''.join([
+            self.ip_dest, self.ip_src,
+            struct.pack('!HH', self.port_dest, self.port_src),
+            HP_SEQS.pack(self.tcp_ack_seq & 0xffffffff,
+                         self.tcp_seq & 0xffffffff), '\x50'])
+
+    def _deliver_predicted(self, phy_data):
+        '''
+        Verify the checksums of a predicted segment, then append its
+        payload and ACK every second one, return False to leave the
+        segment to the general path
+        '''
+        tlen = IP_TLEN.unpack_from(phy_data, ETH_HDR_LEN + 2)[0]
+        tcp_len = tlen - IP_HDR_LEN
+        # pure ACKs and window updates take the general path
+        if tcp_len <= TCP_HDR_LEN or len(phy_data) < ETH_HDR_LEN + tlen:
+            return False
+        if checksum_fold(sum(IP_HDR_WORDS.unpack_from(phy_data,
+                                                      ETH_HDR_LEN))):
+            return False
+        if self.socket.csum_valid:
+            self.metrics['cksumskip'] += 1
+        elif checksum_fold(checksum_add(
+                buffer(phy_data, TCP_OFFSET, tcp_len),
+                pseudo_header_sum(self.ip_dest, self.ip_src, tcp_len))):
+            return False
+        payload = phy_data[HDR_LEN:ETH_HDR_LEN + tlen]
+        if self.trace:
+            self.trace.record(INBOUND, self.tcp_ack_seq, self.tcp_seq,
+                              ord(phy_data[HP_END]), len(payload))
+        self.recv_buf.append(payload)
+        self.hp_len = len(payload)
+        self.tcp_ack_seq += self.hp_len
+        self.metrics['erecv'] += 1
+        self.metrics['fastpath'] += 1
+        if self.stats:
+            # the window and the ACK are the predicted ones
+            self.stats.on_arrival()
+            self.stats.on_deliver(self.hp_len)
+        self._predict_next()
+        if self.ack_pending:
+            self._send(ack=1)
+        else:
+            self.ack_pending = True
+        return True
+
+    def _wait_ack(self):
+        '''
+        Receive the next segment while data is in flight and take
+        its ACK: slide the window, grow the congestion window, and
+        retransmit on three duplicate ACKs, on a partial ACK after
+        a loss (NewReno) or on timeout, with exponential backoff.
+        The peer's data is kept for recv.
+        '''
+        timeouts = 0
+        while True:
+            # a single wait, the oldest segment gets retransmitted
+            # when it times out, not whatever went out last
+            tcp_segment = self._recv(1, timeout=self.rto)
+            if tcp_segment is not None:
+                break
+            timeouts += 1
+            if timeouts >= self.maxretry:
+                raise RuntimeError('Connection timeout')
+            if timeouts == 1:
+                self._loss()
+            self.cwnd = self.snd_mss
+            self.rto = min(self.rto * 2, self.tick)
+            if self.snd_queue:
+                self.metrics['retry'] += 1
+                self._retransmit()
+        if tcp_segment is PREDICTED:
+            return
+        if (tcp_segment.data or tcp_segment.tcp_ffin) and \
+                tcp_segment.tcp_seq >= self.tcp_ack_seq:
+            self._queue(tcp_segment)
+        if not tcp_segment.tcp_fack:
+            return
+        self.snd_wnd = tcp_segment.tcp_adwind
+        acked = (tcp_segment.tcp_ack_seq - self.snd_una) & 0xffffffff
+        if 0 < acked <= self.tcp_seq - self.snd_una:
+            self.snd_una += acked
+            self.dupacks = 0
+            if self.rtt_timing and self.rtt_timing[0] <= self.snd_una:
+                self._update_rto(time.time() - self.rtt_timing[1])
+                self.rtt_timing = None
+            while self.snd_queue and self.snd_queue[0][0] <= self.snd_una:
+                self.snd_queue.popleft()
+            if self.snd_una < self.recover and self.snd_queue:
+                # partial ACK, the next segment is lost as well
+                self._retransmit()
+            elif self.cwnd < self.ssthresh:
+                self.cwnd += min(acked, self.snd_mss)
+            else:
+                self.cwnd += max(1, self.snd_mss * self.snd_mss / self.cwnd)
+        elif not acked and self.snd_queue and not tcp_segment.data:
+            self.dupacks += 1
+            # not again for the losses of the window in recovery
+            if self.dupacks == 3 and self.snd_una >= self.recover:
+                self.metrics['fastretx'] += 1
+                self._loss()
+                self._retransmit()
+        if self.stats:
+            self.stats.on_cwnd(self.cwnd)
+
+    def _update_rto(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), self.tick)
+
+    def _loss(self):
+        self.recover = self.tcp_seq
+        self.ssthresh = max((self.tcp_seq - self.snd_una) / 2,
+                            2 * self.snd_mss)
+        self.cwnd = self.ssthresh
+
+    def _retransmit(self):
+        # Karn's algorithm, the RTT of a retransmission is ambiguous
+        self.rtt_timing = None
+        self.prev_data = self.snd_queue[0][1]
+        self._send(retry=True, ack=1)
+
+    def _retry(self, bufsize, maxretry, timeout=None):
         '''
         Re-_send and re-_recv with the maxretry -1
         Mutual recursion with self._recv(bufsize)
+        Nothing waits for a resend after the last try, _wait_ack
+        retransmits the data in flight itself
         '''
-        self.metrics['retry'] += 1
         maxretry -= 1
+        if not maxretry:
+            return None
+        self.metrics['retry'] += 1
         self._send(retry=True, ack=1)
-        return self._recv(bufsize, maxretry)
+        return self._recv(maxretry, bufsize, timeout)
 
     def _enbuf(self, tcp_segment):
         '''
@@ -326,20 +857,29 @@ class RawSocket:
         '''
         self.recv_buf.append(tcp_segment.data)
         elen = len(tcp_segment.data)
+        if self.stats:
+            self.stats.on_deliver(elen)
         self.tcp_seq = tcp_segment.tcp_ack_seq
         self.tcp_ack_seq += elen
         # self._send(ack=1)
         return elen
 
+    def _queue(self, tcp_segment):
+        '''
+        Keep an out-of-order segment for later, its frame dropped
+        '''
+        if tcp_segment.tcp_seq not in self.tmp_buf:
+            self.tmp_buf[tcp_segment.tcp_seq] = tcp_segment.detach()
+
     def _debuf(self):
         '''
-        Dump all cached TCP payload out from the recv buffer
+        Dump all cached TCP payload out from the recv buffer,
+        the out-of-order segments are kept for the next call
         '''
-        tcp_data = ''
-        for slice in self.recv_buf:
-            tcp_data = ''.join([tcp_data, slice])
+        tcp_data = ''.join(self.recv_buf)
         del self.recv_buf[:]
-        self.tmp_buf.clear()
+        for seq in [seq for seq in self.tmp_buf if seq < self.tcp_ack_seq]:
+            del self.tmp_buf[seq]
         return tcp_data
 
     def _ip_expected(self, ip_datagram):
@@ -383,4 +923,7 @@ class RawSocket:
         '''
         dump = '\n'.join('\t%s: %d' % (k, v) for (k, v)
                          in self.metrics.items())
+        dump += '\n\tfastpath_rate: %.2f' % (
+            self.metrics['fastpath'] / float(self.metrics['erecv'])
+            if self.metrics['erecv'] else 0)
         return dump, self.metrics
@@ -8,10 +8,16 @@ TCP_HDR_FMT = '!HHLLBBHHH'
 TCP_PSH_FMT = '!4s4sBBH'
 
 
-class TCPSegment:
+class TCPSegment(object):
     '''
     Simple Python model for a TCP segment
     '''
+    __slots__ = ('ip_src_addr', 'ip_dest_addr', 'zeros', 'protocol',
+                 'tcp_len', 'tcp_src_port', 'tcp_dest_port', 'tcp_seq',
+                 'tcp_ack_seq', 'tcp_doff', 'tcp_resvd', 'tcp_ffin',
+                 'tcp_fsyn', 'tcp_frst', 'tcp_fpsh', 'tcp_fack', 'tcp_furg',
+                 'tcp_adwind', 'tcp_cksum', 'tcp_urg_ptr', 'tcp_opts', 'data')
+
     def __init__(self, ip_src_addr, ip_dest_addr, tcp_src_port=12138,
                  tcp_dest_port=80, tcp_seq=1, tcp_ack_seq=0, tcp_doff=5,
                  tcp_furg=0, tcp_fack=1, tcp_fpsh=0, tcp_frst=0, tcp_fsyn=0,
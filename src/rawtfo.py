@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import threading
+from collections import Counter
+
+from logger import get_logger
+
+# the cookies of the servers last 1 day like the Linux ones, a
+# server that dropped a SYN with data is left alone for 1 hour
+COOKIE_TTL = 86400
+FAILED_TTL = 3600
+# cookie sizes allowed by RFC 7413
+MIN_COOKIE = 4
+MAX_COOKIE = 16
+PART = '.part'
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def enable(path):
+    '''
+    Turn TCP Fast Open on for the connections opened from now on,
+    with the cookies persisted in the given file
+    '''
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.path != path:
+            _cache = CookieCache(path)
+        return _cache
+
+
+def disable():
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def get_cookie_cache():
+    '''
+    Return the shared CookieCache, None while TCP Fast Open is off
+    '''
+    return _cache
+
+
+class CookieCache:
+    '''
+    The TCP Fast Open cookies of the servers, by server IP, with the
+    MSS they announced (RFC 7413 4.1.1). A SYN to a server without a
+    cookie asks for one, a SYN to a server with one carries data. The
+    servers that dropped a SYN with data are not asked again for a
+    while (RFC 7413 4.1.3.2). The file is rewritten on every change.
+    '''
+    def __init__(self, path):
+        self.logger = get_logger(os.path.basename(__file__))
+        self.path = path
+        self.lock = threading.Lock()
+        self.metrics = Counter(request=0, cookie=0, accepted=0,
+                               rejected=0, fallback=0)
+        self.entries = self._load()
+
+    def lookup(self, ip):
+        '''
+        Return (cookie, MSS) for the given server IP, the cookie is
+        '' to ask for one and None if Fast Open is not to be tried
+        '''
+        with self.lock:
+            entry = self.entries.get(ip)
+            if entry is None or time.time() > entry['expires']:
+                return '', None
+            if entry['failed']:
+                return None, None
+            return entry['cookie'].decode('hex'), entry['mss']
+
+    def store(self, ip, cookie, mss):
+        if not MIN_COOKIE <= len(cookie) <= MAX_COOKIE or len(cookie) % 2:
+            self.logger.warn('Invalid Fast Open cookie from %s' % ip)
+            return
+        self.metrics['cookie'] += 1
+        self._update(ip, dict(cookie=cookie.encode('hex'), mss=mss,
+                              failed=False,
+                              expires=time.time() + COOKIE_TTL))
+
+    def forget(self, ip):
+        '''
+        Drop the cookie of the server, e.g. it has been rejected
+        without a new one, the next SYN asks for one again
+        '''
+        with self.lock:
+            if self.entries.pop(ip, None) is None:
+                return
+            self._save()
+
+    def fail(self, ip):
+        '''
+        The SYN with data got no answer, don't try again for a while
+        '''
+        self.metrics['fallback'] += 1
+        self._update(ip, dict(cookie='', mss=None, failed=True,
+                              expires=time.time() + FAILED_TTL))
+
+    def dump_metrics(self):
+        '''
+        Dump the metrics counters for debug usage
+        '''
+        dump = '\n'.join('\t%s: %d' % (k, v) for (k, v)
+                         in self.metrics.items())
+        return dump, self.metrics
+
+    def _update(self, ip, entry):
+        with self.lock:
+            if self.entries.get(ip) == entry:
+                return
+            self.entries[ip] = entry
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            self.logger.warn('Corrupted Fast Open cookies, starting over')
+            return {}
+        now = time.time()
+        return dict((ip, entry) for ip, entry in entries.items()
+                    if entry['expires'] > now)
+
+    def _save(self):
+        try:
+            with open(self.path + PART, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(self.path + PART, self.path)
+        except (IOError, OSError) as e:
+            self.logger.warn('Cannot save the Fast Open cookies: %s' % e)
@@ -0,0 +1,135 @@
+import time
+import threading
+from struct import Struct
+from collections import deque
+
+from rawpcap import PcapWriter, INBOUND, OUTBOUND
+from rawcodec import encode_frame, HDR_LEN
+
+# timestamp, direction, seq, ack_seq, flags, payload length
+RECORD = Struct('<dBLLBL')
+TRACE_SIZE = 4096
+# the traces of the last connections kept for a dump
+TRACE_KEEP = 16
+FLAGS = 'FSRPAU'
+DIRECTIONS = {INBOUND: '<', OUTBOUND: '>'}
+NO_ENDPOINTS = ('\x00' * 6, '\x00' * 6, '\x00' * 4, '\x00' * 4, 0, 0)
+
+_size = 0
+_traces = deque(maxlen=TRACE_KEEP)
+_lock = threading.Lock()
+
+
+def enable(size=TRACE_SIZE):
+    '''
+    Give every connection opened from now on a trace of the given
+    number of records, 0 turns tracing off
+    '''
+    global _size
+    _size = size
+
+
+def get_trace():
+    '''
+    Return a new TraceBuffer for a connection, None while disabled
+    '''
+    if not _size:
+        return None
+    trace = TraceBuffer(_size)
+    with _lock:
+        _traces.append(trace)
+    return trace
+
+
+def recent_traces():
+    with _lock:
+        return list(_traces)
+
+
+class TraceBuffer:
+    '''
+    Fixed-size ring of the packets of one connection, packed as
+    binary records and only decoded when dumped, the oldest records
+    get overwritten
+    '''
+    def __init__(self, size=TRACE_SIZE):
+        self.size = size
+        self.buf = bytearray(size * RECORD.size)
+        self.pos = 0
+        self.count = 0
+        # (local MAC, gateway MAC, local IP, peer IP, local port,
+        # peer port), only needed to dump to pcap-ng
+        self.endpoints = NO_ENDPOINTS
+
+    def record(self, direction, seq, ack_seq, flags, length):
+        RECORD.pack_into(self.buf, self.pos * RECORD.size, time.time(),
+                         direction, seq & 0xffffffff, ack_seq & 0xffffffff,
+                         flags, length)
+        self.pos += 1
+        if self.pos == self.size:
+            self.pos = 0
+        self.count += 1
+
+    def records(self):
+        '''
+        Return the records still in the ring, oldest first
+        '''
+        if self.count < self.size:
+            slots = range(self.count)
+        else:
+            slots = range(self.pos, self.size) + range(self.pos)
+        return [RECORD.unpack_from(self.buf, slot * RECORD.size)
+                for slot in slots]
+
+    def header(self):
+        mac_src, mac_dest, ip_src, ip_dest, port_src, port_dest = \
+            self.endpoints
+        return '%s:%d > %s:%d, %d packets, %d overwritten' % (
+            '.'.join(str(ord(c)) for c in ip_src), port_src,
+            '.'.join(str(ord(c)) for c in ip_dest), port_dest,
+            self.count, max(0, self.count - self.size))
+
+
+def format_record(record):
+    ts, direction, seq, ack_seq, flags, length = record
+    return '%.6f %s seq: %d, ack_seq: %d, flags: %s, len: %d' % (
+        ts, DIRECTIONS.get(direction, '?'), seq, ack_seq,
+        ''.join(f if flags & (1 << i) else '.'
+                for i, f in enumerate(FLAGS)), length)
+
+
+def dump_text(out, traces=None):
+    '''
+    Write the given traces, the recent ones by default, as text
+    '''
+    for trace in recent_traces() if traces is None else traces:
+        out.write('# %s\n' % trace.header())
+        for record in trace.records():
+            out.write(format_record(record) + '\n')
+
+
+def dump_pcap(path, traces=None):
+    '''
+    Write the given traces, the recent ones by default, to a pcap-ng
+    file, one header-only frame per record with the record as its
+    comment and the payload length in the original frame length
+    '''
+    writer = PcapWriter(path)
+    try:
+        for trace in recent_traces() if traces is None else traces:
+            mac_src, mac_dest, ip_src, ip_dest, port_src, port_dest = \
+                trace.endpoints
+            for record in trace.records():
+                ts, direction, seq, ack_seq, flags, length = record
+                if direction == OUTBOUND:
+                    frame = encode_frame(mac_dest, mac_src, ip_src, ip_dest,
+                                         port_src, port_dest, seq, ack_seq,
+                                         flags, 0)
+                else:
+                    frame = encode_frame(mac_src, mac_dest, ip_dest, ip_src,
+                                         port_dest, port_src, seq, ack_seq,
+                                         flags, 0)
+                writer.write(frame, direction, format_record(record), ts,
+                             origlen=HDR_LEN + length)
+    finally:
+        writer.close()
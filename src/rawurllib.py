@@ -7,20 +7,50 @@ DEF_URI = '/'
 DEF_FILE_NAME = 'index.html'
 
 
-def urlretrieve(url, port, directory, iface='eth0', reporthook=None):
+def urlretrieve(url, port, directory, iface='eth0', reporthook=None,
+                compress=True, cache=None, pool=None):
     '''
     Retrieve the file at the given url to local with
-    the given filename
+    the given filename, a gzip or deflate encoded body
+    gets decoded while it streams to the file. If an
+    HttpCache is given the file is revalidated, resumed
+    or served from it, if a ConnectionPool is given an
+    idle connection to the host gets reused. As with
+    urllib, reporthook(count, block size, total size)
+    gets called once the response has begun and after
+    each block written, the total size is -1 if unknown
     '''
     hostname, uri, filename = _parse_url(url)
-    client = C.HttpClient(hostname, port, iface)
-    rc, headers, content = client.GET(uri)
+    client = C.HttpClient(hostname, port, iface, compress, pool)
     filepath = '/'.join([directory, filename])
+    if cache is not None:
+        cache.retrieve(client, url, uri, filepath, reporthook)
+        return filepath
     with open(filepath, 'w') as f:
-        f.write(content)
+        write, on_response = f.write, None
+        if reporthook is not None:
+            write, on_response = _hooks(f.write, reporthook)
+        client.retrieve(uri, write, on_response=on_response)
     return filepath
 
 
+def _hooks(write, reporthook):
+    '''
+    Return the write and on_response callbacks calling reporthook
+    '''
+    state = {'count': 0, 'total': -1}
+
+    def on_response(rc, headers):
+        state['total'] = int(headers.get('Content-Length', -1))
+        reporthook(0, 0, state['total'])
+
+    def hooked_write(block):
+        write(block)
+        state['count'] += 1
+        reporthook(state['count'], len(block), state['total'])
+    return hooked_write, on_response
+
+
 def _parse_url(url):
     '''
     Return the host name, uri and file name in the
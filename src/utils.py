@@ -1,4 +1,6 @@
+import sys
 import time as t
+from array import array
 
 
 class Timer:
@@ -19,17 +21,33 @@ def checksum(data):
     The algorithm comes from:
     http://en.wikipedia.org/wiki/IPv4_header_checksum
     '''
-    sum = 0
-    # pick up 16 bits (2 WORDs) every time
-    for i in range(0, len(data), 2):
-        # Sum up the ordinal of each WORD with
-        # network bits order (big-endian)
-        if i < len(data) and (i + 1) < len(data):
-            sum += (ord(data[i]) + (ord(data[i + 1]) << 8))
-        elif i < len(data) and (i + 1) == len(data):
-            sum += ord(data[i])
-    addon_carry = (sum & 0xffff) + (sum >> 16)
-    result = (~ addon_carry) & 0xffff
-    # swap bytes
-    result = result >> 8 | ((result & 0x00ff) << 8)
-    return result
+    return checksum_fold(checksum_add(data))
+
+
+def checksum_add(data, initial=0):
+    '''
+    Return the one's complement sum of the given data as 16-bit
+    big-endian words added to initial, unfolded. An odd trailing
+    byte is padded with zero, so only the last part may be odd.
+    Partial sums of the fixed parts of a header can be kept
+    and completed with the fields that change, see RFC 1624.
+    '''
+    size = len(data)
+    words = array('H')
+    words.fromstring(buffer(data, 0, size & ~1))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    initial += sum(words)
+    if size & 1:
+        initial += ord(buffer(data, size - 1)[0]) << 8
+    return initial
+
+
+def checksum_fold(sum):
+    '''
+    Fold the carries of a checksum_add sum and complement it,
+    return the checksum ready to be packed in network order
+    '''
+    sum = (sum & 0xffff) + (sum >> 16)
+    sum = (sum & 0xffff) + (sum >> 16)
+    return (~ sum) & 0xffff
@@ -0,0 +1,107 @@
+'''
+HttpCache with a scripted client, no network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+import HttpCache as H
+from HttpCache import HttpCache
+
+URL = 'http://sim.test/a.bin'
+BODY = os.urandom(30000)
+BLOCK = 8192
+
+
+def setUpModule():
+    init_logger(None, 0)
+
+
+class Client:
+    '''
+    Answers 200 with BODY in blocks, or 304 to a request carrying
+    the ETag of BODY
+    '''
+    def retrieve(self, uri, write, headers=None, on_response=None):
+        if (headers or {}).get('If-None-Match') == '"v1"':
+            on_response('304', {'ETag': '"v1"'})
+            return '304', {}
+        on_response('200', {'ETag': '"v1"',
+                            'Content-Length': str(len(BODY))})
+        for offset in range(0, len(BODY), BLOCK):
+            write(BODY[offset:offset + BLOCK])
+        return '200', {}
+
+
+class ReportHookTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = HttpCache(os.path.join(self.directory, 'cache'))
+        self.filepath = os.path.join(self.directory, 'a.bin')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reporthook(self, count, size, total):
+        self.calls.append((count, size, total))
+
+    def retrieve(self):
+        rc = self.cache.retrieve(Client(), URL, '/a.bin', self.filepath,
+                                 self.reporthook)
+        with open(self.filepath, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+        return rc
+
+    def test_miss_reports_every_block(self):
+        self.assertEqual(self.retrieve(), '200')
+        self.assertEqual(self.calls, [(0, 0, len(BODY)),
+                                      (1, BLOCK, len(BODY)),
+                                      (2, BLOCK, len(BODY)),
+                                      (3, BLOCK, len(BODY)),
+                                      (4, len(BODY) - 3 * BLOCK,
+                                       len(BODY))])
+
+    def test_hit_reports_the_body_served_from_disk(self):
+        self.retrieve()
+        del self.calls[:]
+        self.assertEqual(self.retrieve(), '304')
+        self.assertEqual(self.calls, [(0, 0, len(BODY)),
+                                      (1, len(BODY), len(BODY))])
+
+
+class LockTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = HttpCache(os.path.join(self.directory, 'cache'))
+        self.copyfile = H.shutil.copyfile
+        H.shutil.copyfile = self.copy
+
+    def tearDown(self):
+        H.shutil.copyfile = self.copyfile
+        shutil.rmtree(self.directory)
+
+    def copy(self, src, dst):
+        # another URL could take the cache lock meanwhile
+        self.assertTrue(self.cache.lock.acquire(False))
+        self.cache.lock.release()
+        self.copyfile(src, dst)
+
+    def test_copy_leaves_the_cache_lock_free(self):
+        filepath = os.path.join(self.directory, 'a.bin')
+        self.assertEqual(self.cache.retrieve(Client(), URL, '/a.bin',
+                                             filepath), '200')
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertTrue(self.cache.index[URL]['atime'])
+
+
+if __name__ == '__main__':
+    unittest.main()
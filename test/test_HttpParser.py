@@ -0,0 +1,138 @@
+'''
+ResponseParser and ContentDecoder, no network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import zlib
+import gzip
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from HttpParser import ResponseParser, ContentDecoder
+
+TEXT = ''.join('line %d of the body\n' % i for i in range(5000))
+
+
+def setUpModule():
+    init_logger(None, 0)
+
+
+def gzipped(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+def raw_deflated(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def split(data, first):
+    '''
+    The first chunk of the given size, the rest in chunks of 1000
+    '''
+    return [data[:first]] + [data[i:i + 1000]
+                             for i in range(first, len(data), 1000)]
+
+
+class ContentDecoderTest(unittest.TestCase):
+    def decode(self, encoding, body, first):
+        out = []
+        decoder = ContentDecoder(encoding, out.append, max_chunk=4096)
+        for chunk in split(body, first):
+            decoder.feed(chunk)
+        decoder.flush()
+        self.assertTrue(max(len(chunk) for chunk in out) <= 4096)
+        return ''.join(out)
+
+    def test_gzip(self):
+        for first in (1, 2, 10, 100):
+            self.assertEqual(self.decode('gzip', gzipped(TEXT), first),
+                             TEXT)
+
+    def test_zlib_deflate(self):
+        for first in (1, 2, 100):
+            self.assertEqual(self.decode('deflate', zlib.compress(TEXT),
+                                         first), TEXT)
+
+    def test_raw_deflate_split_anywhere_in_its_head(self):
+        for first in (1, 2, 3, 100):
+            self.assertEqual(self.decode('deflate', raw_deflated(TEXT),
+                                         first), TEXT)
+
+    def test_garbage_fails(self):
+        self.assertRaises(RuntimeError, self.decode, 'gzip',
+                          os.urandom(100), 1)
+        self.assertRaises(RuntimeError, self.decode, 'deflate',
+                          '\xff' * 100, 1)
+
+
+class ResponseParserTest(unittest.TestCase):
+    def parse(self, response, size=7, close=False):
+        parser = ResponseParser()
+        events = []
+        for i in range(0, len(response), size):
+            events.extend(parser.feed(response[i:i + size]))
+        if close:
+            events.extend(parser.finish())
+        body = ''.join(data for kind, data in events if kind == 'body')
+        kinds = [kind for kind, data in events if kind != 'body']
+        return parser, kinds, body, dict(events)
+
+    def test_content_length(self):
+        parser, kinds, body, events = self.parse(
+            'HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\nhello world')
+        self.assertEqual(kinds, ['status', 'headers', 'done'])
+        self.assertEqual(events['status'], ('HTTP/1.1', '200', 'OK'))
+        self.assertEqual(body, 'hello world')
+        self.assertTrue(parser.keep_alive)
+
+    def test_chunked_with_trailers(self):
+        parser, kinds, body, events = self.parse(
+            'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            '5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Sum: 1\r\n\r\n')
+        self.assertEqual(kinds, ['status', 'headers', 'trailers', 'done'])
+        self.assertEqual(body, 'hello world')
+        self.assertEqual(events['trailers']['x-sum'], '1')
+        self.assertTrue(parser.keep_alive)
+
+    def test_close_delimited(self):
+        response = 'HTTP/1.0 200 OK\r\nServer: x\r\n\r\n' + TEXT
+        parser, kinds, body, events = self.parse(response, size=1000)
+        self.assertEqual(kinds, ['status', 'headers'])
+        self.assertFalse(parser.done)
+        parser, kinds, body, events = self.parse(response, size=1000,
+                                                 close=True)
+        self.assertEqual(kinds, ['status', 'headers', 'done'])
+        self.assertEqual(body, TEXT)
+        self.assertFalse(parser.keep_alive)
+
+    def test_interim_and_bodiless_responses(self):
+        parser, kinds, body, events = self.parse(
+            'HTTP/1.1 100 Continue\r\n\r\n'
+            'HTTP/1.1 304 Not Modified\r\nContent-Length: 99\r\n\r\n')
+        self.assertEqual(kinds, ['status', 'headers', 'status', 'headers',
+                                 'done'])
+        self.assertEqual(body, '')
+
+    def test_cut_short_and_malformed(self):
+        parser = ResponseParser()
+        parser.feed('HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc')
+        self.assertRaises(RuntimeError, parser.finish)
+        self.assertRaises(RuntimeError, ResponseParser().feed,
+                          'SMTP ready\r\n')
+        self.assertRaises(RuntimeError, ResponseParser().feed,
+                          'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked'
+                          '\r\n\r\nzz\r\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+'''
+encode_frame and TCPFrame against the EthFrame, IPDatagram and
+TCPSegment models, no network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import socket
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rawethernet import EthFrame
+from rawip import IPDatagram
+from rawtcp import TCPSegment
+from rawcodec import encode_frame, mss_option, tcp_option, TCPFrame, \
+    TCPOPT_MSS, FIN, SYN, PSH, ACK
+
+DEST_MAC = '\x02\x00\x00\x00\x00\x02'
+SRC_MAC = '\x02\x00\x00\x00\x00\x01'
+SRC = socket.inet_aton('10.0.0.1')
+DEST = socket.inet_aton('10.0.0.2')
+# the flags, the payload
+SEGMENTS = [(SYN, ''), (ACK, ''), (ACK | PSH, 'GET / HTTP/1.1\r\n\r\n'),
+            (ACK, os.urandom(1460)), (ACK, os.urandom(1461)),
+            (ACK | FIN, 'x')]
+
+
+def layered(flags, data, seq=1000, ack_seq=2000, adwind=29200):
+    '''
+    The frame packed layer by layer with the models
+    '''
+    segment = TCPSegment(SRC, DEST, tcp_src_port=40000, tcp_dest_port=80,
+                         tcp_seq=seq, tcp_ack_seq=ack_seq,
+                         tcp_ffin=flags & FIN, tcp_fsyn=(flags & SYN) >> 1,
+                         tcp_fpsh=(flags & PSH) >> 3,
+                         tcp_fack=(flags & ACK) >> 4, tcp_adwind=adwind,
+                         data=data)
+    datagram = IPDatagram(SRC, DEST, data=segment.pack())
+    return EthFrame(DEST_MAC, SRC_MAC, data=datagram.pack()).pack()
+
+
+def encoded(flags, data, seq=1000, ack_seq=2000, adwind=29200, opts=''):
+    return str(encode_frame(DEST_MAC, SRC_MAC, SRC, DEST, 40000, 80, seq,
+                            ack_seq, flags, adwind, data, opts))
+
+
+class EncodeTest(unittest.TestCase):
+    def test_same_bytes_as_the_models(self):
+        for flags, data in SEGMENTS:
+            self.assertEqual(encoded(flags, data), layered(flags, data))
+
+    def test_models_unpack_and_verify_the_frame(self):
+        for flags, data in SEGMENTS:
+            eth = EthFrame()
+            eth.unpack(encoded(flags, data, opts=mss_option(1460)))
+            ip = IPDatagram('', '')
+            ip.unpack(eth.data)
+            self.assertTrue(ip.verify_checksum())
+            self.assertEqual((ip.ip_src_addr, ip.ip_dest_addr, ip.ip_id,
+                              ip.ip_ttl, ip.ip_proto),
+                             (SRC, DEST, 54321, 255, socket.IPPROTO_TCP))
+            tcp = TCPSegment(ip.ip_src_addr, ip.ip_dest_addr)
+            tcp.unpack(ip.data)
+            self.assertTrue(tcp.verify_checksum())
+            self.assertEqual((tcp.tcp_seq, tcp.tcp_ack_seq, tcp.tcp_doff,
+                              tcp.tcp_adwind, tcp.data),
+                             (1000, 2000, 6, 29200, data))
+
+
+class TCPFrameTest(unittest.TestCase):
+    def assertSameFields(self, frame, flags, data):
+        eth = EthFrame()
+        eth.unpack(frame)
+        ip = IPDatagram('', '')
+        ip.unpack(eth.data)
+        tcp = TCPSegment(ip.ip_src_addr, ip.ip_dest_addr)
+        tcp.unpack(ip.data)
+        view = TCPFrame(frame)
+        self.assertTrue(view.is_tcp())
+        self.assertEqual(
+            (view.eth_tcode, view.ip_ver, view.ip_ihl, view.ip_tlen,
+             view.ip_id, view.ip_frag_off, view.ip_proto,
+             view.ip_src_addr, view.ip_dest_addr),
+            (eth.eth_tcode, ip.ip_ver, ip.ip_ihl, ip.ip_tlen, ip.ip_id,
+             ip.ip_frag_off, ip.ip_proto, ip.ip_src_addr,
+             ip.ip_dest_addr))
+        self.assertEqual(
+            (view.tcp_src_port, view.tcp_dest_port, view.tcp_seq,
+             view.tcp_ack_seq, view.tcp_doff, view.tcp_adwind,
+             view.tcp_ffin, view.tcp_fsyn, view.tcp_frst, view.tcp_fpsh,
+             view.tcp_fack, view.tcp_furg),
+            (tcp.tcp_src_port, tcp.tcp_dest_port, tcp.tcp_seq,
+             tcp.tcp_ack_seq, tcp.tcp_doff, tcp.tcp_adwind, tcp.tcp_ffin,
+             tcp.tcp_fsyn, tcp.tcp_frst, tcp.tcp_fpsh, tcp.tcp_fack,
+             tcp.tcp_furg))
+        self.assertEqual(view.data, data)
+        self.assertTrue(view.verify_ip_checksum())
+        self.assertTrue(view.verify_checksum())
+
+    def test_same_fields_as_the_models(self):
+        for flags, data in SEGMENTS:
+            self.assertSameFields(layered(flags, data), flags, data)
+
+    def test_options(self):
+        frame = encoded(SYN, '', opts=mss_option(1400))
+        self.assertSameFields(frame, SYN, '')
+        view = TCPFrame(frame)
+        self.assertEqual(view.tcp_opts, mss_option(1400))
+        self.assertEqual(tcp_option(view.tcp_opts, TCPOPT_MSS),
+                         struct.pack('!H', 1400))
+
+    def test_ethernet_padding_is_not_payload(self):
+        frame = encoded(ACK, 'x') + '\x00' * 5
+        self.assertEqual(len(frame), 60)
+        self.assertSameFields(frame, ACK, 'x')
+
+    def test_checksums_catch_a_flipped_byte(self):
+        frame = bytearray(encoded(ACK | PSH, 'hello'))
+        frame[-1] ^= 0x01
+        self.assertFalse(TCPFrame(str(frame)).verify_checksum())
+        frame[-1] ^= 0x01
+        frame[22] ^= 0x01
+        self.assertFalse(TCPFrame(str(frame)).verify_ip_checksum())
+
+    def test_truncated_frame_is_not_tcp(self):
+        self.assertFalse(TCPFrame(encoded(ACK, '')[:40]).is_tcp())
+
+    def test_detach_keeps_what_the_reorder_queue_reads(self):
+        view = TCPFrame(encoded(ACK | FIN, 'tail', seq=7, ack_seq=9,
+                                adwind=512))
+        segment = view.detach()
+        self.assertEqual((segment.tcp_seq, segment.tcp_ack_seq,
+                          segment.tcp_adwind, segment.data),
+                         (7, 9, 512, 'tail'))
+        self.assertEqual((segment.tcp_ffin, segment.tcp_fsyn,
+                          segment.tcp_fack), (1, 0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
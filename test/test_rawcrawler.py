@@ -0,0 +1,60 @@
+'''
+Crawler over a scripted site, no network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from rawcrawler import Crawler
+
+HOST = 'site.test'
+# uri -> body, fed to the crawler in chunks of CHUNK bytes
+PAGES = {
+    '/': '<a href="/a.html">a</a> KEY=one <a href="/b.html">b</a>',
+    '/a.html': 'KEY=two <a href="/">home</a> KEY=one',
+    '/b.html': 'nothing here',
+}
+CHUNK = 7
+
+
+def setUpModule():
+    init_logger(None, 0)
+
+
+def fetch(clients, host, uri, consume):
+    body = PAGES[uri]
+    for offset in range(0, len(body), CHUNK):
+        consume(body[offset:offset + CHUNK])
+
+
+class CrawlerTest(unittest.TestCase):
+    def crawl(self, target_reg):
+        sink = StringIO()
+        crawler = Crawler(['http://%s/' % HOST], target_reg, sink,
+                          workers=2, fetch=fetch)
+        return crawler.run(), sink.getvalue()
+
+    def test_targets_are_written_once(self):
+        stats, output = self.crawl(r'KEY=(\w+) ')
+        self.assertEqual(stats['pages'], 3)
+        self.assertEqual(sorted(output.splitlines()), ['one', 'two'])
+        self.assertEqual(stats['matches'], 2)
+
+    def test_no_target_regex_writes_nothing(self):
+        stats, output = self.crawl('')
+        self.assertEqual(stats['pages'], 3)
+        self.assertEqual((output, stats['matches']), ('', 0))
+
+    def test_empty_matches_are_dropped(self):
+        stats, output = self.crawl(r'(\d*)')
+        self.assertEqual((output, stats['matches']), ('', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+'''
+rawdaemon serving rawclient on the simulated link and HTTP peer, no
+root or network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import json
+import socket
+import shutil
+import tempfile
+import unittest
+import threading
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+from logger import init_logger
+from rawdns import get_resolver
+from rawlink import set_link_factory
+from rawsim import SimLink, HttpPeer
+from rawdaemon import Daemon
+from rawclient import submit
+
+HOST = 'sim.test'
+FILES = {'/a.bin': os.urandom(100000), '/b.txt': 'b' * 3000}
+
+
+def setUpModule():
+    init_logger(None, 0)
+    get_resolver().add_host(HOST, '10.0.0.2')
+
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'daemon.sock')
+        self.peer = HttpPeer(FILES, keepalive=True)
+        set_link_factory(lambda iface: SimLink(self.peer, latency=0.002))
+        self.daemon = Daemon(self.path, 'sim')
+        # listening before the first client connects
+        self.daemon.bind()
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        set_link_factory(None)
+        shutil.rmtree(self.directory)
+
+    def submit(self, *paths):
+        return list(submit(['http://%s%s' % (HOST, path) for path in paths],
+                           self.path, self.directory))
+
+    def rawclient(self, *args):
+        client = subprocess.Popen(
+            [sys.executable, os.path.join(SRC, 'rawclient.py'),
+             '-s', self.path, '-d', self.directory] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = client.communicate()
+        return client.returncode, out
+
+    def test_jobs_are_answered_in_order(self):
+        replies = self.submit('/a.bin', '/missing', '/b.txt')
+        self.assertEqual([reply['url'] for reply in replies],
+                         ['http://sim.test/a.bin', 'http://sim.test/missing',
+                          'http://sim.test/b.txt'])
+        a, missing, b = replies
+        for reply, path in ((a, '/a.bin'), (b, '/b.txt')):
+            self.assertEqual(reply['size'], len(FILES[path]))
+            with open(reply['path'], 'rb') as f:
+                self.assertEqual(f.read(), FILES[path])
+            self.assertTrue(reply['start'] <= reply['first_byte'] <=
+                            reply['end'])
+        self.assertIn('error', missing)
+        self.assertEqual(self.daemon.metrics['jobs'], 3)
+        self.assertEqual(self.daemon.metrics['failures'], 1)
+
+    def test_connection_stays_warm_between_clients(self):
+        self.submit('/a.bin')
+        self.submit('/b.txt')
+        self.assertEqual(self.daemon.metrics['clients'], 2)
+        self.assertEqual(self.peer.metrics['connections'], 1)
+        self.assertEqual(self.peer.metrics['requests'], 2)
+
+    def test_malformed_job(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.path)
+        conn.sendall('not json\n{"directory": "."}\n')
+        conn.shutdown(socket.SHUT_WR)
+        replies = [json.loads(line) for line in conn.makefile('rb')]
+        conn.close()
+        self.assertTrue(replies[0]['error'].startswith('Malformed job'))
+        self.assertEqual(replies[1]['error'], 'No url in the job')
+
+    def test_rawclient(self):
+        rc, out = self.rawclient('http://sim.test/b.txt')
+        self.assertEqual(rc, 0)
+        self.assertEqual(out, os.path.join(self.directory, 'b.txt') + '\n')
+        rc, out = self.rawclient('--json', 'http://sim.test/b.txt',
+                                 'http://sim.test/missing')
+        self.assertEqual(rc, 1)
+        self.assertEqual([json.loads(line).get('size')
+                          for line in out.splitlines()], [3000, None])
+        self.daemon.shutdown()
+        self.assertEqual(self.rawclient('http://sim.test/b.txt')[0], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+'''
+Resolver against a stub DNS server on 127.0.0.1, no network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import time
+import socket
+import struct
+import unittest
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from rawdns import Resolver, DNS_HDR_FMT, DNS_RR_FMT, DNS_QUESTION_FMT, \
+    DNS_TYPE_A, DNS_TYPE_SOA, DNS_CLASS_IN, DNS_RCODE_NXDOMAIN
+
+SERVFAIL = 2
+
+
+def soa(minimum):
+    '''
+    SOA RDATA with root MNAME and RNAME and the given MINIMUM field
+    '''
+    return '\x00\x00' + struct.pack('!5L', 1, 7200, 900, 86400, minimum)
+
+
+# name -> (rcode, answer records, authority records) of the stub
+ZONE = {
+    'good.test': (0, [(DNS_TYPE_A, 120, socket.inet_aton('10.1.2.3'))], []),
+    'missing.test': (DNS_RCODE_NXDOMAIN, [],
+                     [(DNS_TYPE_SOA, 60, soa(300))]),
+    'lowmin.test': (DNS_RCODE_NXDOMAIN, [], [(DNS_TYPE_SOA, 600, soa(45))]),
+    'nodata.test': (0, [], [(DNS_TYPE_SOA, 90, soa(300))]),
+    'broken.test': (SERVFAIL, [], []),
+}
+# name -> name of the question the stub answers instead
+SPOOFED = {'spoofed.test': 'good.test'}
+
+
+def setUpModule():
+    init_logger(None, 0)
+
+
+class StubServer:
+    '''
+    Answers the A queries from ZONE, counts the queries per name
+    '''
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.queries = {}
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(512)
+            except socket.error:
+                return
+            self.sock.sendto(self.answer(data), addr)
+
+    def answer(self, query):
+        hdr_len = struct.calcsize(DNS_HDR_FMT)
+        qid = struct.unpack(DNS_HDR_FMT, query[:hdr_len])[0]
+        offset, labels = hdr_len, []
+        while ord(query[offset]):
+            length = ord(query[offset])
+            labels.append(query[offset + 1:offset + 1 + length])
+            offset += length + 1
+        question = query[hdr_len:offset + 1 +
+                         struct.calcsize(DNS_QUESTION_FMT)]
+        name = '.'.join(labels)
+        self.queries[name] = self.queries.get(name, 0) + 1
+        if name in SPOOFED:
+            name = SPOOFED[name]
+            question = ''.join('%c%s' % (len(label), label)
+                               for label in name.split('.')) + \
+                '\x00' + question[-struct.calcsize(DNS_QUESTION_FMT):]
+        rcode, answers, authority = ZONE.get(name, (DNS_RCODE_NXDOMAIN, [],
+                                                    []))
+        records = ''.join(
+            # a pointer to the name in the question
+            '\xc0\x0c' + struct.pack(DNS_RR_FMT, rtype, DNS_CLASS_IN, ttl,
+                                     len(rdata)) + rdata
+            for rtype, ttl, rdata in answers + authority)
+        return struct.pack(DNS_HDR_FMT, qid, 0x8180 | rcode, 1,
+                           len(answers), len(authority), 0) + \
+            question + records
+
+    def close(self):
+        self.sock.close()
+
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.resolver = Resolver(['127.0.0.1'], timeout=0.5, retries=1,
+                                 min_ttl=1, hosts=None,
+                                 port=self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+
+    def ttl(self, hostname):
+        return self.resolver.cache[hostname][1] - time.time()
+
+    def test_positive_answer_is_cached_for_its_ttl(self):
+        self.assertEqual(self.resolver.resolve('good.test'), '10.1.2.3')
+        self.assertEqual(self.resolver.resolve('GOOD.test'), '10.1.2.3')
+        self.assertEqual(self.server.queries['good.test'], 1)
+        self.assertTrue(115 < self.ttl('good.test') <= 120)
+
+    def test_nxdomain_is_cached_for_the_soa_ttl(self):
+        self.assertRaises(RuntimeError, self.resolver.resolve,
+                          'missing.test')
+        self.assertRaises(RuntimeError, self.resolver.resolve,
+                          'missing.test')
+        self.assertEqual(self.server.queries['missing.test'], 1)
+        self.assertEqual(self.resolver.cache['missing.test'][0], None)
+        self.assertTrue(55 < self.ttl('missing.test') <= 60)
+        self.assertEqual(self.resolver.metrics['negative'], 1)
+
+    def test_negative_ttl_is_capped_by_the_soa_minimum(self):
+        self.assertEqual(self.resolver.resolve_many(['lowmin.test']),
+                         {'lowmin.test': None})
+        self.assertTrue(40 < self.ttl('lowmin.test') <= 45)
+
+    def test_answer_to_another_question_is_dropped(self):
+        self.assertRaises(RuntimeError, self.resolver.resolve,
+                          'spoofed.test')
+        self.assertEqual(self.server.queries['spoofed.test'], 2)
+        self.assertNotIn('spoofed.test', self.resolver.cache)
+        self.assertNotIn('good.test', self.resolver.cache)
+
+    def test_nodata_is_cached_negatively(self):
+        self.assertEqual(self.resolver.resolve_many(['nodata.test']),
+                         {'nodata.test': None})
+        self.assertIn('nodata.test', self.resolver.cache)
+
+    def test_servfail_is_retried_and_not_cached(self):
+        self.assertRaises(RuntimeError, self.resolver.resolve,
+                          'broken.test')
+        # the first try and the retry
+        self.assertEqual(self.server.queries['broken.test'], 2)
+        self.assertNotIn('broken.test', self.resolver.cache)
+        self.assertEqual(self.resolver.metrics['failure'], 1)
+        self.assertRaises(RuntimeError, self.resolver.resolve,
+                          'broken.test')
+        self.assertEqual(self.server.queries['broken.test'], 4)
+
+    def test_batch_mixes_answers_and_failures(self):
+        result = self.resolver.resolve_many(['good.test', 'missing.test',
+                                             'broken.test'])
+        self.assertEqual(result, {'good.test': '10.1.2.3',
+                                  'missing.test': None,
+                                  'broken.test': None})
+        self.assertEqual(sorted(self.resolver.cache),
+                         ['good.test', 'missing.test'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+IPv4 fragment reassembly, no network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from rawip import IPDatagram, Reassembler, IP_MF
+
+SRC = socket.inet_aton('10.0.0.2')
+DEST = socket.inet_aton('10.0.0.1')
+PAYLOAD = os.urandom(4000)
+
+
+def datagram(ip_id=7, data=PAYLOAD, offset=0, more=False):
+    frag_off = offset // 8 | (IP_MF if more else 0)
+    return IPDatagram(SRC, DEST, ip_id=ip_id, ip_frag_off=frag_off,
+                      data=data).pack()
+
+
+def fragments(ip_id=7, size=1480, data=PAYLOAD):
+    '''
+    The fragments of the datagram in order, size bytes of data each
+    '''
+    return [datagram(ip_id, data[offset:offset + size], offset,
+                     offset + size < len(data))
+            for offset in range(0, len(data), size)]
+
+
+class ReassemblerTest(unittest.TestCase):
+    def setUp(self):
+        self.reassembler = Reassembler(timeout=30, max_bytes=1 << 20)
+
+    def feed(self, frags, now=0):
+        return [self.reassembler.reassemble(frag, now) for frag in frags]
+
+    def assertReassembled(self, results):
+        self.assertEqual(results[-1], datagram())
+        self.assertEqual(results[:-1], [None] * (len(results) - 1))
+        self.assertEqual(self.reassembler.buckets, {})
+        self.assertEqual(self.reassembler.size, 0)
+
+    def test_whole_datagram_passes_through(self):
+        self.assertEqual(self.feed([datagram()]), [datagram()])
+        self.assertEqual(self.reassembler.metrics['fragment'], 0)
+
+    def test_in_order(self):
+        self.assertReassembled(self.feed(fragments()))
+        self.assertEqual(self.reassembler.metrics['reassembled'], 1)
+
+    def test_reversed(self):
+        self.assertReassembled(self.feed(fragments()[::-1]))
+
+    def test_duplicates_are_held_once(self):
+        first = fragments()[0]
+        self.feed([first] * 10)
+        self.assertEqual(self.reassembler.size, 1480)
+        self.assertReassembled(self.feed(fragments()[1:]))
+
+    def test_overlaps_count_the_new_bytes_only(self):
+        # 0-1599 then 800-2399 and 1600-3999 over what is there
+        frags = [datagram(data=PAYLOAD[:1600], more=True),
+                 datagram(data=PAYLOAD[800:2400], offset=800, more=True)]
+        self.feed(frags)
+        self.assertEqual(self.reassembler.size, 2400)
+        self.feed(frags)
+        self.assertEqual(self.reassembler.size, 2400)
+        self.assertReassembled(self.feed([
+            datagram(data=PAYLOAD[1600:], offset=1600)]))
+
+    def test_first_copy_of_overlapping_bytes_wins(self):
+        forged = datagram(data='x' * 800, offset=800, more=True)
+        results = self.feed([fragments(size=1600)[0], forged] +
+                            fragments(size=1600)[1:])
+        self.assertEqual(results[-1], datagram())
+
+    def test_timeout(self):
+        self.feed(fragments()[:1], now=0)
+        self.assertEqual(self.feed(fragments()[1:], now=31), [None, None])
+        self.assertEqual(self.reassembler.metrics['timeout'], 1)
+        # what came after the timeout waits for the first fragment
+        self.assertEqual(self.reassembler.size, len(PAYLOAD) - 1480)
+
+    def test_memory_cap_evicts_the_oldest(self):
+        self.reassembler.max_bytes = 4000
+        for ip_id in range(3):
+            self.feed(fragments(ip_id)[:2])
+        self.assertEqual(self.reassembler.metrics['evict'], 2)
+        self.assertEqual(len(self.reassembler.buckets), 1)
+        self.assertEqual(self.reassembler.size, 2960)
+        # the same fragment again does not push the bucket out
+        self.feed(fragments(2)[:2])
+        self.assertEqual(self.reassembler.metrics['evict'], 2)
+
+    def test_malformed_lengths_drop_the_datagram(self):
+        self.feed(fragments()[:1])
+        # not a multiple of 8 bytes with more fragments to come
+        self.assertEqual(self.feed([datagram(data='x' * 100, offset=1480,
+                                             more=True)]), [None])
+        # beyond the largest datagram
+        self.assertEqual(self.feed([datagram(data='x' * 8, offset=65528,
+                                             more=True)]), [None])
+        self.assertEqual(self.reassembler.metrics['malformed'], 2)
+        self.assertEqual(self.reassembler.buckets, {})
+        self.assertEqual(self.reassembler.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
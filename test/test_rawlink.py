@@ -0,0 +1,119 @@
+'''
+Recording links on the simulated link and HTTP peer, no root or
+network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import socket
+import struct
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from rawdns import get_resolver
+from rawlink import set_link_factory, recording_factory, Replay
+from rawpcap import PcapWriter, read_pcap, OUTBOUND
+from rawsim import SimLink, HttpPeer
+import HttpClient as C
+
+HOST = 'sim.test'
+BODY = os.urandom(50000)
+
+
+def setUpModule():
+    init_logger(None, 0)
+    get_resolver().add_host(HOST, '10.0.0.2')
+
+
+class RecordingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session.pcapng')
+        peer = HttpPeer({'/a.bin': BODY})
+        set_link_factory(recording_factory(
+            self.path, lambda iface: SimLink(peer, latency=0.002)))
+
+    def tearDown(self):
+        set_link_factory(None)
+        shutil.rmtree(self.directory)
+
+    def retrieve(self):
+        chunks = []
+        C.HttpClient(HOST, 80, 'sim').retrieve('/a.bin', chunks.append)
+        self.assertEqual(''.join(chunks), BODY)
+
+    def syns(self):
+        # the SYN is the only TCP frame sent with flags 0x02, not ARP
+        return sum(1 for ts, frame, direction, comment
+                   in read_pcap(self.path)
+                   if direction == OUTBOUND and len(frame) > 47 and
+                   ord(frame[47]) == 0x02)
+
+    def test_recording_is_complete_once_the_link_closes(self):
+        self.retrieve()
+        # nothing left in the buffers of a writer still open
+        self.assertEqual(self.syns(), 1)
+
+    def test_later_links_append_to_the_recording(self):
+        self.retrieve()
+        self.retrieve()
+        self.assertEqual(self.syns(), 2)
+
+
+
+def syn(ihl=5, mss=1400):
+    '''
+    An Ethernet frame with a SYN from 10.0.0.1:40000 to 10.0.0.2:80,
+    the IP options padded with zeros
+    '''
+    options = struct.pack('!BBH', 2, 4, mss)
+    tcp = struct.pack('!HHLLBBHHH', 40000, 80, 1234, 0,
+                      (5 + len(options) // 4) << 4, 0x02, 65535, 0, 0) + \
+        options
+    ip = struct.pack('!BBHHHBBH4s4s', 0x40 | ihl, 0, ihl * 4 + len(tcp),
+                     0, 0, 64, socket.IPPROTO_TCP, 0,
+                     socket.inet_aton('10.0.0.1'),
+                     socket.inet_aton('10.0.0.2')) + \
+        '\x00' * (ihl * 4 - 20)
+    return '\x02' * 6 + '\x04' * 6 + '\x08\x00' + ip + tcp
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session.pcapng')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replay(self, *frames):
+        writer = PcapWriter(self.path)
+        for frame in frames:
+            writer.write(frame, OUTBOUND)
+        writer.close()
+        return Replay(self.path)
+
+    def test_truncated_frames_are_no_syns(self):
+        replay = self.replay(
+            # cut before the protocol of the IP header
+            syn()[:20],
+            # IP options claimed beyond the end of the frame
+            syn(ihl=15)[:60],
+            syn(mss=1300))
+        self.assertEqual(replay.server_ip(), '10.0.0.2')
+        self.assertEqual(replay.next_syn(), (40000, 1234))
+        self.assertEqual(replay.mtu, 1340)
+
+    def test_recording_without_a_syn(self):
+        replay = self.replay(syn()[:20], syn(ihl=15)[:60])
+        self.assertEqual(replay.server_ip(), None)
+        self.assertEqual(replay.next_syn(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
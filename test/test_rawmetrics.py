@@ -0,0 +1,82 @@
+'''
+Metrics registry exports, no network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from rawmetrics import Registry, PROMETHEUS
+
+
+def setUpModule():
+    init_logger(None, 0)
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'metrics.jsonl')
+        self.registry = Registry()
+        self.registry.enable()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def finish(self, host, size):
+        connection = self.registry.connection({'retransmit': 1})
+        connection.on_connect(host, 80)
+        connection.on_deliver(size)
+        connection.close()
+
+    def hosts(self):
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+        return [(r['host'], r['connections'], r['bytes_recv'])
+                for r in records if r['type'] == 'host']
+
+    def test_host_records_cover_the_interval_only(self):
+        self.finish('a.test', 100)
+        self.finish('b.test', 10)
+        self.registry.export(self.path)
+        self.finish('a.test', 50)
+        self.registry.export(self.path)
+        # nothing finished, no host record
+        self.registry.export(self.path)
+        self.assertEqual(self.hosts(), [(u'a.test', 1, 100),
+                                        (u'b.test', 1, 10),
+                                        (u'a.test', 1, 50)])
+
+    def test_intervals_follow_each_other(self):
+        self.finish('a.test', 100)
+        self.registry.export(self.path)
+        self.finish('a.test', 100)
+        self.registry.export(self.path)
+        with open(self.path) as f:
+            first, second = [r for r in map(json.loads, f)
+                             if r['type'] == 'host']
+        self.assertEqual(first['until'], second['since'])
+        self.assertTrue(second['since'] < second['until'])
+
+    def test_prometheus_stays_cumulative(self):
+        path = os.path.join(self.directory, 'metrics.prom')
+        self.finish('a.test', 100)
+        self.registry.export(path, PROMETHEUS)
+        self.finish('a.test', 50)
+        self.registry.export(path, PROMETHEUS)
+        with open(path) as f:
+            text = f.read()
+        self.assertIn('rawsocket_received_bytes_total{host="a.test"} 150.0',
+                      text)
+        self.assertEqual(self.registry.finished, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
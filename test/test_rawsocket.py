@@ -0,0 +1,248 @@
+'''
+RawSocket and HttpClient on the simulated link and HTTP peer, no root
+or network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import time
+import struct
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from rawdns import get_resolver
+from rawlink import set_link_factory
+from rawsim import SimLink, HttpPeer, SIM_LOCAL_IP
+from rawsocket import RawSocket
+from rawcodec import HDR_LEN, TCP_OFFSET, SYN, pseudo_header_sum
+from utils import checksum, checksum_add, checksum_fold
+import HttpClient as C
+
+HOST = 'sim.test'
+BODY = os.urandom(400000)
+ROUTER_IP = '\x0a\x00\x00\xfd'
+
+
+def setUpModule():
+    init_logger(None, 0)
+    get_resolver().add_host(HOST, '10.0.0.2')
+
+
+class EarlyAbortTest(unittest.TestCase):
+    '''
+    Giving up on a response while the server is still sending it in
+    order, when the receive path predicts every segment
+    '''
+    def setUp(self):
+        self.peer = HttpPeer({'/a.bin': BODY}, keepalive=True)
+        set_link_factory(lambda iface: SimLink(self.peer, latency=0.002))
+
+    def tearDown(self):
+        set_link_factory(None)
+
+    def refuse(self, rc, headers):
+        raise ValueError('Refused')
+
+    def test_error_in_on_response_surfaces(self):
+        client = C.HttpClient(HOST, 80, 'sim')
+        self.assertRaises(ValueError, client.retrieve, '/a.bin',
+                          lambda data: None, on_response=self.refuse)
+
+    def test_error_in_on_response_surfaces_with_a_pool(self):
+        pool = C.ConnectionPool()
+        client = C.HttpClient(HOST, 80, 'sim', pool=pool)
+        self.assertRaises(ValueError, client.retrieve, '/a.bin',
+                          lambda data: None, on_response=self.refuse)
+        # the connection cut short is not kept for another request
+        self.assertEqual(pool.idle, {})
+        code, headers = client.retrieve('/a.bin', lambda data: None)
+        self.assertEqual(code, '200')
+        pool.close()
+
+    def test_close_while_receiving(self):
+        sock = RawSocket('sim', timeout=6, tick=0.5,
+                         link=SimLink(HttpPeer({'/a.bin': BODY}),
+                                      latency=0.002))
+        sock.connect((HOST, 80), 'GET /a.bin HTTP/1.1\r\n'
+                     'Host: %s\r\n\r\n' % HOST)
+        self.assertTrue(sock.recv(8192))
+        self.assertTrue(sock.hp_head is not None)
+        begin = time.time()
+        sock.close()
+        # the rest of the response gets acknowledged, no timeout
+        self.assertTrue(time.time() - begin < 3)
+
+
+class DropFirstDataLink(SimLink):
+    '''
+    SimLink losing the first data segment we send
+    '''
+    def __init__(self, peer, **kwargs):
+        SimLink.__init__(self, peer, **kwargs)
+        self.dropped = False
+
+    def send(self, data):
+        data = str(data)
+        if not self.dropped and len(data) > HDR_LEN and \
+                not ord(data[TCP_OFFSET + 13]) & SYN:
+            self.dropped = True
+            return len(data)
+        return SimLink.send(self, data)
+
+
+class RetransmitTest(unittest.TestCase):
+    def test_timeout_resends_data_not_the_delayed_ack(self):
+        link = DropFirstDataLink(HttpPeer({'/a.bin': BODY}),
+                                 latency=0.002)
+        sock = RawSocket('sim', timeout=6, tick=0.5, link=link)
+        sock.connect((HOST, 80))
+        sock.send('GET /a.bin HTTP/1.1\r\nHost: %s\r\n\r\n' % HOST)
+        # data of the peer came in meanwhile, its ACK gets sent while
+        # waiting for the ACK of ours
+        sock.ack_pending = True
+        sock.flush()
+        # the lost segment went out again, the ACK only once
+        self.assertEqual(link.metrics['resent'], 0)
+        self.assertTrue(sock.recv(8192).startswith('HTTP/1.1 200'))
+        sock.abort()
+
+
+class NarrowPathLink(SimLink):
+    '''
+    SimLink behind a router with a smaller MTU, which drops the
+    larger frames we send and answers ICMP fragmentation needed
+    '''
+    def __init__(self, peer, path_mtu, **kwargs):
+        SimLink.__init__(self, peer, **kwargs)
+        self.path_mtu = path_mtu
+        self.too_big = 0
+
+    def send(self, data):
+        data = str(data)
+        if data[12:14] == '\x08\x00' and \
+                struct.unpack('!H', data[16:18])[0] > self.path_mtu:
+            self.too_big += 1
+            self.deliver(self.frag_needed(data))
+            return len(data)
+        return SimLink.send(self, data)
+
+    def frag_needed(self, data):
+        # the IP header and the first 8 bytes of the dropped datagram
+        icmp = struct.pack('!BBHHH', 3, 4, 0, 0, self.path_mtu) + \
+            data[14:42]
+        icmp = icmp[:2] + struct.pack('!H', checksum(icmp)) + icmp[4:]
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(icmp), 0, 0,
+                         64, 1, 0, ROUTER_IP, SIM_LOCAL_IP)
+        ip = ip[:10] + struct.pack('!H', checksum(ip)) + ip[12:]
+        return data[6:12] + data[:6] + '\x08\x00' + ip + icmp
+
+
+class PathMTUTest(unittest.TestCase):
+    '''
+    Sending when the path MTU drops below the MTU of the interface
+    '''
+    def setUp(self):
+        self.peer = HttpPeer({})
+        self.links = []
+        set_link_factory(self.narrow_link)
+
+    def tearDown(self):
+        set_link_factory(None)
+
+    def narrow_link(self, iface):
+        self.links.append(NarrowPathLink(self.peer, 1000, latency=0.002))
+        return self.links[-1]
+
+    def test_segments_in_flight_are_sliced_and_resent(self):
+        begin = time.time()
+        rc, headers, digest = C.HttpClient(HOST, 80, 'sim').PUT('/up.bin',
+                                                                BODY)
+        self.assertEqual(rc, '201')
+        self.assertEqual(self.peer.uploads['/up.bin'],
+                         (len(BODY), hashlib.md5(BODY).hexdigest()))
+        # the whole first window was too large, resent at once
+        self.assertTrue(self.links[0].too_big > 1)
+        self.assertTrue(time.time() - begin < 3)
+
+
+
+class ScriptedDownLink(SimLink):
+    '''
+    SimLink delivering the nth data segment of the peer late, after
+    the next one, or with ECE set among its flags
+    '''
+    def __init__(self, peer, nth, action, **kwargs):
+        SimLink.__init__(self, peer, **kwargs)
+        self.nth = nth
+        self.action = action
+        self.count = 0
+        self.held = None
+
+    def deliver(self, frame):
+        frame = str(frame)
+        # ARP, or a segment without data
+        if frame[12:14] != '\x08\x00' or \
+                struct.unpack('!H', frame[16:18])[0] <= \
+                20 + (ord(frame[TCP_OFFSET + 12]) >> 4) * 4:
+            return SimLink.deliver(self, frame)
+        self.count += 1
+        if self.count == self.nth and self.action == 'late':
+            self.held = frame
+            return
+        if self.count == self.nth and self.action == 'ece':
+            frame = self.flag(frame, 0x40)
+        SimLink.deliver(self, frame)
+        if self.held and self.count == self.nth + 1:
+            SimLink.deliver(self, self.held)
+
+    def flag(self, frame, flag):
+        tcp_len = struct.unpack('!H', frame[16:18])[0] - 20
+        tcp = bytearray(frame[TCP_OFFSET:])
+        tcp[13] |= flag
+        tcp[16:18] = '\x00\x00'
+        tcp[16:18] = struct.pack('!H', checksum_fold(checksum_add(
+            buffer(tcp, 0, tcp_len),
+            pseudo_header_sum(frame[26:30], frame[30:34], tcp_len))))
+        return frame[:TCP_OFFSET] + str(tcp)
+
+
+class HeaderPredictionTest(unittest.TestCase):
+    '''
+    Segments the receive path cannot predict take the general path,
+    the prediction resumes behind them
+    '''
+    def fetch(self, nth=None, action=None):
+        link = ScriptedDownLink(HttpPeer({'/a.bin': BODY}), nth, action,
+                                latency=0.002)
+        sock = RawSocket('sim', timeout=6, tick=0.5, link=link)
+        sock.connect((HOST, 80), 'GET /a.bin HTTP/1.1\r\n'
+                     'Host: %s\r\n\r\n' % HOST)
+        response = []
+        while not sock.fin_received:
+            response.append(sock.recv(65536))
+        sock.abort()
+        self.assertEqual(''.join(response).split('\r\n\r\n', 1)[1], BODY)
+        return sock.metrics['erecv'] - sock.metrics['fastpath'], \
+            sock.metrics['fastpath']
+
+    def test_out_of_order_segment_falls_back(self):
+        slow, fast = self.fetch()
+        late_slow, late_fast = self.fetch(20, 'late')
+        # the segment ahead of the gap and the one filling it, the
+        # segments behind them predicted again
+        self.assertEqual(late_slow, slow + 2)
+        self.assertEqual(late_fast, fast - 2)
+
+    def test_flagged_segment_falls_back(self):
+        slow, fast = self.fetch()
+        ece_slow, ece_fast = self.fetch(20, 'ece')
+        self.assertEqual(ece_slow, slow + 1)
+        self.assertEqual(ece_fast, fast - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+'''
+TCP Fast Open on the simulated link and HTTP peer, no root or
+network needed
+
+    python -m unittest discover test
+'''
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import init_logger
+from rawdns import get_resolver
+from rawlink import set_link_factory
+from rawsim import SimLink, HttpPeer, SIM_LOCAL_IP
+from rawsocket import RawSocket
+from rawcodec import TCP_OFFSET, ETH_HDR_LEN, IP_HDR_LEN, SYN
+import rawtfo
+import HttpClient as C
+
+HOST = 'sim.test'
+HOST_IP = '10.0.0.2'
+BODY = os.urandom(20000)
+REQUEST = 'GET /a.bin HTTP/1.1\r\nHost: %s\r\n\r\n' % HOST
+
+
+def setUpModule():
+    init_logger(None, 0)
+    get_resolver().add_host(HOST, HOST_IP)
+
+
+class NoSynDataLink(SimLink):
+    '''
+    SimLink behind a middlebox dropping the SYNs that carry data
+    '''
+    def __init__(self, peer, **kwargs):
+        SimLink.__init__(self, peer, **kwargs)
+        self.dropped = 0
+
+    def send(self, data):
+        data = str(data)
+        if len(data) > TCP_OFFSET + 13 and \
+                ord(data[TCP_OFFSET + 13]) & SYN:
+            tlen = struct.unpack('!H', data[ETH_HDR_LEN + 2:
+                                            ETH_HDR_LEN + 4])[0]
+            doff = (ord(data[TCP_OFFSET + 12]) >> 4) * 4
+            if tlen > IP_HDR_LEN + doff:
+                self.dropped += 1
+                return len(data)
+        return SimLink.send(self, data)
+
+
+class FastOpenTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = rawtfo.enable(os.path.join(self.directory,
+                                                'cookies.json'))
+        self.peer = HttpPeer({'/a.bin': BODY}, fastopen=True)
+        set_link_factory(lambda iface: SimLink(self.peer, latency=0.002))
+
+    def tearDown(self):
+        set_link_factory(None)
+        rawtfo.disable()
+        shutil.rmtree(self.directory)
+
+    def retrieve(self):
+        chunks = []
+        code, headers = C.HttpClient(HOST, 80, 'sim').retrieve(
+            '/a.bin', chunks.append)
+        self.assertEqual(code, '200')
+        self.assertEqual(''.join(chunks), BODY)
+
+    def metrics(self, *names):
+        return [self.cache.metrics[name] for name in names]
+
+    def test_first_connection_asks_for_a_cookie(self):
+        self.retrieve()
+        self.assertEqual(self.metrics('request', 'cookie'), [1, 1])
+        self.assertEqual(self.peer.metrics['tfo_request'], 1)
+        cookie, mss = self.cache.lookup(HOST_IP)
+        self.assertEqual(cookie, self.peer.cookie(SIM_LOCAL_IP))
+
+    def test_request_goes_in_the_syn(self):
+        self.retrieve()
+        self.retrieve()
+        self.assertEqual(self.metrics('request', 'accepted', 'rejected'),
+                         [1, 1, 0])
+        self.assertEqual(self.peer.metrics['tfo_accepted'], 1)
+
+    def test_rejected_data_is_resent_after_the_handshake(self):
+        self.retrieve()
+        # a new secret on the server invalidates the cookie
+        self.peer.secret = os.urandom(16)
+        self.retrieve()
+        self.assertEqual(self.metrics('accepted', 'rejected'), [0, 1])
+        self.assertEqual(self.peer.metrics['tfo_rejected'], 1)
+        # the SYN-ACK came with the new cookie, which gets taken next
+        self.assertEqual(self.metrics('cookie'), [2])
+        self.retrieve()
+        self.assertEqual(self.metrics('accepted'), [1])
+
+    def test_syn_timeout_falls_back_and_disables_fast_open(self):
+        self.retrieve()
+        link = NoSynDataLink(self.peer, latency=0.002)
+        sock = RawSocket('sim', timeout=6, tick=0.5, link=link)
+        sock.connect((HOST, 80), REQUEST)
+        self.assertTrue(sock.recv(8192).startswith('HTTP/1.1 200'))
+        sock.abort()
+        self.assertEqual(link.dropped, 1)
+        self.assertEqual(self.metrics('fallback', 'accepted'), [1, 0])
+        self.assertEqual(self.cache.lookup(HOST_IP), (None, None))
+        # the next connections leave Fast Open alone
+        self.retrieve()
+        self.assertEqual(self.metrics('request'), [1])
+        self.assertEqual(self.peer.metrics['tfo_request'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()